@@ -0,0 +1,227 @@
+"""
+Benchmarks for stitch counting, thread estimation, palette creation, colour
+matching and chart rendering.
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.benchmark --sizes 100,500 --output results.json
+
+Synthetic pixel art and photo-like images are generated with a fixed seed, so
+results of different runs are comparable.
+"""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import click
+import imageio
+from matplotlib.backends.backend_pdf import PdfPages
+import numpy as np
+
+from crosstitch_helper.chart_renderer import ChartRenderer
+from crosstitch_helper.imagetool import ImageTool
+from crosstitch_helper.palette import Palette
+from crosstitch_helper.palette_creator import PaletteCreator
+from crosstitch_helper.stitch_counter import StitchCounter
+from crosstitch_helper.thread_length import ThreadEstimator
+
+from conf import palettes
+
+DMC_PALETTE = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                           "palettes", "dmc.json")
+SYMBOLS = [chr(code) for code in range(0x21, 0x7f)]
+
+
+def pixel_art_image(size, rng):
+    """
+    Return RGB data of a pixel art like image using the Monkey Island palette.
+
+    The image consists of rectangular blocks of colour with some single
+    stitches scattered around.
+    """
+    colours = np.array([[int(key[i:i + 2], 16) for i in (1, 3, 5)]
+                        for key in palettes.monkey_island_palette],
+                       dtype=np.uint8)
+    block = max(size // 20, 1)
+    blocks = rng.integers(0, len(colours), (size // block + 1,) * 2)
+    indices = np.kron(blocks, np.ones((block, block), dtype=int))[:size, :size]
+    confetti = rng.random((size, size)) < 0.02
+    indices[confetti] = rng.integers(0, len(colours), confetti.sum())
+    return colours[indices]
+
+
+def photo_like_image(size, rng):
+    """
+    Return RGB data of an image with smooth gradients and noise.
+    """
+    y, x = np.mgrid[0:size, 0:size] / max(size - 1, 1)
+    image = np.stack([255 * x, 255 * y, 127 + 127 * np.sin(6 * x * y)],
+                     axis=-1)
+    image += rng.normal(0, 8, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def measure(function, repeat=1, trace_memory=True):
+    """
+    Run a function and return the best wall time and peak traced memory.
+
+    Timed runs are done without memory tracing, as tracing slows down Python
+    code considerably. If `trace_memory` is set, the function is run once more
+    while tracing memory allocations. Otherwise peak memory is None.
+
+    Returns a tuple `(seconds, peak_bytes, result)`.
+    """
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    peak = None
+    if trace_memory:
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return best, peak, result
+
+
+def _result(name, kind, size, seconds, peak, **throughput):
+    """
+    Return a dict describing the result of one benchmark.
+    """
+    result = {"benchmark": name,
+              "image": kind,
+              "size": size,
+              "seconds": seconds,
+              "peak_memory_bytes": peak}
+    for unit, amount in throughput.items():
+        result[unit + "_per_second"] = amount / seconds if seconds else None
+    return result
+
+
+def run_image_benchmarks(path, kind, size, dmc, max_pages, **measure_args):
+    """
+    Run all benchmarks for one image and return their results.
+    """
+    # pylint: disable=too-many-arguments, too-many-locals
+    pixels = size * size
+    results = []
+
+    seconds, peak, image_tool = measure(lambda: ImageTool(path),
+                                        **measure_args)
+    results.append(_result("load", kind, size, seconds, peak, pixels=pixels))
+
+    def create_palette():
+        creator = PaletteCreator(ImageTool(path), SYMBOLS)
+        creator.create_palette()
+        return creator
+    seconds, peak, creator = measure(create_palette, **measure_args)
+    results.append(_result("create_palette", kind, size, seconds, peak,
+                           pixels=pixels))
+    # pylint: disable=protected-access
+    palette = creator._palette
+
+    def count():
+        counter = StitchCounter(ImageTool(path), palette)
+        counter.count_all_stitches()
+        return counter
+    seconds, peak, _ = measure(count, **measure_args)
+    results.append(_result("count_all_stitches", kind, size, seconds, peak,
+                           pixels=pixels))
+
+    runs = image_tool.runs()
+    seconds, peak, _ = measure(
+        lambda: ThreadEstimator(runs).colour_stats(), **measure_args)
+    results.append(_result("estimate_thread", kind, size, seconds, peak,
+                           pixels=pixels))
+
+    seconds, peak, _ = measure(
+        lambda: dmc.best_match_many(image_tool.colour_values()),
+        **measure_args)
+    results.append(_result("best_match_many", kind, size, seconds, peak,
+                           pixels=pixels))
+
+    sample = image_tool.colour_values().reshape(-1, 3)[:100]
+    seconds, peak, _ = measure(
+        lambda: [dmc.best_match(colour) for colour in sample], **measure_args)
+    results.append(_result("best_match", kind, size, seconds, peak,
+                           colours=len(sample)))
+
+    renderer = ChartRenderer(image_tool, palette)
+    pages = renderer.pages()[:max_pages]
+
+    def render():
+        with tempfile.TemporaryFile() as outfile, PdfPages(outfile) as pdf:
+            for page in pages:
+                pdf.savefig(renderer.draw_page(page), bbox_inches="tight")
+    seconds, peak, _ = measure(render, **measure_args)
+    results.append(_result("render_pages", kind, size, seconds, peak,
+                           pages=len(pages)))
+    return results
+
+
+def environment():
+    """
+    Return a dict describing the environment the benchmarks were run in.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"],
+                                capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"python": sys.version.split()[0],
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "commit": commit,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z")}
+
+
+@click.command()
+@click.option("--sizes", default="100,500,2000",
+              help="Comma separated list of image side lengths in pixels")
+@click.option("--repeat", type=int, default=1,
+              help="Number of times each benchmark is run, best time is used")
+@click.option("--max-pages", type=int, default=4,
+              help="Maximum number of chart pages rendered per image")
+@click.option("--trace-memory/--no-trace-memory", default=True,
+              help="Measure peak memory in an additional traced run")
+@click.option("--seed", type=int, default=0,
+              help="Seed for generating the synthetic images")
+@click.option("--output", type=click.File("w"), default="-",
+              help="File for the JSON results, defaults to stdout")
+def main(sizes, repeat, trace_memory, max_pages, seed, output):
+    """
+    Run the benchmarks and write the results as JSON.
+    """
+    dmc = Palette.load(DMC_PALETTE)
+    generators = {"pixel_art": pixel_art_image, "photo": photo_like_image}
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in (int(size) for size in sizes.split(",")):
+            for kind, generator in generators.items():
+                path = os.path.join(directory, "{}-{}.png".format(kind, size))
+                imageio.imwrite(path, generator(size,
+                                                np.random.default_rng(seed)))
+                click.echo("Benchmarking {} {}x{}".format(kind, size, size),
+                           err=True)
+                results.extend(run_image_benchmarks(
+                    path, kind, size, dmc, max_pages, repeat=repeat,
+                    trace_memory=trace_memory))
+    json.dump({"environment": environment(), "results": results}, output,
+              indent=4)
+    output.write("\n")
+
+
+if __name__ == "__main__":
+    # pylint: disable=no-value-for-parameter
+    main()
@@ -0,0 +1,166 @@
+"""
+Processing of several pattern images with one shared palette.
+"""
+
+import csv
+import json
+import multiprocessing
+
+from crosstitch_helper.imagetool import ImageTool
+from crosstitch_helper.stitch_counter import StitchCounter, skein_count
+
+TOTAL = "TOTAL"
+
+_worker_palette = None
+_worker_lazy = False
+
+
+class BatchCounter():
+    """
+    Count the stitches of many images concurrently.
+    """
+
+    def __init__(self, palette, workers=None, lazy=False):
+        """
+        Create a new BatchCounter.
+
+        :palette: colour palette shared by all the images
+        :workers: Number of worker processes. Defaults to the number of CPUs.
+        :lazy: Whether images are read in strips, see `ImageTool`
+        """
+        self._palette = palette
+        self._workers = workers
+        self._lazy = lazy
+
+    def count(self, paths):
+        """
+        Count stitches of each colour in each image.
+
+        The palette is sent to each worker process only once. Returns a list
+        of dicts, one per image in the order of `paths`, containing the path
+        ("image"), stitch counts of each colour ("stitch_count") and an error
+        message ("error") if the image could not be processed.
+
+        :paths: paths of the pattern images
+        """
+        with multiprocessing.Pool(
+                self._workers, initializer=_init_worker,
+                initargs=(self._palette, self._lazy)) as pool:
+            return pool.map(_count_image, paths)
+
+
+class BatchReport():
+    """
+    Per-image and total stitch and skein counts of a batch of images.
+    """
+
+    FIELDS = ["image", "colour", "symbol", "stitches", "skeins"]
+
+    def __init__(self, results, palette, stitches_per_skein):
+        """
+        Create a new report.
+
+        :results: list of results from `BatchCounter.count`
+        :palette: colour palette that holds the symbols for each colour
+        :stitches_per_skein: How many stitches can one skein of thread make
+        """
+        self._results = results
+        self._palette = palette
+        self._stitches_per_skein = stitches_per_skein
+
+    def errors(self):
+        """
+        Return a list of `(image, error message)` tuples of failed images.
+        """
+        return [(result["image"], result["error"])
+                for result in self._results if result["error"]]
+
+    def total_stitch_count(self):
+        """
+        Return a dict of total stitch counts of each colour in all images.
+        """
+        total = {}
+        for result in self._results:
+            for colour, count in result["stitch_count"].items():
+                total[colour] = total.get(colour, 0) + count
+        return total
+
+    def rows(self):
+        """
+        Return the report as a list of dicts having the keys in `FIELDS`.
+
+        Each image has one row per colour, followed by the totals of all
+        images with "TOTAL" as the image name. Total skein counts are
+        calculated from the total number of stitches.
+        """
+        rows = []
+        for result in self._results:
+            rows.extend(self._colour_rows(result["image"],
+                                          result["stitch_count"]))
+        rows.extend(self._colour_rows(TOTAL, self.total_stitch_count()))
+        return rows
+
+    def write_csv(self, outfile):
+        """
+        Write the report rows into a CSV file.
+        """
+        writer = csv.DictWriter(outfile, fieldnames=self.FIELDS)
+        writer.writeheader()
+        writer.writerows(self.rows())
+
+    def write_json(self, outfile, indent=4):
+        """
+        Write the report into a JSON file.
+
+        The output has a list of images, each with its colours and possible
+        error, and the totals of all images.
+        """
+        images = [{"image": result["image"],
+                   "error": result["error"],
+                   "colours": self._colour_rows(None, result["stitch_count"])}
+                  for result in self._results]
+        report = {"images": images,
+                  "total": self._colour_rows(None, self.total_stitch_count())}
+        json.dump(report, outfile, indent=indent, ensure_ascii=False)
+        outfile.write("\n")
+
+    def _colour_rows(self, image, stitch_count):
+        """
+        Return rows of one image, the most prevalent colour first.
+        """
+        rows = []
+        for colour in sorted(stitch_count, key=stitch_count.get,
+                             reverse=True):
+            row = {"colour": colour,
+                   "symbol": self._palette[colour][0],
+                   "stitches": stitch_count[colour],
+                   "skeins": skein_count(stitch_count[colour],
+                                         self._stitches_per_skein)}
+            if image is not None:
+                row["image"] = image
+            rows.append(row)
+        return rows
+
+
+def _init_worker(palette, lazy):
+    """
+    Store the shared palette in a worker process.
+    """
+    # pylint: disable=global-statement
+    global _worker_palette, _worker_lazy
+    _worker_palette = palette
+    _worker_lazy = lazy
+
+
+def _count_image(path):
+    """
+    Return the stitch counts of one image as a result dict.
+    """
+    try:
+        counter = StitchCounter(ImageTool(path, lazy=_worker_lazy),
+                                _worker_palette)
+        counter.count_all_stitches()
+    except (OSError, ValueError) as error:
+        return {"image": path, "stitch_count": {}, "error": str(error)}
+    return {"image": path, "stitch_count": counter.stitch_count,
+            "error": None}
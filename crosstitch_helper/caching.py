@@ -0,0 +1,93 @@
+"""
+Locations and helpers for data cached on disk between runs.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+
+def default_cache_dir(subdirectory=None):
+    """
+    Return the directory for cached data, creating it if necessary.
+
+    The location can be set using the environment variable
+    CROSSTITCH_CACHE_DIR. Otherwise `$XDG_CACHE_HOME/crosstitch_helper` (or
+    `~/.cache/crosstitch_helper`) is used.
+
+    :subdirectory: Optional name of a subdirectory within the cache directory
+    """
+    path = os.environ.get("CROSSTITCH_CACHE_DIR")
+    if not path:
+        base = os.environ.get("XDG_CACHE_HOME",
+                              os.path.join(os.path.expanduser("~"), ".cache"))
+        path = os.path.join(base, "crosstitch_helper")
+    if subdirectory:
+        path = os.path.join(path, subdirectory)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def file_digest(source):
+    """
+    Return SHA-1 hex digest of the contents of a file.
+
+    :source: path to the file or a binary file object. File objects are
+             rewound to their original position afterwards.
+    """
+    digest = hashlib.sha1()
+    if hasattr(source, "read"):
+        position = source.tell()
+        for block in iter(lambda: source.read(1 << 20), b""):
+            digest.update(block)
+        source.seek(position)
+    else:
+        with open(source, "rb") as infile:
+            for block in iter(lambda: infile.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def decoded_image(source, cache_dir=None, strip_height=256):
+    """
+    Return RGB data of an image memory-mapped from an uncompressed cache.
+
+    The image is decoded only the first time it is seen: the decoded pixels
+    are stored as a `.npy` file named after the hash of the image file, and
+    later calls only memory-map that file. When decoding, Pillow still holds
+    the whole image in its own pixel format (e.g. one byte per pixel for
+    palette images), but it is converted to RGB and written to the cache one
+    strip of rows at a time.
+
+    :source: path to the image or a binary file object
+    :cache_dir: Directory of the decoded images. Defaults to `images` in the
+                directory given by `default_cache_dir`.
+    :strip_height: Number of rows converted at a time when decoding
+    """
+    if cache_dir is None:
+        cache_dir = default_cache_dir("images")
+    cache_path = os.path.join(cache_dir, file_digest(source) + ".npy")
+    if not os.path.exists(cache_path):
+        temporary_path = "{}.{}.tmp.npy".format(cache_path[:-4], os.getpid())
+        _decode_in_strips(source, temporary_path, strip_height)
+        os.replace(temporary_path, cache_path)
+    return np.load(cache_path, mmap_mode="r")
+
+
+def _decode_in_strips(source, path, strip_height):
+    """
+    Decode an image into a `.npy` file of RGB data, one strip at a time.
+    """
+    # pylint: disable=import-outside-toplevel
+    from PIL import Image
+    with Image.open(source) as image:
+        width, height = image.size
+        imagedata = np.lib.format.open_memmap(
+            path, mode="w+", dtype=np.uint8, shape=(height, width, 3))
+        for first_row in range(0, height, strip_height):
+            last_row = min(first_row + strip_height, height)
+            imagedata[first_row:last_row] = np.asarray(image.crop(
+                (0, first_row, width, last_row)).convert("RGB"))
+        imagedata.flush()
+        del imagedata
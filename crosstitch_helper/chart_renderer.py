@@ -0,0 +1,293 @@
+"""
+Rendering of printable cross stitch charts.
+"""
+
+import collections
+import functools
+import io
+import multiprocessing
+import os
+
+import numpy as np
+
+from crosstitch_helper import stats
+from crosstitch_helper.imagetool import code_to_hex, pack_rgb
+from crosstitch_helper.pdf_writer import PdfWriter, copy_pages
+
+SYMBOL_SIZE = 9  # points
+INCHES_PER_STITCH = 0.22
+
+
+class ChartRenderer():
+    """
+    Draw the pattern as pages of symbol charts.
+    """
+
+    def __init__(self, image_tool, palette, page_width=50, page_height=80):
+        """
+        Create a new renderer.
+
+        :image_tool: `ImageTool` for the pattern image
+        :palette: colour palette that holds the symbols for each colour
+        :page_width: width of one page in stitches
+        :page_height: height of one page in stitches
+        """
+        self._image_tool = image_tool
+        self._palette = palette
+        self.page_width = page_width
+        self.page_height = page_height
+
+    def pages(self):
+        """
+        Return a list of the pages in the chart.
+
+        Each page is given as a tuple `(min_x, min_y, max_x, max_y)` of the
+        stitch coordinates it covers. Pages proceed column by column, from
+        upper left to lower right.
+        """
+        height, width = self._image_tool.colour_values().shape[:2]
+        return page_bounds(width, height, self.page_width, self.page_height)
+
+    def render(self, output, workers=None):
+        """
+        Render all pages into one multi-page PDF file.
+
+        Pages are drawn and saved as PDF in parallel on a pool of worker
+        processes, and copied into the file in order as soon as they are
+        ready. Only a few pages per worker are drawn ahead of the one being
+        copied.
+
+        :output: path or binary file object of the output PDF
+        :workers: Number of worker processes. Defaults to the number of CPUs.
+        """
+        if not hasattr(output, "write"):
+            with open(output, "wb") as outfile:
+                self.render(outfile, workers=workers)
+            return
+        pdf = PdfWriter(output)
+        catalog, pages_tree = pdf.reserve(), pdf.reserve()
+        kids = []
+        with stats.timer("render chart"), \
+                multiprocessing.Pool(workers) as pool:
+            for data in _save_pages(pool, self._page_tasks(), workers):
+                kids.extend(copy_pages(pdf, data, pages_tree))
+                stats.count("pages rendered")
+        pdf.write_object(pages_tree, "<< /Type /Pages /Kids [{}] /Count {} >>"
+                         "".format(" ".join("{} 0 R".format(kid)
+                                            for kid in kids),
+                                   len(kids)).encode())
+        pdf.write_object(catalog, "<< /Type /Catalog /Pages {} 0 R >>"
+                         "".format(pages_tree).encode())
+        pdf.close(catalog)
+
+    def render_pages(self, directory, pages=None, workers=None, pool=None):
+        """
+        Render pages into separate PDF files.
+
+        Pages are drawn and saved as PDF in parallel on a pool of worker
+        processes, a few pages per worker ahead of the one being written.
+
+        The file of each page is named after its number in the whole chart,
+        e.g. `page-003.pdf`, so that single pages can be regenerated without
+        touching the others.
+
+        :directory: Output directory, created if it does not exist
+        :pages: Bounds of the pages to render, as returned by `pages`.
+                Defaults to all pages.
+        :workers: Number of worker processes. Defaults to the number of CPUs.
+        :pool: Optional `multiprocessing.Pool` to draw the pages with instead
+               of starting a new one
+        :returns: list of the paths of the written files
+        """
+        # pylint: disable=too-many-arguments
+        os.makedirs(directory, exist_ok=True)
+        all_pages = self.pages()
+        if pages is None:
+            pages = all_pages
+        indices = {page: index for index, page in enumerate(all_pages)}
+        paths = [os.path.join(directory, page_file_name(indices[page]))
+                 for page in pages]
+        if not paths:
+            return paths
+        tasks = (self._page_task(page) for page in pages)
+        with stats.timer("render chart"):
+            if pool is None:
+                with multiprocessing.Pool(workers) as own_pool:
+                    _write_pages(paths, _save_pages(own_pool, tasks, workers))
+            else:
+                _write_pages(paths, _save_pages(pool, tasks, workers))
+        stats.count("pages rendered", len(paths))
+        return paths
+
+    def draw_page(self, page):
+        """
+        Return a matplotlib `Figure` containing one page of the chart.
+
+        :page: page bounds, as returned by `pages`
+        """
+        return _draw_page(self._page_task(page))
+
+    def _page_tasks(self):
+        """
+        Yield the data needed to draw each page.
+        """
+        for page in self.pages():
+            yield self._page_task(page)
+
+    def _page_task(self, page):
+        """
+        Return the data needed to draw the given page.
+        """
+        min_x, min_y, max_x, max_y = page
+        plotarea = self._image_tool.colour_values()[min_y:max_y, min_x:max_x]
+        return (np.array(plotarea), min_x, min_y, self._palette)
+
+
+def page_bounds(width, height, page_width, page_height):
+    """
+    Return the bounds `(min_x, min_y, max_x, max_y)` of the pages of a chart.
+
+    Pages proceed column by column, from upper left to lower right.
+
+    :width: width of the pattern in stitches
+    :height: height of the pattern in stitches
+    :page_width: width of one page in stitches
+    :page_height: height of one page in stitches
+    """
+    return [(min_x, min_y,
+             min(min_x + page_width, width),
+             min(min_y + page_height, height))
+            for min_x in range(0, width, page_width)
+            for min_y in range(0, height, page_height)]
+
+
+def _save_pages(pool, tasks, workers=None):
+    """
+    Yield the PDF data of each page from `_save_page` on a pool, in order.
+
+    Unlike `Pool.imap`, which takes all tasks at once, only two tasks per
+    worker are queued at a time, so that the page data waiting to be drawn
+    or written stays bounded.
+
+    :pool: `multiprocessing.Pool` to draw the pages with
+    :tasks: iterable of page tasks
+    :workers: number of worker processes of the pool, defaults to the number
+              of CPUs
+    """
+    window = 2 * (workers or os.cpu_count() or 1)
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.apply_async(_save_page, (task,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _write_pages(paths, pages):
+    """
+    Write the PDF data of each page into its own file.
+    """
+    for path, data in zip(paths, pages):
+        with open(path, "wb") as outfile:
+            outfile.write(data)
+
+
+def page_file_name(index, extension="pdf"):
+    """
+    Return the file name of a page rendered by `render_pages`.
+
+    :index: index of the page in `ChartRenderer.pages`
+    :extension: file name extension of the page files
+    """
+    return "page-{:03d}.{}".format(index + 1, extension)
+
+
+def _save_page(task):
+    """
+    Return one page of the chart as a PDF document in bytes.
+
+    :task: tuple of page image data, page offsets and the palette
+    """
+    output = io.BytesIO()
+    _draw_page(task).savefig(output, format="pdf", bbox_inches="tight")
+    return output.getvalue()
+
+
+def _draw_page(task):
+    """
+    Return a `Figure` with one page of the chart.
+
+    Symbols are drawn as one path collection per colour instead of one text
+    object per stitch.
+
+    :task: tuple of page image data, page offsets and the palette
+    """
+    # pylint: disable=too-many-locals, import-outside-toplevel
+    from matplotlib.collections import PathCollection
+    from matplotlib.figure import Figure
+    from matplotlib.transforms import Affine2D
+
+    plotarea, min_x, min_y, palette = task
+    height, width = plotarea.shape[:2]
+    max_x = min_x + width
+    max_y = min_y + height
+
+    fig = Figure(figsize=(INCHES_PER_STITCH * width,
+                          INCHES_PER_STITCH * height))
+    ax = fig.add_subplot()
+    ax.imshow(plotarea)
+
+    ax.grid(True, which="major", color="0.95", linestyle="-", linewidth=2.0)
+    ax.minorticks_on()
+    ax.grid(True, which="minor", color="0.7", linestyle="-", linewidth=1.0)
+    ax.tick_params("both", top=True, right=True)
+    ax.tick_params("both", labeltop=True, labelright=True)
+
+    # put a major gridline every 5 stitches
+    ax.set_xticks(np.arange(-0.5, width + 1, 5))
+    ax.set_yticks(np.arange(-0.5, height + 1, 5))
+    ax.set_xticklabels(np.arange(min_x, max_x + 1, 5))
+    ax.set_yticklabels(np.arange(min_y, max_y + 1, 5))
+
+    # put a minor gridline every stitch
+    ax.set_xticks(np.arange(-0.5, width, 1), minor=True)
+    ax.set_yticks(np.arange(-0.5, height, 1), minor=True)
+
+    symbol_transform = Affine2D().scale(1 / 72) + fig.dpi_scale_trans
+    codes = pack_rgb(plotarea)
+    for code in np.unique(codes):
+        hexvalue = code_to_hex(code)
+        if hexvalue not in palette:
+            raise ValueError("Colour {} found in the pattern image, "
+                             "not found in the colour palette."
+                             "".format(hexvalue))
+        symbol, symbol_colour = palette[hexvalue][:2]
+        rows, columns = np.nonzero(codes == code)
+        ax.add_collection(PathCollection(
+            [symbol_path(symbol)],
+            offsets=np.column_stack([columns, rows]),
+            offset_transform=ax.transData,
+            transform=symbol_transform,
+            facecolors=symbol_colour,
+            edgecolors="none"))
+
+    fig.tight_layout(pad=0)  # reduce space around image
+    return fig
+
+
+@functools.lru_cache(maxsize=None)
+def symbol_path(symbol):
+    """
+    Return the outline of a symbol as a `Path` centered at the origin.
+
+    Path coordinates are in points.
+    """
+    # pylint: disable=import-outside-toplevel
+    from matplotlib.path import Path
+    from matplotlib.textpath import TextPath
+
+    path = TextPath((0, 0), symbol, size=SYMBOL_SIZE)
+    extents = path.get_extents()
+    center = (extents.x0 + extents.x1) / 2, (extents.y0 + extents.y1) / 2
+    return Path(path.vertices - center, path.codes)
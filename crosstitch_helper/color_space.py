@@ -0,0 +1,123 @@
+"""
+Vectorized color space conversions and color differences.
+
+The conversions follow the ones used by colormath (sRGB with D65 illuminant
+converted to CIELab), so that the results match those of `FlossColor.labcolor`
+while handling whole arrays of colors at once.
+"""
+
+import numpy as np
+
+_RGB_TO_XYZ = np.array([[0.412424, 0.357579, 0.180464],
+                        [0.212656, 0.715158, 0.0721856],
+                        [0.0193324, 0.119193, 0.950444]])
+_D65_WHITE = np.array([0.95047, 1.0, 1.08883])
+_CIE_E = 216.0 / 24389.0
+
+
+def rgb_to_lab(rgb):
+    """
+    Return CIELab coordinates for an array of sRGB colors.
+
+    :rgb: array whose last axis holds the R, G and B values (0-255)
+    """
+    xyz = _linear_rgb(rgb) @ _RGB_TO_XYZ.T / _D65_WHITE
+    scaled = np.where(xyz > _CIE_E, np.cbrt(xyz), 7.787 * xyz + 16.0 / 116.0)
+    lab = np.empty_like(scaled)
+    lab[..., 0] = 116.0 * scaled[..., 1] - 16.0
+    lab[..., 1] = 500.0 * (scaled[..., 0] - scaled[..., 1])
+    lab[..., 2] = 200.0 * (scaled[..., 1] - scaled[..., 2])
+    return lab
+
+
+def relative_luminance(rgb):
+    """
+    Return the relative luminance (0-1) of an array of sRGB colors.
+
+    :rgb: array whose last axis holds the R, G and B values (0-255)
+    """
+    return _linear_rgb(rgb) @ _RGB_TO_XYZ[1]
+
+
+def _linear_rgb(rgb):
+    """
+    Return linear RGB values (0-1) for an array of sRGB colors (0-255).
+    """
+    rgb = np.asarray(rgb, dtype=np.float64) / 255.0
+    return np.where(rgb <= 0.04045, rgb / 12.92,
+                    np.power((rgb + 0.055) / 1.055, 2.4))
+
+
+def delta_e_cie1994(reference, samples, K_L=1, K_C=1, K_H=1, K_1=0.045,
+                    K_2=0.015):
+    """
+    Return the CIE 1994 color differences between two sets of Lab colors.
+
+    The result is a matrix with one row per reference color and one column
+    per sample color. CIE 1994 is not symmetric: the chroma weighting terms
+    are calculated from the reference colors.
+
+    :reference: array of shape (n, 3) containing L, a and b coordinates
+    :samples: array of shape (m, 3) containing L, a and b coordinates
+    """
+    # pylint: disable=invalid-name, too-many-arguments
+    return np.sqrt(_delta_e_cie1994_squared(
+        np.asarray(reference, dtype=np.float64),
+        np.asarray(samples, dtype=np.float64),
+        K_L=K_L, K_C=K_C, K_H=K_H, K_1=K_1, K_2=K_2))
+
+
+def _delta_e_cie1994_squared(reference, samples, K_L=1, K_C=1, K_H=1,
+                             K_1=0.045, K_2=0.015):
+    """
+    Return the squared CIE 1994 color differences of two sets of Lab colors.
+
+    See `delta_e_cie1994`.
+    """
+    # pylint: disable=invalid-name, too-many-arguments
+    C_1 = np.hypot(reference[:, 1], reference[:, 2])[:, np.newaxis]
+    C_2 = np.hypot(samples[:, 1], samples[:, 2])
+
+    delta_L_sq = np.square(reference[:, 0, np.newaxis] - samples[:, 0])
+    delta_ab_sq = (np.square(reference[:, 1, np.newaxis] - samples[:, 1])
+                   + np.square(reference[:, 2, np.newaxis] - samples[:, 2]))
+    delta_C_sq = np.square(C_1 - C_2)
+    delta_H_sq = np.clip(delta_ab_sq - delta_C_sq, 0, None)
+
+    S_C = 1 + K_1 * C_1
+    S_H = 1 + K_2 * C_1
+
+    return (delta_L_sq / K_L**2 + delta_C_sq / np.square(K_C * S_C)
+            + delta_H_sq / np.square(K_H * S_H))
+
+
+def nearest(reference, samples, chunk_size=1024, return_distances=False,
+            **metric_params):
+    """
+    Return the index of the nearest sample for each reference Lab color.
+
+    Distances are CIE 1994 color differences, calculated `chunk_size`
+    reference colors at a time to limit memory usage.
+
+    :reference: array of shape (n, 3) containing L, a and b coordinates
+    :samples: array of shape (m, 3) containing L, a and b coordinates
+    :return_distances: If True, a tuple `(indices, distances)` is returned,
+                       where `distances` holds the color difference to the
+                       nearest sample
+    :metric_params: parameters passed to `delta_e_cie1994`
+    """
+    reference = np.asarray(reference, dtype=np.float64).reshape(-1, 3)
+    samples = np.asarray(samples, dtype=np.float64)
+    indices = np.empty(len(reference), dtype=np.intp)
+    nearest_distances = np.empty(len(reference))
+    for start in range(0, len(reference), chunk_size):
+        chunk = reference[start:start + chunk_size]
+        distances = _delta_e_cie1994_squared(chunk, samples, **metric_params)
+        indices[start:start + chunk_size] = np.argmin(distances, axis=1)
+        if return_distances:
+            nearest_distances[start:start + chunk_size] = np.sqrt(
+                distances[np.arange(len(chunk)),
+                          indices[start:start + chunk_size]])
+    if return_distances:
+        return indices, nearest_distances
+    return indices
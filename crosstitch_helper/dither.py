@@ -0,0 +1,142 @@
+"""
+Dithering of images onto floss palettes.
+
+Each function returns an array of indices to the palette colors for every
+pixel of the image.
+"""
+
+import numpy as np
+
+METHODS = ("none", "ordered", "floyd-steinberg")
+
+
+def map_colors(rgb, palette, method="none", **kwargs):
+    """
+    Return the palette color indices of an image using the given dithering.
+
+    :rgb: image data of shape (height, width, 3)
+    :palette: `Palette` the image is mapped onto
+    :method: One of `METHODS`
+    :kwargs: Parameters for the dithering function
+    """
+    if method == "none":
+        return palette.best_match_many(rgb)
+    if method == "ordered":
+        return ordered_dither(rgb, palette, **kwargs)
+    if method == "floyd-steinberg":
+        return error_diffusion_dither(rgb, palette, **kwargs)
+    raise ValueError("Unknown dithering method {}".format(method))
+
+
+def bayer_matrix(size):
+    """
+    Return a Bayer threshold matrix with values evenly spread in [-0.5, 0.5).
+
+    :size: Side length of the matrix, a power of two
+    """
+    matrix = np.zeros((1, 1))
+    while matrix.shape[0] < size:
+        matrix = np.block([[4 * matrix, 4 * matrix + 2],
+                           [4 * matrix + 3, 4 * matrix + 1]])
+    return (matrix + 0.5) / matrix.size - 0.5
+
+
+def ordered_dither(rgb, palette, matrix_size=4, spread=32):
+    """
+    Return palette indices of an image using ordered (Bayer) dithering.
+
+    A tiled threshold matrix is added to the image before matching each pixel
+    to the palette, so the whole image is handled in one vectorized pass.
+
+    :rgb: image data of shape (height, width, 3)
+    :palette: `Palette` the image is mapped onto
+    :matrix_size: Side length of the Bayer matrix, a power of two
+    :spread: Amplitude of the threshold offsets in RGB units. Should be about
+             the distance between neighbouring palette colors.
+    """
+    rgb = np.asarray(rgb)
+    height, width = rgb.shape[:2]
+    matrix = bayer_matrix(matrix_size)
+    tiled = np.tile(matrix, (height // matrix_size + 1,
+                             width // matrix_size + 1))[:height, :width]
+    offset = rgb + spread * tiled[:, :, np.newaxis]
+    return palette.best_match_many(np.clip(np.rint(offset), 0, 255))
+
+
+def error_diffusion_dither(rgb, palette, match_bits=6):
+    """
+    Return palette indices of an image using Floyd-Steinberg dithering.
+
+    The matching error of each pixel is diffused to the next pixel on the
+    same row (7/16) and to three pixels on the next row (3/16, 5/16 and
+    1/16). A pixel only depends on the pixel before it and the three pixels
+    above it, so all pixels on an anti-diagonal wavefront where
+    `2 * row + column` is equal are matched at once. The result is the same as
+    with scanning the image pixel by pixel.
+
+    The matches are looked up from a table of colours rounded to
+    `match_bits` bits per channel, which is filled as colours are seen, so
+    that each rounded colour is matched only once. The error is calculated
+    from the unrounded colour, so rounding only affects which floss is chosen
+    for colours almost equally close to two flosses. If the palette has a
+    lookup table, it is used instead.
+
+    :rgb: image data of shape (height, width, 3)
+    :palette: `Palette` the image is mapped onto
+    :match_bits: Bits per channel of the colours in the match table
+    """
+    rgb = np.asarray(rgb)
+    height, width = rgb.shape[:2]
+    palette_rgb = palette.rgb.astype(np.float32)
+    match = _matcher(palette, match_bits)
+    # one extra column on both sides and an extra row below receive the
+    # error diffused outside the image
+    work = np.zeros((height + 1, width + 2, 3), dtype=np.float32)
+    work[:height, 1:-1] = rgb
+    work = work.reshape(-1, 3)
+    stride = width + 2
+    indices = np.empty(height * width, dtype=np.intp)
+    for step in range(width + 2 * (height - 1)):
+        rows = np.arange(max(0, (step - width + 2) // 2),
+                         min(height - 1, step // 2) + 1)
+        columns = step - 2 * rows
+        positions = rows * stride + columns + 1
+        target = np.clip(work[positions], 0, 255)
+        matches = match(target)
+        indices[rows * width + columns] = matches
+        error = target - palette_rgb[matches]
+        work[positions + 1] += error * (7 / 16)
+        work[positions + stride - 1] += error * (3 / 16)
+        work[positions + stride] += error * (5 / 16)
+        work[positions + stride + 1] += error * (1 / 16)
+    return indices.reshape(height, width)
+
+
+def _matcher(palette, bits):
+    """
+    Return a function returning the palette indices of an array of RGB
+    colours, using a match table of colours rounded to `bits` bits per
+    channel.
+    """
+    if palette.lookup_table is not None:
+        return palette.best_match_many
+    shift = 8 - bits
+    table = np.full(1 << (3 * bits), -1, dtype=np.intp)
+
+    def match(target):
+        binned = np.rint(target).astype(np.uint32) >> shift
+        keys = (binned[:, 0] << (2 * bits)) | (binned[:, 1] << bits) | \
+            binned[:, 2]
+        matches = table[keys]
+        missing = matches < 0
+        if missing.any():
+            new_keys = np.unique(keys[missing])
+            centres = np.stack([new_keys >> (2 * bits),
+                                (new_keys >> bits) & ((1 << bits) - 1),
+                                new_keys & ((1 << bits) - 1)], axis=1)
+            centres = np.minimum((centres << shift) + (1 << shift >> 1), 255)
+            table[new_keys] = palette.best_match_many(centres)
+            matches = table[keys]
+        return matches
+
+    return match
@@ -2,9 +2,13 @@
 Tools for working with pattern image
 """
 
-from imageio import imread
+import numpy as np
 
-from matplotlib.colors import to_hex
+from crosstitch_helper import stats
+from crosstitch_helper.caching import decoded_image
+
+DEFAULT_STRIP_HEIGHT = 256
+_MERGE_THRESHOLD = 1 << 20
 
 
 class ImageTool():
@@ -12,27 +16,297 @@ class ImageTool():
     A tool for handling image data.
     """
 
-    def __init__(self, path):
+    def __init__(self, path, lazy=False, strip_height=None):
         """
         Create a new instance.
 
         :path: the input image, where one pixel corresponds to one stitch
+        :lazy: If True, the decoded image is memory-mapped from an uncompressed
+               cache file instead of being held in memory, and only a strip of
+               rows at a time is read when processing the image.
+        :strip_height: Number of image rows processed at a time. By default,
+                       lazy images are processed in strips of
+                       `DEFAULT_STRIP_HEIGHT` rows and other images as a whole.
         """
         self.path = path
-        self._imagedata = imread(self.path, pilmode="RGB")
+        with stats.timer("read image"):
+            if lazy:
+                if strip_height is None:
+                    strip_height = DEFAULT_STRIP_HEIGHT
+                imagedata = decoded_image(self.path,
+                                          strip_height=strip_height)
+            else:
+                # pylint: disable=import-outside-toplevel
+                from imageio import imread
+                imagedata = imread(self.path, pilmode="RGB")
+        stats.count("pixels", imagedata.shape[0] * imagedata.shape[1])
+        self._set_imagedata(imagedata, strip_height)
+
+    @classmethod
+    def from_array(cls, imagedata, strip_height=None):
+        """
+        Return a new instance for RGB data that is already in memory.
+
+        :imagedata: array of shape (height, width, 3) with values 0-255
+        :strip_height: Number of image rows processed at a time. By default
+                       the image is processed as a whole.
+        """
+        tool = cls.__new__(cls)
+        tool.path = None
+        tool._set_imagedata(np.asarray(imagedata, dtype=np.uint8),
+                            strip_height)
+        return tool
+
+    def _set_imagedata(self, imagedata, strip_height):
+        """
+        Set the image data and reset everything calculated from it.
+        """
+        self._imagedata = imagedata
+        self.strip_height = strip_height
+        self._colour_codes = None
+        self._unique_colours = None
+        self._distinct_colours = None
+        self._hex_values = None
+        self._runs = None
 
     def colour_values(self):
         """
         Return image colour data.
+
+        For lazy images this is a read-only memory-mapped array.
         """
         return self._imagedata
 
+    def iterate_strips(self):
+        """
+        Iterate over horizontal strips of the image.
+
+        Yields tuples `(first_row, strip)` where `strip` contains the RGB data
+        of `strip_height` rows (fewer for the last strip) starting from row
+        `first_row`.
+        """
+        height = self._imagedata.shape[0]
+        strip_height = self.strip_height or max(height, 1)
+        for first_row in range(0, height, strip_height):
+            yield (first_row,
+                   self._imagedata[first_row:first_row + strip_height])
+
+    def colour_codes(self):
+        """
+        Return the colour of each pixel packed into a 24-bit integer.
+
+        The returned array has the same height and width as the image, and
+        each value is of form 0xRRGGBB.
+        """
+        if self._colour_codes is None:
+            self._colour_codes = pack_rgb(self._imagedata)
+        return self._colour_codes
+
+    def unique_colours(self):
+        """
+        Return the distinct colours of the image and their usage.
+
+        Returns a tuple `(codes, inverse, counts)` where `codes` contains the
+        packed colour codes of distinct colours in the order they first appear
+        in the image (row by row, from upper left to lower right), `inverse`
+        is an array of image shape holding the index in `codes` of each pixel
+        and `counts` the number of pixels having each colour.
+
+        This processes the whole image at once. Use `distinct_colours` when
+        the per-pixel indices are not needed.
+        """
+        if self._unique_colours is None:
+            self._unique_colours = unique_in_order(self.colour_codes())
+        return self._unique_colours
+
+    def distinct_colours(self):
+        """
+        Return the distinct colours of the image and their pixel counts.
+
+        Returns a tuple `(codes, counts)` where `codes` contains the packed
+        colour codes in the order they first appear in the image. The image is
+        processed one strip at a time.
+        """
+        if self._distinct_colours is None:
+            with stats.timer("count colours"):
+                self._distinct_colours = merge_colour_counts(
+                    count_in_order(pack_rgb(strip))
+                    for _, strip in self.iterate_strips())
+            stats.count("unique colours", len(self._distinct_colours[0]))
+        return self._distinct_colours
+
+    def runs(self):
+        """
+        Return the image encoded as runs of equal colour in each row.
+
+        The image is encoded one strip at a time. See `RunLengthImage`.
+        """
+        if self._runs is None:
+            # pylint: disable=import-outside-toplevel, cyclic-import
+            from crosstitch_helper.run_length import RunLengthImage
+            with stats.timer("run-length encoding"):
+                self._runs = RunLengthImage.from_strips(
+                    (strip for _, strip in self.iterate_strips()),
+                    self._imagedata.shape[1])
+            stats.count("runs", self._runs.run_count())
+        return self._runs
+
+    def remap_colours(self, mapping):
+        """
+        Replace colours of the image with other colours.
+
+        The image is processed one strip at a time. The result is held in
+        memory, also for lazy images, and everything calculated from the
+        image is reset.
+
+        :mapping: dict mapping hex value of a colour to the hex value of the
+                  colour replacing it
+        """
+        if not mapping:
+            return
+        sources = np.array([int(colour[1:], 16) for colour in mapping],
+                           dtype=np.uint32)
+        targets = np.array([int(colour[1:], 16)
+                            for colour in mapping.values()], dtype=np.uint32)
+        order = np.argsort(sources)
+        sources, targets = sources[order], targets[order]
+        remapped = np.empty(self._imagedata.shape, dtype=np.uint8)
+        with stats.timer("remap colours"):
+            for first_row, strip in self.iterate_strips():
+                codes = pack_rgb(strip)
+                indices = np.minimum(np.searchsorted(sources, codes),
+                                     len(sources) - 1)
+                matches = sources[indices] == codes
+                codes[matches] = targets[indices[matches]]
+                remapped[first_row:first_row + len(strip)] = unpack_rgb(codes)
+        self._set_imagedata(remapped, self.strip_height)
+
+    def hex_values(self):
+        """
+        Return the hex strings of the distinct colours in the image.
+
+        The list is in the same order as the codes from `distinct_colours`.
+        """
+        if self._hex_values is None:
+            codes, _ = self.distinct_colours()
+            with stats.timer("hex conversion"):
+                self._hex_values = [code_to_hex(code) for code in codes]
+        return self._hex_values
+
+    def colour_counts(self):
+        """
+        Return a dict mapping hex value of each colour to its pixel count.
+
+        The colours are in the order they first appear in the image.
+        """
+        _, counts = self.distinct_colours()
+        return dict(zip(self.hex_values(), counts.tolist()))
+
     def iterate_pixels(self):
         """
         Iterate over all pixels in the image, yielding hex value of each pixel.
 
         Covers the image row by row, from upper left to lower right.
+
+        Kept for backwards compatibility: `colour_counts` and `unique_colours`
+        are much faster for processing the whole image.
         """
         for i in range(self._imagedata.shape[0]):
             for j in range(self._imagedata.shape[1]):
-                yield to_hex(self._imagedata[i, j]/255.0)
+                yield code_to_hex(pack_rgb(self._imagedata[i, j]))
+
+
+def pack_rgb(rgb):
+    """
+    Return an array of 24-bit integer colour codes for RGB data.
+
+    :rgb: array whose last axis holds the R, G and B values (0-255)
+    """
+    rgb = np.asarray(rgb, dtype=np.uint32)
+    return (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+
+
+def unpack_rgb(codes):
+    """
+    Return an uint8 RGB array for an array of 24-bit integer colour codes.
+
+    :codes: array of colour codes of form 0xRRGGBB
+    """
+    codes = np.asarray(codes, dtype=np.uint32)
+    return np.stack([(codes >> 16) & 0xff, (codes >> 8) & 0xff, codes & 0xff],
+                    axis=-1).astype(np.uint8)
+
+
+def code_to_hex(code):
+    """
+    Return the hex string (e.g. "#5555ff") of a 24-bit colour code.
+    """
+    return "#{:06x}".format(int(code))
+
+
+def unique_in_order(codes):
+    """
+    Return unique values of an array in the order they first appear.
+
+    Returns a tuple `(values, inverse, counts)`. `inverse` has the shape of
+    `codes` and holds the index in `values` of each element.
+
+    :codes: array of colour codes
+    """
+    values, first_index, inverse, counts = np.unique(
+        codes, return_index=True, return_inverse=True, return_counts=True)
+    order = np.argsort(first_index, kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    inverse = rank[inverse.reshape(np.shape(codes))]
+    return values[order], inverse, counts[order]
+
+
+def count_in_order(codes):
+    """
+    Return unique values of an array and their counts in order of appearance.
+
+    Returns a tuple `(values, counts)`.
+
+    :codes: array of colour codes
+    """
+    values, first_index, counts = np.unique(codes, return_index=True,
+                                            return_counts=True)
+    order = np.argsort(first_index, kind="stable")
+    return values[order], counts[order]
+
+
+def merge_colour_counts(parts):
+    """
+    Combine colour counts of consecutive parts of an image.
+
+    Returns a tuple `(codes, counts)` with the distinct colours of all parts in
+    the order of their first appearance and the total count of each colour.
+
+    :parts: iterable of `(codes, counts)` tuples, where the codes of each part
+            are distinct and in the order of their first appearance within the
+            part
+    """
+    codes = [np.empty(0, dtype=np.uint32)]
+    counts = [np.empty(0, dtype=np.int64)]
+    pending = 0
+    for part_codes, part_counts in parts:
+        codes.append(np.asarray(part_codes, dtype=np.uint32))
+        counts.append(np.asarray(part_counts, dtype=np.int64))
+        pending += len(part_codes)
+        if pending > _MERGE_THRESHOLD:
+            merged_codes, merged_counts = _merge_parts(codes, counts)
+            codes, counts = [merged_codes], [merged_counts]
+            pending = 0
+    return _merge_parts(codes, counts)
+
+
+def _merge_parts(codes, counts):
+    """
+    Return combined `(codes, counts)` of lists of per-part codes and counts.
+    """
+    codes = np.concatenate(codes)
+    counts = np.concatenate(counts)
+    values, inverse, _ = unique_in_order(codes)
+    totals = np.bincount(inverse, weights=counts, minlength=len(values))
+    return values, totals.astype(np.int64)
@@ -0,0 +1,252 @@
+"""
+Incremental stitch counting for pattern images that are edited between runs.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from crosstitch_helper.imagetool import code_to_hex, pack_rgb
+
+STATE_VERSION = 1
+
+
+class IncrementalCounter():
+    """
+    Count the colours of a pattern, recounting only the tiles that changed.
+
+    The image is divided into tiles, by default of the same size as the pages
+    of a `ChartRenderer` chart. The state file holds a hash of the pixel data
+    of each tile along with the colour counts of the tile and of the whole
+    image. On later runs only the tiles whose hash differs are counted again,
+    and the totals are updated by the difference.
+
+    The counter provides `colour_counts`, so it can be passed to
+    `StitchCounter` in place of an `ImageTool`.
+    """
+
+    def __init__(self, image_tool, state_path, tile_width=50, tile_height=80,
+                 palette=None):
+        """
+        Create a new counter.
+
+        :image_tool: `ImageTool` for the pattern image
+        :state_path: Location of the state file. It is created if it does not
+                     exist.
+        :tile_width: width of one tile in stitches
+        :tile_height: height of one tile in stitches
+        :palette: Optional colour palette. All tiles are reported as changed
+                  if the palette differs from the one used for the state.
+        """
+        # pylint: disable=too-many-arguments
+        self._image_tool = image_tool
+        self._state_path = state_path
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self._palette_digest = _palette_digest(palette)
+        self.changed_tiles = None
+        self.tile_count = 0
+        self._totals = None
+        self._state = None
+
+    def update(self, image_tool=None):
+        """
+        Bring the counts up to date with the image and save the state.
+
+        The tiles that had to be recounted are stored in `changed_tiles` as a
+        list of `(min_x, min_y, max_x, max_y)` bounds, the same as chart page
+        bounds. If the state file is missing or was made for a differently
+        shaped image or tiling, every tile is counted. After the first update
+        the state is kept in memory and the file is only written.
+
+        :image_tool: Optional new version of the image. Defaults to the image
+                     given when creating the counter.
+        """
+        if image_tool is not None:
+            self._image_tool = image_tool
+        imagedata = self._image_tool.colour_values()
+        state = self._read_state(imagedata.shape[:2])
+        old_tiles = state["tiles"]
+        totals = {hexvalue: list(entry)
+                  for hexvalue, entry in state["totals"].items()}
+        tiles = {}
+        changed = []
+        touched = set()
+        for bounds, tile in self._iterate_tiles(imagedata):
+            key = "{},{}".format(bounds[0], bounds[1])
+            digest = hashlib.blake2b(np.ascontiguousarray(tile).data,
+                                     digest_size=16).hexdigest()
+            old = old_tiles.get(key)
+            if old is not None and old["hash"] == digest:
+                tiles[key] = old
+                continue
+            changed.append(bounds)
+            tiles[key] = {"hash": digest,
+                          "colours": _tile_colours(tile, bounds,
+                                                   imagedata.shape[1])}
+            for entries, sign in ((old["colours"] if old else {}, -1),
+                                  (tiles[key]["colours"], 1)):
+                for hexvalue, (count, _) in entries.items():
+                    totals.setdefault(hexvalue, [0, 0])[0] += sign * count
+                    touched.add(hexvalue)
+        _update_first_indices(totals, touched, tiles)
+        self._totals = totals
+        self.tile_count = len(tiles)
+        if state.get("palette") != self._palette_digest:
+            changed = list(self._iterate_bounds(imagedata.shape[:2]))
+        self.changed_tiles = changed
+        self._state = {"version": STATE_VERSION,
+                       "shape": list(imagedata.shape[:2]),
+                       "tile_size": [self.tile_width, self.tile_height],
+                       "palette": self._palette_digest,
+                       "totals": totals,
+                       "tiles": tiles,
+                       "remapping": state.get("remapping", {})}
+        self._write_state(self._state)
+
+    def remap_colours(self, mapping):
+        """
+        Merge the counts of colours replaced with `ImageTool.remap_colours`.
+
+        The saved state keeps the tiles of the image as it was read, so that
+        the replaced tiles are not counted again on the next run. Tiles with
+        colours replaced differently than on the last run are added to
+        `changed_tiles`. The counts are updated first if `update` has not
+        been called.
+
+        :mapping: dict mapping hex value of a colour to the hex value of the
+                  colour replacing it
+        """
+        if self._totals is None:
+            self.update()
+        previous = self._state["remapping"]
+        altered = {colour for colour in set(mapping) | set(previous)
+                   if mapping.get(colour) != previous.get(colour)}
+        if altered:
+            for bounds in self._iterate_bounds(self._state["shape"]):
+                key = "{},{}".format(bounds[0], bounds[1])
+                if bounds not in self.changed_tiles and \
+                        altered.intersection(
+                            self._state["tiles"][key]["colours"]):
+                    self.changed_tiles.append(bounds)
+            self._state["remapping"] = dict(mapping)
+            self._write_state(self._state)
+        totals = {hexvalue: list(entry)
+                  for hexvalue, entry in self._totals.items()}
+        for source, target in mapping.items():
+            if source not in totals:
+                continue
+            count, first = totals.pop(source)
+            entry = totals.setdefault(target, [0, first])
+            entry[0] += count
+            entry[1] = min(entry[1], first)
+        self._totals = totals
+
+    def colour_counts(self):
+        """
+        Return a dict mapping hex value of each colour to its pixel count.
+
+        The colours are in the order they first appear in the image, as with
+        `ImageTool.colour_counts`. The counts are updated first if `update`
+        has not been called.
+        """
+        if self._totals is None:
+            self.update()
+        order = sorted(self._totals.items(), key=lambda item: item[1][1])
+        return {hexvalue: count for hexvalue, (count, _) in order}
+
+    def _iterate_bounds(self, shape):
+        """
+        Yield the bounds of each tile, column by column like chart pages.
+        """
+        height, width = shape
+        for min_x in range(0, width, self.tile_width):
+            for min_y in range(0, height, self.tile_height):
+                yield (min_x, min_y, min(min_x + self.tile_width, width),
+                       min(min_y + self.tile_height, height))
+
+    def _iterate_tiles(self, imagedata):
+        """
+        Yield `(bounds, tile)` for each tile, reading one row of tiles at a
+        time so that memory-mapped images are read sequentially.
+        """
+        height, width = imagedata.shape[:2]
+        for min_y in range(0, height, self.tile_height):
+            max_y = min(min_y + self.tile_height, height)
+            rows = np.asarray(imagedata[min_y:max_y])
+            for min_x in range(0, width, self.tile_width):
+                max_x = min(min_x + self.tile_width, width)
+                yield (min_x, min_y, max_x, max_y), rows[:, min_x:max_x]
+
+    def _read_state(self, shape):
+        """
+        Return the saved state, or an empty state if it cannot be used.
+        """
+        empty = {"palette": self._palette_digest, "totals": {}, "tiles": {}}
+        state = self._state
+        if state is None:
+            try:
+                with open(self._state_path) as infile:
+                    state = json.load(infile)
+            except (OSError, ValueError):
+                return empty
+        if state.get("version") != STATE_VERSION or \
+                state.get("shape") != list(shape) or \
+                state.get("tile_size") != [self.tile_width, self.tile_height]:
+            return empty
+        return state
+
+    def _write_state(self, state):
+        """
+        Save the state, replacing the old file only once it is complete.
+        """
+        temporary_path = "{}.{}.tmp".format(self._state_path, os.getpid())
+        with open(temporary_path, "w") as outfile:
+            json.dump(state, outfile)
+        os.replace(temporary_path, self._state_path)
+
+
+def _tile_colours(tile, bounds, image_width):
+    """
+    Return the colours of a tile as a dict mapping hex value to a list of the
+    pixel count and the index of the first pixel in the whole image.
+    """
+    codes, first_index, counts = np.unique(pack_rgb(tile), return_index=True,
+                                           return_counts=True)
+    tile_width = bounds[2] - bounds[0]
+    rows, columns = np.divmod(first_index, tile_width)
+    first_index = (bounds[1] + rows) * image_width + bounds[0] + columns
+    return {code_to_hex(code): [count, first]
+            for code, count, first in zip(codes.tolist(), counts.tolist(),
+                                          first_index.tolist())}
+
+
+def _update_first_indices(totals, touched, tiles):
+    """
+    Drop colours no longer in the image and find the first appearance of the
+    touched colours again.
+    """
+    for hexvalue in touched:
+        if totals[hexvalue][0] == 0:
+            del totals[hexvalue]
+    touched = {hexvalue for hexvalue in touched if hexvalue in totals}
+    first = {}
+    if touched:
+        for tile in tiles.values():
+            for hexvalue in touched.intersection(tile["colours"]):
+                index = tile["colours"][hexvalue][1]
+                first[hexvalue] = min(first.get(hexvalue, index), index)
+    for hexvalue, index in first.items():
+        totals[hexvalue][1] = index
+
+
+def _palette_digest(palette):
+    """
+    Return a hash of a chart palette dict, or None if there is no palette.
+    """
+    if palette is None:
+        return None
+    return hashlib.sha1(json.dumps(sorted(palette.items()),
+                                   ensure_ascii=False).encode()).hexdigest()
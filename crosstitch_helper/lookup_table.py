@@ -0,0 +1,160 @@
+"""
+Precomputed lookup tables from every 24-bit RGB color to the best floss.
+
+A table contains one uint16 floss index per color code (0xRRGGBB), i.e. 32 MB
+for the whole RGB cube. The table is stored as a `.npy` file so that it can be
+memory-mapped without copying, accompanied by a small JSON file holding the
+fingerprint of the palette it was built for. A table can also be embedded in
+a binary palette file (see `Palette.save`).
+"""
+
+import json
+import multiprocessing
+import struct
+import zipfile
+
+import numpy as np
+
+from crosstitch_helper import color_space
+from crosstitch_helper.imagetool import unpack_rgb
+
+TABLE_SIZE = 1 << 24
+_BLOCK_SIZE = 1 << 16
+_ZIP_LOCAL_HEADER_SIZE = 30
+
+_worker_lab_matrix = None
+_worker_metric_params = None
+
+
+def metadata_path(path):
+    """
+    Return the location of the metadata file of a lookup table.
+    """
+    return path + ".json"
+
+
+def build_lookup_table(palette, path, workers=None, progress=None):
+    """
+    Calculate the best matching floss for every RGB color and save the table.
+
+    The RGB cube is processed in blocks of 65536 colors (one value of red per
+    block) on a pool of worker processes.
+
+    :palette: `Palette` for which the table is built
+    :path: Location of the output `.npy` file
+    :workers: Number of worker processes. Defaults to the number of CPUs.
+    :progress: Optional callable that is called with the number of finished
+               blocks and the total number of blocks after each block.
+    """
+    if len(palette) > np.iinfo(np.uint16).max:
+        raise ValueError("Palette has too many colors for a lookup table")
+    table = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint16,
+                                      shape=(TABLE_SIZE,))
+    n_blocks = TABLE_SIZE // _BLOCK_SIZE
+    with multiprocessing.Pool(workers, initializer=_init_worker,
+                              initargs=(palette.lab_matrix(),
+                                        palette.metric_params)) as pool:
+        blocks = pool.imap_unordered(_match_block, range(n_blocks))
+        for done, (block, indices) in enumerate(blocks, start=1):
+            table[block * _BLOCK_SIZE:(block + 1) * _BLOCK_SIZE] = indices
+            if progress:
+                progress(done, n_blocks)
+    table.flush()
+    del table
+    with open(metadata_path(path), "w") as outfile:
+        json.dump({"fingerprint": palette.fingerprint(),
+                   "palette_size": len(palette)}, outfile, indent=4)
+
+
+def load_lookup_table(palette, path):
+    """
+    Return a read-only memory-mapped lookup table.
+
+    :palette: `Palette` the table is used with
+    :path: Location of the `.npy` file saved by `build_lookup_table`
+    :raises ValueError: if the table has not been built for the palette
+    """
+    with open(metadata_path(path)) as infile:
+        metadata = json.load(infile)
+    if metadata["fingerprint"] != palette.fingerprint():
+        raise ValueError("Lookup table {} was built for a different palette"
+                         "".format(path))
+    table = np.load(path, mmap_mode="r")
+    if table.shape != (TABLE_SIZE,) or table.dtype != np.uint16:
+        raise ValueError("{} is not a valid lookup table".format(path))
+    return table
+
+
+def load_embedded_lookup_table(path, name="lookup_table"):
+    """
+    Return a read-only memory-mapped lookup table stored in an npz archive.
+
+    The table must be stored uncompressed, as `Palette.save` does.
+
+    :path: Location of the npz file
+    :name: Name of the table in the archive
+    :raises ValueError: if the table is compressed or not a valid table
+    """
+    with zipfile.ZipFile(path) as archive:
+        info = archive.getinfo(name + ".npy")
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError("Lookup table in {} is compressed".format(path))
+    with open(path, "rb") as infile:
+        # the data follows the local file header, whose name and extra field
+        # lengths may differ from those in the central directory
+        infile.seek(info.header_offset)
+        header = infile.read(_ZIP_LOCAL_HEADER_SIZE)
+        name_length, extra_length = struct.unpack("<HH", header[26:30])
+        infile.seek(info.header_offset + _ZIP_LOCAL_HEADER_SIZE +
+                    name_length + extra_length)
+        if np.lib.format.read_magic(infile) == (1, 0):
+            header = np.lib.format.read_array_header_1_0(infile)
+        else:
+            header = np.lib.format.read_array_header_2_0(infile)
+        shape, fortran_order, dtype = header
+        offset = infile.tell()
+    if shape != (TABLE_SIZE,) or dtype != np.uint16 or fortran_order:
+        raise ValueError("{} does not contain a valid lookup table"
+                         "".format(path))
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape)
+
+
+def verify_lookup_table(palette, table, samples=100000, seed=None):
+    """
+    Compare a random sample of table entries against direct color matching.
+
+    Returns the color codes for which the table and the palette disagree.
+
+    :palette: `Palette` the table was built for
+    :table: lookup table array
+    :samples: Number of color codes to check
+    :seed: Seed for selecting the checked colors
+    """
+    rng = np.random.default_rng(seed)
+    codes = np.unique(rng.integers(0, TABLE_SIZE, size=samples,
+                                   dtype=np.uint32))
+    expected = color_space.nearest(color_space.rgb_to_lab(unpack_rgb(codes)),
+                                   palette.lab_matrix(),
+                                   **palette.metric_params)
+    return codes[table[codes] != expected]
+
+
+def _init_worker(lab_matrix, metric_params):
+    """
+    Store the palette data in a worker process.
+    """
+    # pylint: disable=global-statement
+    global _worker_lab_matrix, _worker_metric_params
+    _worker_lab_matrix = lab_matrix
+    _worker_metric_params = metric_params
+
+
+def _match_block(block):
+    """
+    Return the block number and floss indices for one block of color codes.
+    """
+    codes = np.arange(block * _BLOCK_SIZE, (block + 1) * _BLOCK_SIZE,
+                      dtype=np.uint32)
+    indices = color_space.nearest(color_space.rgb_to_lab(unpack_rgb(codes)),
+                                  _worker_lab_matrix, **_worker_metric_params)
+    return block, indices.astype(np.uint16)
@@ -0,0 +1,118 @@
+"""
+Persistent cache for color to floss matches.
+"""
+
+import os
+import sqlite3
+
+import numpy as np
+
+from crosstitch_helper.caching import default_cache_dir
+
+
+class MatchCache():
+    """
+    SQLite backed store of the best matching floss for RGB colors.
+
+    Matches are stored per palette fingerprint, so that a cache file can be
+    shared by different palettes, and so that changes in the palette contents
+    or in the color difference parameters automatically invalidate the old
+    matches.
+    """
+
+    _BATCH_SIZE = 50000
+
+    def __init__(self, path=None):
+        """
+        Open (or create) a match cache.
+
+        :path: Location of the cache database. Defaults to `matches.sqlite`
+               in the directory given by `default_cache_dir`.
+        """
+        if path is None:
+            path = os.path.join(default_cache_dir(), "matches.sqlite")
+        self.path = path
+        self._connection = sqlite3.connect(path, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS matches ("
+            "fingerprint TEXT NOT NULL, "
+            "code INTEGER NOT NULL, "
+            "floss INTEGER NOT NULL, "
+            "PRIMARY KEY (fingerprint, code)) WITHOUT ROWID")
+        self._connection.execute(
+            "CREATE TEMP TABLE query (code INTEGER PRIMARY KEY)")
+        self._connection.commit()
+
+    def lookup(self, fingerprint, codes):
+        """
+        Return the cached floss indices of the given colors.
+
+        Returns an array of the same length as `codes`, containing -1 for the
+        colors not found in the cache.
+
+        :fingerprint: fingerprint of the palette, see `Palette.fingerprint`
+        :codes: 1D array of distinct 24-bit color codes
+        """
+        codes = np.asarray(codes)
+        indices = np.full(len(codes), -1, dtype=np.intp)
+        if not len(codes):
+            return indices
+        found = {}
+        with self._connection:
+            for start in range(0, len(codes), self._BATCH_SIZE):
+                batch = codes[start:start + self._BATCH_SIZE]
+                self._connection.executemany(
+                    "INSERT OR IGNORE INTO query VALUES (?)",
+                    ((int(code),) for code in batch))
+                found.update(self._connection.execute(
+                    "SELECT matches.code, matches.floss FROM query "
+                    "JOIN matches ON matches.code = query.code "
+                    "WHERE matches.fingerprint = ?", (fingerprint,)))
+                self._connection.execute("DELETE FROM query")
+        if found:
+            found_codes = np.fromiter(found.keys(), dtype=codes.dtype,
+                                      count=len(found))
+            found_indices = np.fromiter(found.values(), dtype=np.intp,
+                                        count=len(found))
+            order = np.argsort(found_codes)
+            positions = np.searchsorted(found_codes[order], codes)
+            positions = np.minimum(positions, len(found_codes) - 1)
+            hits = found_codes[order][positions] == codes
+            indices[hits] = found_indices[order][positions[hits]]
+        return indices
+
+    def store(self, fingerprint, codes, indices):
+        """
+        Save floss matches of colors to the cache.
+
+        :fingerprint: fingerprint of the palette, see `Palette.fingerprint`
+        :codes: 1D array of 24-bit color codes
+        :indices: index of the best matching floss for each color
+        """
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO matches VALUES (?, ?, ?)",
+                ((fingerprint, int(code), int(index))
+                 for code, index in zip(codes, indices)))
+
+    def clear(self, fingerprint=None):
+        """
+        Remove cached matches.
+
+        :fingerprint: Only remove the matches of this palette fingerprint. If
+                      not given, the whole cache is cleared.
+        """
+        with self._connection:
+            if fingerprint is None:
+                self._connection.execute("DELETE FROM matches")
+            else:
+                self._connection.execute(
+                    "DELETE FROM matches WHERE fingerprint = ?",
+                    (fingerprint,))
+
+    def close(self):
+        """
+        Close the underlying database connection.
+        """
+        self._connection.close()
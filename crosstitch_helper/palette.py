@@ -2,12 +2,19 @@
 Class for depicting floss palettes.
 """
 
+import hashlib
 import json
 
-from colormath.color_objects import LabColor, sRGBColor
-from colormath import color_conversions, color_diff
 import numpy as np
-from sklearn.neighbors import NearestNeighbors
+
+from crosstitch_helper import color_space, lookup_table, stats
+from crosstitch_helper.imagetool import pack_rgb, unpack_rgb
+
+FORMATS = ("json", "npz")
+_NPZ_MAGIC = b"PK\x03\x04"
+_NPZ_VERSION = 1
+_STRING_FIELDS = ("hex_codes", "symbols", "symbol_colors", "color_numbers",
+                  "color_names")
 
 
 class Palette():
@@ -15,45 +22,286 @@ class Palette():
     Floss palette
     """
 
-    _neighbor_graph = None
-    _palette_size_at_update = -1
+    metric_params = {"K_L": 2, "K_1": 0.048, "K_2": 0.014}
 
-    def __init__(self, colors=None):
+    def __init__(self, colors=None, match_cache=None):
         """
         Create a new palette
 
+        The colors are stored as arrays, one entry per floss: `hex_codes`,
+        `rgb` (uint8 RGB values), `lab` (CIELab coordinates), `symbols`,
+        `symbol_colors`, `color_numbers` and `color_names`.
+
         :colors: Optional list of `FlossColor`s to include in the palette
+        :match_cache: Optional `MatchCache` for storing the results of color
+                      matching persistently
         """
-        if not colors:
-            self.colors = []
-        else:
-            self.colors = colors
+        self.match_cache = match_cache
+        self.lookup_table = None
+        self.hex_codes = None
+        self.symbols = None
+        self.symbol_colors = None
+        self.color_numbers = None
+        self.color_names = None
+        self.rgb = None
+        self.lab = None
+        self._fingerprint = None
+        self.colors = colors or []
 
     @classmethod
-    def load(cls, file_path):
+    def from_fields(cls, hex_codes, symbols, symbol_colors, color_numbers,
+                    color_names, match_cache=None):
+        """
+        Return a palette created from per-floss sequences of field values.
+
+        All sequences must have the same length. See `FlossColor` for the
+        meaning of the fields.
+        """
+        # pylint: disable=too-many-arguments
+        palette = cls(match_cache=match_cache)
+        palette._set_fields(hex_codes, symbols, symbol_colors, color_numbers,
+                            color_names)
+        return palette
+
+    def _set_fields(self, hex_codes, symbols, symbol_colors, color_numbers,
+                    color_names):
         """
-        Return a palette read from a JSON file saved using the `save` method.
+        Store the floss data and calculate the RGB and Lab arrays.
         """
+        # pylint: disable=too-many-arguments
+        codes = np.array([int(code.lstrip("#"), 16) for code in hex_codes],
+                         dtype=np.uint32)
+        rgb = unpack_rgb(codes).reshape(-1, 3)
+        self._set_arrays(_string_array(hex_codes), _string_array(symbols),
+                         _string_array(symbol_colors),
+                         _string_array(color_numbers),
+                         _string_array(color_names),
+                         rgb, color_space.rgb_to_lab(rgb))
+
+    def _set_arrays(self, hex_codes, symbols, symbol_colors, color_numbers,
+                    color_names, rgb, lab):
+        """
+        Store the floss data arrays as they are.
+        """
+        # pylint: disable=too-many-arguments
+        self.hex_codes = hex_codes
+        self.symbols = symbols
+        self.symbol_colors = symbol_colors
+        self.color_numbers = color_numbers
+        self.color_names = color_names
+        self.rgb = rgb
+        self.lab = lab
+        self._fingerprint = None
+
+    @classmethod
+    def load(cls, file_path, match_cache=None):
+        """
+        Return a palette read from a file saved using the `save` method.
+
+        The format of the file (JSON or npz) is detected from its contents.
+        A lookup table embedded in an npz file is memory-mapped and used for
+        color matching.
+
+        :file_path: Location of the palette file
+        :match_cache: Optional `MatchCache` for storing the results of color
+                      matching persistently
+        """
+        with open(file_path, "rb") as infile:
+            is_npz = infile.read(len(_NPZ_MAGIC)) == _NPZ_MAGIC
+        if is_npz:
+            return cls._load_npz(file_path, match_cache)
         with open(file_path) as jsonfile:
             color_list = json.load(jsonfile)
-        colors = []
-        for color in color_list:
-            colors.append(FlossColor(**color))
-        return cls(colors)
+        defaults = FlossColor.DEFAULTS
+        fields = [[color.get(field, defaults.get(field))
+                   for color in color_list]
+                  for field in FlossColor.FIELDS]
+        return cls.from_fields(*fields, match_cache=match_cache)
+
+    @classmethod
+    def _load_npz(cls, file_path, match_cache):
+        """
+        Return a palette read from a binary file written by `_save_npz`.
+        """
+        with np.load(file_path) as data:
+            if "version" not in data.files or \
+                    int(data["version"]) != _NPZ_VERSION:
+                raise ValueError("{} is not a supported palette file"
+                                 "".format(file_path))
+            palette = cls(match_cache=match_cache)
+            palette._set_arrays(*[data[name] for name in _STRING_FIELDS],
+                                data["rgb"], data["lab"])
+            has_table = "lookup_table" in data.files
+            fingerprint = str(data["fingerprint"])
+        # a table matched with other color difference parameters is ignored
+        if has_table and fingerprint == palette.fingerprint():
+            palette.lookup_table = lookup_table.load_embedded_lookup_table(
+                file_path)
+        return palette
+
+    def __len__(self):
+        """
+        Return the number of flosses in the palette.
+        """
+        return len(self.hex_codes)
+
+    def __getitem__(self, index):
+        """
+        Return a `FlossColor` view of the floss at the given index.
+        """
+        if not -len(self) <= index < len(self):
+            raise IndexError("palette index out of range")
+        return FlossColor.view(self, index % len(self))
 
-    def save(self, file_path, indent=4):
+    @property
+    def colors(self):
+        """
+        Return a tuple of `FlossColor` views of all the flosses.
+
+        Use `append` or `extend` for adding flosses, or assign a new list of
+        `FlossColor`s for replacing them.
+        """
+        return tuple(FlossColor.view(self, i) for i in range(len(self)))
+
+    @colors.setter
+    def colors(self, colors):
+        """
+        Replace the flosses of the palette with a list of `FlossColor`s.
+        """
+        colors = list(colors)
+        self._set_fields(*[[getattr(color, field) for color in colors]
+                           for field in FlossColor.FIELDS])
+        self.lookup_table = None
+
+    def append(self, color):
+        """
+        Add a floss to the end of the palette.
+
+        :color: `FlossColor` of the floss
+        """
+        self.extend([color])
+
+    def extend(self, colors):
+        """
+        Add flosses to the end of the palette.
+
+        A lookup table in use is dropped, as it does not cover the new
+        flosses.
+
+        :colors: iterable of `FlossColor`s
         """
-        Save the palette to a JSON file.
+        colors = list(colors)
+        fields = [np.concatenate([getattr(self, name), _string_array(
+            getattr(color, field) for color in colors)])
+                  for name, field in zip(_STRING_FIELDS, FlossColor.FIELDS)]
+        rgb = np.array([color.rgb_values() for color in colors],
+                       dtype=np.uint8).reshape(-1, 3)
+        lab = np.array([np.asarray(color) for color in colors],
+                       dtype=self.lab.dtype).reshape(-1, 3)
+        self._set_arrays(*fields, np.concatenate([self.rgb, rgb]),
+                         np.concatenate([self.lab, lab]))
+        self.lookup_table = None
 
-        Colors are saved in a list, each color represented as a dictionary.
+    def subset(self, indices):
+        """
+        Return a new palette containing the flosses at the given indices.
+
+        :indices: sequence of indices of the flosses, in the desired order
+        """
+        indices = np.asarray(indices, dtype=np.intp)
+        return self.from_fields(self.hex_codes[indices].tolist(),
+                                self.symbols[indices].tolist(),
+                                self.symbol_colors[indices].tolist(),
+                                self.color_numbers[indices].tolist(),
+                                self.color_names[indices].tolist(),
+                                match_cache=self.match_cache)
+
+    def use_lookup_table(self, file_path):
+        """
+        Use a precomputed lookup table for color matching.
+
+        The table is memory-mapped, so only the parts of it needed for
+        matching are read from the disk.
+
+        :file_path: Location of a table built for this palette using
+                    `lookup_table.build_lookup_table`
+        """
+        self.lookup_table = lookup_table.load_lookup_table(self, file_path)
+
+    def fingerprint(self):
+        """
+        Return a hash identifying the colors and color matching of the palette.
+
+        Two palettes have the same fingerprint if they contain the same colors
+        in the same order and use the same color difference parameters, i.e.
+        they give the same results from `best_match_many`.
+        """
+        if self._fingerprint is None:
+            content = {"colors": np.char.lower(self.hex_codes).tolist(),
+                       "metric": "cie1994",
+                       "metric_params": self.metric_params}
+            self._fingerprint = hashlib.sha1(
+                json.dumps(content, sort_keys=True).encode()).hexdigest()
+        return self._fingerprint
+
+    def save(self, file_path, indent=4, format="json",
+             include_lookup_table=False):
+        """
+        Save the palette to a file.
+
+        In JSON format, colors are saved in a list, each color represented as
+        a dictionary. The npz format is a numpy archive containing the color
+        data as arrays, including the precomputed RGB and Lab values, and
+        optionally the lookup table of the palette.
 
         :file_path: Location of the output file
-        :indent: Indentation depth in the output file. Defaults to 4.
+        :indent: Indentation depth in the JSON output file. Defaults to 4.
+        :format: One of `FORMATS`
+        :include_lookup_table: Embed the lookup table in use (see
+                               `use_lookup_table`) in an npz file
         """
-        dicts = [c.to_dict() for c in self.colors]
+        # pylint: disable=redefined-builtin
+        if format == "npz":
+            self._save_npz(file_path, include_lookup_table)
+            return
+        if format != "json":
+            raise ValueError("Unknown palette format {}".format(format))
+        fields = [getattr(self, name).tolist() for name in _STRING_FIELDS]
+        dicts = [dict(zip(FlossColor.FIELDS, values))
+                 for values in zip(*fields)]
         with open(file_path, "w") as outfile:
             outfile.write(json.dumps(dicts, indent=indent))
 
+    def _save_npz(self, file_path, include_lookup_table):
+        """
+        Save the palette to an uncompressed numpy archive.
+
+        The archive is not compressed so that an embedded lookup table can be
+        memory-mapped directly from the file.
+        """
+        arrays = {name: getattr(self, name) for name in _STRING_FIELDS}
+        arrays.update(version=np.array(_NPZ_VERSION), rgb=self.rgb,
+                      lab=self.lab, fingerprint=np.array(self.fingerprint()))
+        if include_lookup_table:
+            if self.lookup_table is None:
+                raise ValueError("The palette has no lookup table to include")
+            arrays["lookup_table"] = np.asarray(self.lookup_table)
+        with open(file_path, "wb") as outfile:
+            np.savez(outfile, **arrays)
+
+    def to_chart_palette(self):
+        """
+        Return the palette as a dict used for counting stitches and charts.
+
+        The dict has the lower case hex value of each color as key and a
+        (symbol, symbol_color) tuple as value, like the palettes in
+        conf/palettes.py.
+        """
+        return {hexvalue.lower(): (symbol, symbol_color)
+                for hexvalue, symbol, symbol_color in zip(
+                    self.hex_codes.tolist(), self.symbols.tolist(),
+                    self.symbol_colors.tolist())}
+
     def best_match(self, color):
         """
         Return the best matching floss color in the palette to the given color.
@@ -61,43 +309,96 @@ class Palette():
         :color: an array containing the RGB values (in range 0-255) of the
                 color.
         """
-        if self._palette_size_at_update != len(self.colors):
-            self._update_neighbor_graph()
-        rgbcolor = sRGBColor(*color, is_upscaled=True)
-        labcolor = color_conversions.convert_color(rgbcolor, LabColor)
-        _, indices = self._neighbor_graph.kneighbors(
-                np.array([np.array(labcolor.get_value_tuple())]))
-        return self.colors[indices[0][0]]
+        index = self.best_match_many(np.array([color]))[0]
+        return self[index]
 
-    def _update_neighbor_graph(self):
+    def best_match_many(self, rgb_array):
         """
-        Recalculate the nearest neighbors tree.
+        Return the indices of the best matching floss colors for many colors.
+
+        The colors are compared in CIELab space using CIE 1994 color
+        difference with the parameters in `metric_params`. Each distinct color
+        is matched only once. If a lookup table is in use, the matches are
+        read directly from the table instead.
+
+        :rgb_array: an array whose last axis contains the RGB values (in range
+                    0-255) of the colors, e.g. image data of shape
+                    (height, width, 3)
+        :returns: an array of indices to the palette, having the shape of
+                  `rgb_array` without the last axis
         """
-        def _cielab_color_distance(colorarray1, colorarray2):
-            """
-            Return the CIE 1994 color difference of the two given colors.
+        with stats.timer("match colours"):
+            codes = pack_rgb(rgb_array)
+            if self.lookup_table is not None:
+                stats.count("lookup table matches", codes.size)
+                return self.lookup_table[codes].astype(np.intp)
+            unique_codes, inverse = np.unique(codes, return_inverse=True)
+            matches = self._match_codes(unique_codes)
+            return matches[inverse].reshape(codes.shape)
 
-            The colors are provided as Numpy arrays containing the L, a and b
-            coordinates of the color.
-            """
-            labcolor1 = LabColor(*colorarray1)
-            labcolor2 = LabColor(*colorarray2)
-            return color_diff.delta_e_cie1994(labcolor1, labcolor2,
-                                              K_L=2, K_1=0.048, K_2=0.014)
+    def _match_codes(self, codes):
+        """
+        Return the indices of the best matching floss colors for color codes.
 
-        data = np.array([np.array(c) for c in self.colors])
-        self._neighbor_graph = NearestNeighbors(n_neighbors=1,
-                                                algorithm="ball_tree",
-                                                metric=_cielab_color_distance
-                                                ).fit(data)
-        self._palette_size_at_update = len(self.colors)
+        Results are read from and saved to the match cache, if the palette has
+        one.
+
+        :codes: 1D array of distinct 24-bit color codes
+        """
+        if self.match_cache is None:
+            stats.count("colours matched", len(codes))
+            return self._calculate_matches(codes)
+        fingerprint = self.fingerprint()
+        indices = self.match_cache.lookup(fingerprint, codes)
+        misses = indices < 0
+        stats.count("match cache hits", len(codes) - misses.sum())
+        stats.count("match cache misses", misses.sum())
+        stats.count("colours matched", misses.sum())
+        if misses.any():
+            indices[misses] = self._calculate_matches(codes[misses])
+            self.match_cache.store(fingerprint, codes[misses], indices[misses])
+        return indices
+
+    def _calculate_matches(self, codes):
+        """
+        Return the indices of the best matching floss colors for color codes.
+
+        :codes: 1D array of distinct 24-bit color codes
+        """
+        return color_space.nearest(color_space.rgb_to_lab(unpack_rgb(codes)),
+                                   self.lab_matrix(), **self.metric_params)
+
+    def lab_matrix(self):
+        """
+        Return an array containing the CIELab coordinates of the flosses.
+
+        The array has one row of L, a and b values for each floss. This is the
+        same as `self.lab`.
+        """
+        return self.lab
+
+
+def _string_array(values):
+    """
+    Return a numpy unicode array of the given strings.
+    """
+    return np.array(list(values), dtype=str).reshape(-1)
 
 
 class FlossColor():
     """
     Representation of a specific floss.
+
+    A FlossColor is a view to one entry of a `Palette`. Creating a FlossColor
+    directly creates a palette containing only that floss.
     """
 
+    __slots__ = ("_palette", "_index")
+
+    FIELDS = ("color", "symbol", "symbol_color", "color_number", "color_name")
+    DEFAULTS = {"symbol": "x", "symbol_color": "#000000", "color_number": "",
+                "color_name": ""}
+
     def __init__(self, color, symbol="x", symbol_color="#000000",
                  color_number="", color_name=""):
         """
@@ -111,32 +412,81 @@ class FlossColor():
         :color_name: Floss color name, e.g. "Moss Green"
         """
         # pylint: disable=too-many-arguments
-        self.color = color
-        self.symbol = symbol
-        self.symbol_color = symbol_color
-        self.color_number = color_number
-        self.color_name = color_name
-        self._rgb = None
-        self._lab = None
+        self._palette = Palette.from_fields([color], [symbol], [symbol_color],
+                                            [color_number], [color_name])
+        self._index = 0
+
+    @classmethod
+    def view(cls, palette, index):
+        """
+        Return a FlossColor representing an entry of a palette.
+
+        :palette: the `Palette` containing the floss
+        :index: index of the floss in the palette
+        """
+        color = cls.__new__(cls)
+        color._palette = palette
+        color._index = index
+        return color
+
+    @property
+    def color(self):
+        """
+        The hex value of the color, e.g. "#838a29"
+        """
+        return str(self._palette.hex_codes[self._index])
+
+    @property
+    def symbol(self):
+        """
+        The symbol used for the color in charts
+        """
+        return str(self._palette.symbols[self._index])
+
+    @property
+    def symbol_color(self):
+        """
+        Color used when drawing the symbol
+        """
+        return str(self._palette.symbol_colors[self._index])
+
+    @property
+    def color_number(self):
+        """
+        Floss color chart number, e.g. "DMC 581"
+        """
+        return str(self._palette.color_numbers[self._index])
+
+    @property
+    def color_name(self):
+        """
+        Floss color name, e.g. "Moss Green"
+        """
+        return str(self._palette.color_names[self._index])
 
     @property
     def rgbcolor(self):
         """
         Return colormath.sRGBColor representation of the color
         """
-        if not self._rgb:
-            self._rgb = sRGBColor.new_from_rgb_hex(self.color)
-        return self._rgb
+        # pylint: disable=import-outside-toplevel
+        from colormath.color_objects import sRGBColor
+        return sRGBColor(*self.rgb_values(), is_upscaled=True)
+
+    def rgb_values(self):
+        """
+        Return a tuple containing the RGB values (in range 0-255) of the color
+        """
+        return tuple(self._palette.rgb[self._index].tolist())
 
     @property
     def labcolor(self):
         """
         Return colormath.LabColor representation of the color
         """
-        if not self._lab:
-            self._lab = color_conversions.convert_color(self.rgbcolor,
-                                                        LabColor)
-        return self._lab
+        # pylint: disable=import-outside-toplevel
+        from colormath.color_objects import LabColor
+        return LabColor(*self._palette.lab[self._index].tolist())
 
     def __repr__(self):
         """
@@ -163,15 +513,11 @@ class FlossColor():
         """
         Return a dictionary representation of the class
         """
-        return {"color": self.color,
-                "symbol": self.symbol,
-                "symbol_color": self.symbol_color,
-                "color_number": self.color_number,
-                "color_name": self.color_name,
-                }
+        return {field: getattr(self, field) for field in self.FIELDS}
 
-    def __array__(self):
+    def __array__(self, dtype=None, copy=None):
         """
         Return an array representation of the CIELab color of this floss.
         """
-        return np.array(self.labcolor.get_value_tuple())
+        # pylint: disable=unused-argument
+        return np.array(self._palette.lab[self._index], dtype=dtype)
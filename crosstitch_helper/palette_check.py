@@ -0,0 +1,137 @@
+"""
+Checking that the colours of a pattern image are found in a palette.
+"""
+
+import numpy as np
+
+from crosstitch_helper import color_space, stats
+from crosstitch_helper.imagetool import pack_rgb, unpack_rgb
+from crosstitch_helper.palette import Palette
+
+
+class PaletteCheck():
+    """
+    Find all colours of a pattern image that are missing from a palette.
+
+    The colours are taken from the colour counts that are also used for
+    counting the stitches, so checking does not need a separate pass over
+    the image. The image is only read again to find where missing colours
+    first appear.
+    """
+
+    def __init__(self, image_tool, palette, colour_counts=None,
+                 metric_params=None):
+        """
+        Create a new check.
+
+        :image_tool: `ImageTool` for the pattern image
+        :palette: colour palette, a dict with hex values of the colours as
+                  keys and (symbol, symbol colour) pairs as values
+        :colour_counts: Optional dict mapping hex value of each colour of the
+                        image to its pixel count, in the order the colours
+                        first appear, e.g. from the counter used for counting
+                        the stitches. Defaults to the counts of the
+                        run-length encoded image.
+        :metric_params: Parameters of the colour difference used for finding
+                        the nearest palette colours. Defaults to those used
+                        for matching flosses, `Palette.metric_params`.
+        """
+        self._image_tool = image_tool
+        self._palette = palette
+        self._colour_counts = colour_counts
+        self._metric_params = metric_params
+        if metric_params is None:
+            self._metric_params = Palette.metric_params
+        self._missing = None
+
+    def missing_colours(self):
+        """
+        Return the colours of the image that are not in the palette.
+
+        Returns a list with a dict for each missing colour, in the order they
+        first appear in the image, with the keys
+
+        * `colour`: hex value of the colour
+        * `count`: number of stitches of the colour
+        * `row`, `column`: position of the first stitch of the colour
+        * `nearest`: hex value of the nearest palette colour
+        * `delta_e`: CIE 1994 colour difference to the nearest palette colour
+        """
+        if self._missing is None:
+            with stats.timer("check palette"):
+                self._missing = self._find_missing()
+        return self._missing
+
+    def remapping(self, tolerance):
+        """
+        Return a dict mapping the missing colours within `tolerance` of their
+        nearest palette colour to that colour.
+
+        The result can be passed to `ImageTool.remap_colours`.
+
+        :tolerance: largest CIE 1994 colour difference that is remapped
+        """
+        return {missing["colour"]: missing["nearest"]
+                for missing in self.missing_colours()
+                if missing["delta_e"] <= tolerance}
+
+    def _find_missing(self):
+        """
+        Calculate the missing colours. See `missing_colours`.
+        """
+        counts = self._colour_counts
+        if counts is None:
+            counts = self._image_tool.runs().colour_counts()
+        palette_colours = list(self._palette)
+        palette_codes = np.array([int(colour[1:], 16)
+                                  for colour in palette_colours],
+                                 dtype=np.uint32)
+        codes = np.array([int(colour[1:], 16) for colour in counts],
+                         dtype=np.uint32)
+        missing = np.flatnonzero(~np.isin(codes, palette_codes))
+        if not len(missing):
+            return []
+        stats.count("missing colours", len(missing))
+        rows, columns = first_positions(self._image_tool, codes[missing])
+        if len(palette_codes):
+            nearest, distances = color_space.nearest(
+                color_space.rgb_to_lab(unpack_rgb(codes[missing])),
+                color_space.rgb_to_lab(unpack_rgb(palette_codes)),
+                return_distances=True, **self._metric_params)
+        else:
+            nearest = [None] * len(missing)
+            distances = np.full(len(missing), np.inf)
+        colours = list(counts)
+        return [{"colour": colours[index],
+                 "count": int(counts[colours[index]]),
+                 "row": int(row),
+                 "column": int(column),
+                 "nearest": None if match is None else palette_colours[match],
+                 "delta_e": float(distance)}
+                for index, row, column, match, distance in zip(
+                    missing, rows, columns, nearest, distances)]
+
+
+def first_positions(image_tool, codes):
+    """
+    Return the row and column where each colour first appears in an image.
+
+    The image is read one strip at a time, until all colours have been
+    found.
+
+    :image_tool: `ImageTool` for the image
+    :codes: 24-bit codes of colours found in the image
+    :returns: tuple of arrays `(rows, columns)`, -1 for colours that were not
+              found
+    """
+    rows = np.full(len(codes), -1, dtype=np.int64)
+    columns = np.full(len(codes), -1, dtype=np.int64)
+    for first_row, strip in image_tool.iterate_strips():
+        values, first_index = np.unique(pack_rgb(strip), return_index=True)
+        indices = np.minimum(np.searchsorted(values, codes), len(values) - 1)
+        found = (values[indices] == codes) & (rows < 0)
+        rows[found] = first_row + first_index[indices[found]] // strip.shape[1]
+        columns[found] = first_index[indices[found]] % strip.shape[1]
+        if (rows >= 0).all():
+            break
+    return rows, columns
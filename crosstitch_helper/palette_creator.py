@@ -4,36 +4,64 @@ Tool for automatically generating palettes
 
 import pprint
 
+from crosstitch_helper import stats
+from crosstitch_helper.imagetool import unpack_rgb
+from crosstitch_helper.symbol_assignment import assign_symbols, symbol_colours
+
 
 class PaletteCreator():
     """
     Create a palette for an image.
     """
 
-    def __init__(self, stitch_iterator, symbols):
+    def __init__(self, stitch_iterator, symbols, sequential_symbols=False):
         """
         Create a new PaletteCreator.
 
-        :stitch_iterator: An iterator that yields hex strings for each stitch
-                          in the pattern.
+        :stitch_iterator: An `ImageTool` (or other object providing
+                          `colour_counts`) for the pattern, or a callable
+                          returning an iterator that yields hex strings for
+                          each stitch in the pattern.
+        :symbols: sequence of symbols to use, in order of preference
+        :sequential_symbols: If True, symbols are given in order of first
+                             appearance of the colours, cycling through
+                             `symbols`. By default, symbols are chosen so
+                             that similar colours get distinct symbols.
         """
         self._stitch_iterator = stitch_iterator
         self._symbols = symbols
+        self._sequential_symbols = sequential_symbols
         self._palette = None
 
     def create_palette(self):
         """
         Determine the colours in the piece and their symbols.
+
+        Each colour gets a black or white symbol colour, whichever contrasts
+        more with it.
+        """
+        colours = list(dict.fromkeys(self._colours()))
+        with stats.timer("assign symbols"):
+            rgb = unpack_rgb([int(hexvalue.lstrip("#"), 16)
+                              for hexvalue in colours]).reshape(-1, 3)
+            if self._sequential_symbols:
+                symbols = [self._symbols[index % len(self._symbols)]
+                           for index in range(len(colours))]
+            else:
+                symbols = assign_symbols(rgb, self._symbols)
+            self._palette = dict(zip(colours, zip(symbols,
+                                                  symbol_colours(rgb))))
+
+    def _colours(self):
+        """
+        Return an iterable of the colours of the stitches.
+
+        Each colour of the pattern is present at least once, in the order of
+        first appearance.
         """
-        self._palette = {}
-        symbol_index = 0
-        for hexvalue in self._stitch_iterator():
-            if hexvalue not in self._palette:
-                self._palette[hexvalue] = (self._symbols[symbol_index],
-                                           "#000000")
-                symbol_index += 1
-                if symbol_index >= len(self._symbols):
-                    symbol_index = 0
+        if hasattr(self._stitch_iterator, "colour_counts"):
+            return self._stitch_iterator.colour_counts()
+        return self._stitch_iterator()
 
     def needs_palette(func, *args, **kwargs):
         """
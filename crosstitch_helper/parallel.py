@@ -0,0 +1,133 @@
+"""
+Counting the colours of one large image on a pool of worker processes.
+"""
+
+import multiprocessing
+import signal
+
+import numpy as np
+
+from crosstitch_helper import stats
+from crosstitch_helper.imagetool import (code_to_hex, count_in_order,
+                                         merge_colour_counts, pack_rgb)
+
+CHUNK_PIXELS = 1 << 20
+
+
+class ParallelCounter():
+    """
+    Count the colours of an image in row chunks processed concurrently.
+
+    Each worker returns the distinct colours and counts of its chunk, and the
+    partial counts are merged in chunk order, so the result is identical to
+    `ImageTool.colour_counts`, including the order of colours.
+
+    Memory-mapped (lazy) images are opened by the workers themselves, so that
+    only the row range of each chunk is sent to them.
+
+    The counter provides `colour_counts`, so it can be passed to
+    `StitchCounter` in place of an `ImageTool`.
+    """
+
+    def __init__(self, image_tool, workers=None, chunk_rows=None,
+                 progress=None):
+        """
+        Create a new counter.
+
+        :image_tool: `ImageTool` for the pattern image
+        :workers: Number of worker processes. Defaults to the number of CPUs.
+        :chunk_rows: Number of image rows in each chunk. By default chunks
+                     have about `CHUNK_PIXELS` pixels.
+        :progress: Optional callable, called with the number of pixels
+                   counted so far and the total number of pixels after each
+                   chunk
+        """
+        self._image_tool = image_tool
+        self._workers = workers
+        self._chunk_rows = chunk_rows
+        self._progress = progress
+        self._colour_counts = None
+
+    def colour_counts(self):
+        """
+        Return a dict mapping hex value of each colour to its pixel count.
+
+        The colours are in the order they first appear in the image. If the
+        counting is interrupted (e.g. with Ctrl-C), the worker processes are
+        terminated before the exception is passed on.
+        """
+        if self._colour_counts is None:
+            with stats.timer("count colours"):
+                codes, counts = merge_colour_counts(self._counted_chunks())
+            self._colour_counts = dict(zip([code_to_hex(code)
+                                            for code in codes],
+                                           counts.tolist()))
+            stats.count("unique colours", len(codes))
+        return self._colour_counts
+
+    def _counted_chunks(self):
+        """
+        Yield `(codes, counts)` of each chunk in order, reporting progress.
+        """
+        imagedata = self._image_tool.colour_values()
+        height, width = imagedata.shape[:2]
+        chunk_rows = self._chunk_rows or max(1, CHUNK_PIXELS // max(width, 1))
+        tasks = [(first_row, min(first_row + chunk_rows, height))
+                 for first_row in range(0, height, chunk_rows)]
+        done = 0
+        if len(tasks) <= 1:
+            results = (_count_rows(imagedata, *task) for task in tasks)
+            for result, task in zip(results, tasks):
+                done += (task[1] - task[0]) * width
+                self._report(done, height * width)
+                yield result
+            return
+        filename = getattr(imagedata, "filename", None)
+        if filename is not None:
+            tasks = [(filename,) + task for task in tasks]
+            function = _count_file_rows
+        else:
+            tasks = [imagedata[first:last] for first, last in tasks]
+            function = _count_strip
+        with multiprocessing.Pool(self._workers,
+                                  initializer=_init_worker) as pool:
+            for codes, counts in pool.imap(function, tasks):
+                done += int(counts.sum())
+                self._report(done, height * width)
+                yield codes, counts
+
+    def _report(self, done, total):
+        """
+        Pass the progress to the progress callback, if there is one.
+        """
+        if self._progress is not None:
+            self._progress(done, total)
+
+
+def _init_worker():
+    """
+    Leave handling Ctrl-C to the main process, which terminates the pool.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _count_rows(imagedata, first_row, last_row):
+    """
+    Return distinct colour codes and counts of a range of rows.
+    """
+    return count_in_order(pack_rgb(imagedata[first_row:last_row]))
+
+
+def _count_strip(strip):
+    """
+    Return distinct colour codes and counts of image data sent to the worker.
+    """
+    return count_in_order(pack_rgb(strip))
+
+
+def _count_file_rows(task):
+    """
+    Return distinct colour codes and counts of rows of a `.npy` image file.
+    """
+    filename, first_row, last_row = task
+    return _count_rows(np.load(filename, mmap_mode="r"), first_row, last_row)
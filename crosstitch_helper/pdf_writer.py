@@ -0,0 +1,144 @@
+"""
+Writing PDF files object by object, and copying the pages of other PDF files
+into them.
+"""
+
+import bisect
+import re
+
+_REFERENCE = re.compile(rb"\b(\d+) 0 R\b")
+_OBJECT = re.compile(rb"(\d+) 0 obj\s*(.*?)\s*endobj\s*$", re.S)
+_STREAM = re.compile(rb">>\s*stream\r?\n")
+
+
+class PdfWriter():
+    """
+    Minimal writer of PDF objects into a binary file, in any order.
+    """
+
+    def __init__(self, outfile):
+        """
+        Write the PDF header into the file.
+        """
+        self._file = outfile
+        self._start = outfile.tell()
+        self._offsets = {}
+        self._next_number = 1
+        outfile.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def reserve(self):
+        """
+        Return the number of a new object, to be written later.
+        """
+        number = self._next_number
+        self._next_number += 1
+        return number
+
+    def write_object(self, number, dictionary, stream=None):
+        """
+        Write an object, or a stream object if `stream` is given.
+
+        :number: object number from `reserve`
+        :dictionary: the object (or stream dictionary) as bytes
+        :stream: stream content as bytes
+        """
+        self._offsets[number] = self._file.tell() - self._start
+        self._file.write("{} 0 obj\n".format(number).encode())
+        if stream is None:
+            self._file.write(dictionary)
+        else:
+            self._file.write(dictionary[:-2].rstrip() +
+                             " /Length {} >>\nstream\n".format(
+                                 len(stream)).encode())
+            self._file.write(stream)
+            self._file.write(b"\nendstream")
+        self._file.write(b"\nendobj\n")
+
+    def close(self, root):
+        """
+        Write the cross-reference table and trailer.
+
+        :root: object number of the document catalog
+        """
+        xref = self._file.tell() - self._start
+        lines = ["xref", "0 {}".format(self._next_number),
+                 "0000000000 65535 f "]
+        lines.extend("{:010d} 00000 n ".format(self._offsets[number])
+                     for number in range(1, self._next_number))
+        lines.append("trailer\n<< /Size {} /Root {} 0 R >>".format(
+            self._next_number, root))
+        lines.append("startxref\n{}\n%%EOF\n".format(xref))
+        self._file.write("\n".join(lines).encode())
+
+
+def copy_pages(pdf, data, parent):
+    """
+    Copy all objects of a PDF document into a `PdfWriter`, except its
+    catalog, page tree and document information.
+
+    This is meant for single documents written by matplotlib, which have one
+    cross-reference table and no object streams. The copied objects are given
+    new numbers, and the pages are attached to another page tree.
+
+    :pdf: `PdfWriter` of the output file
+    :data: the PDF document as bytes
+    :parent: object number of the page tree in the output file
+    :returns: list of the object numbers of the copied pages
+    """
+    objects = _read_objects(data)
+    trailer = data[data.rindex(b"trailer"):]
+    root = int(re.search(rb"/Root (\d+) 0 R", trailer).group(1))
+    pages_tree = int(re.search(rb"/Pages (\d+) 0 R",
+                               objects[root]).group(1))
+    kids = [int(number) for number in _REFERENCE.findall(
+        re.search(rb"/Kids \[(.*?)\]", objects[pages_tree], re.S).group(1))]
+    skipped = {root, pages_tree}
+    info = re.search(rb"/Info (\d+) 0 R", trailer)
+    if info:
+        skipped.add(int(info.group(1)))
+    numbers = {number: pdf.reserve() for number in objects
+               if number not in skipped}
+    # the pages refer to their page tree as their parent
+    references = dict(numbers)
+    references[pages_tree] = parent
+
+    def renumber(match):
+        return b"%d 0 R" % references[int(match.group(1))]
+
+    for number, body in objects.items():
+        if number in skipped:
+            continue
+        stream = _STREAM.search(body)
+        header = body if stream is None else body[:stream.start()]
+        header = _REFERENCE.sub(renumber, header)
+        pdf.write_object(numbers[number], header if stream is None
+                         else header + body[stream.start():])
+    return [numbers[kid] for kid in kids]
+
+
+def _read_objects(data):
+    """
+    Return a dict mapping object numbers of a PDF document to the bytes
+    between `obj` and `endobj`.
+
+    The objects are located with the cross-reference table, so stream data is
+    never parsed.
+    """
+    start = int(re.search(rb"startxref\s+(\d+)", data[-64:]).group(1))
+    lines = data[start:data.index(b"trailer", start)].split(b"\n")
+    first, _ = (int(value) for value in lines[1].split())
+    offsets = {}
+    for number, line in enumerate(lines[2:], first):
+        fields = line.split()
+        if len(fields) == 3 and fields[2] == b"n":
+            offsets[number] = int(fields[0])
+    ends = sorted(offsets.values()) + [start]
+    objects = {}
+    for number, offset in offsets.items():
+        end = ends[bisect.bisect_right(ends, offset)]
+        match = _OBJECT.match(data, offset, end)
+        if match is None or int(match.group(1)) != number:
+            raise ValueError("object {} not found at offset {}".format(
+                number, offset))
+        objects[number] = match.group(2)
+    return objects
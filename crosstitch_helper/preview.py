@@ -0,0 +1,316 @@
+"""
+Previews of how a pattern looks when stitched, as a pyramid of image tiles.
+
+Zoom level 0 shows the whole pattern in one tile, and each following level
+doubles the size, up to `cell_size` pixels per stitch at the last level. The
+image is decoded and its colours mapped only once. The tiles are drawn when
+they are first requested and kept in a cache, so that a large pattern can be
+viewed without drawing all of it first.
+
+Levels with less than a pixel per stitch are drawn from averaged colours, and
+levels with several pixels per stitch can be drawn with a cross stitch
+texture.
+"""
+
+import collections
+import functools
+import hashlib
+import io
+import os
+import threading
+
+import numpy as np
+
+from crosstitch_helper import stats
+from crosstitch_helper.imagetool import unpack_rgb
+
+TILE_SIZE = 256
+CELL_SIZE = 8
+TEXTURE_MIN_CELL = 4  # smallest cell size in pixels drawn with texture
+BACKGROUND = (255, 255, 255)
+
+
+class PreviewPyramid():
+    """
+    Preview tiles of a pattern at several zoom levels.
+    """
+
+    def __init__(self, image_tool, palette=None, tile_size=TILE_SIZE,
+                 cell_size=CELL_SIZE, texture=False, cache_size=256,
+                 cache_dir=None):
+        """
+        Create a new pyramid. No tiles are drawn yet.
+
+        :image_tool: `ImageTool` for the pattern image
+        :palette: Optional floss `Palette`. If given, each colour is shown as
+                  the best matching floss.
+        :tile_size: width and height of the tiles in pixels
+        :cell_size: pixels per stitch at the last zoom level, a power of two
+        :texture: whether stitches are drawn as crosses at levels with at
+                  least `TEXTURE_MIN_CELL` pixels per stitch
+        :cache_size: number of encoded tiles kept in memory
+        :cache_dir: Optional directory where encoded tiles are saved and
+                    reused from, also by later instances for the same image
+                    and options
+        """
+        # pylint: disable=too-many-arguments
+        if cell_size < 1 or cell_size & (cell_size - 1):
+            raise ValueError("cell size must be a power of two")
+        self.tile_size = tile_size
+        self.cell_size = cell_size
+        self.texture = texture
+        with stats.timer("preview colours"):
+            codes, self._indices, _ = image_tool.unique_colours()
+            rgb = unpack_rgb(codes).reshape(-1, 3)
+            if palette is not None:
+                rgb = palette.rgb[palette.best_match_many(rgb)]
+            self._colours = rgb.astype(np.uint8)
+        self.height, self.width = self._indices.shape
+        self.levels = 1
+        while max(self.width, self.height) * cell_size > \
+                tile_size << (self.levels - 1):
+            self.levels += 1
+        self._mipmaps = {}
+        self._mipmap_lock = threading.RLock()
+        self._tiles = collections.OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+        self._cache_dir = None
+        if cache_dir is not None:
+            self._cache_dir = os.path.join(cache_dir, self._digest())
+
+    def scale(self, level):
+        """
+        Return the number of pixels per stitch at a zoom level.
+
+        Below 1 at levels where several stitches share a pixel.
+        """
+        self._check_level(level)
+        return self.cell_size / 2 ** (self.levels - 1 - level)
+
+    def level_size(self, level):
+        """
+        Return the width and height of the whole preview at a zoom level in
+        pixels.
+        """
+        scale = self.scale(level)
+        return (int(np.ceil(self.width * scale)),
+                int(np.ceil(self.height * scale)))
+
+    def tile_counts(self, level):
+        """
+        Return the number of tile columns and rows at a zoom level.
+        """
+        width, height = self.level_size(level)
+        return (-(-width // self.tile_size), -(-height // self.tile_size))
+
+    def tile(self, level, column, row):
+        """
+        Return a tile as PNG data.
+
+        Tiles at the edges of the pattern are filled with `BACKGROUND`.
+
+        :level: zoom level, 0 being the smallest
+        :column, row: position of the tile, counted from the upper left tile
+        """
+        key = (level, column, row)
+        with self._lock:
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+                stats.count("preview tiles from memory")
+                return self._tiles[key]
+        columns, rows = self.tile_counts(level)
+        if not (0 <= column < columns and 0 <= row < rows):
+            raise ValueError("no tile {}/{} at level {}".format(column, row,
+                                                                level))
+        path = None
+        if self._cache_dir is not None:
+            path = os.path.join(self._cache_dir, str(level), str(column),
+                                "{}.png".format(row))
+        if path is not None and os.path.exists(path):
+            with open(path, "rb") as infile:
+                data = infile.read()
+            stats.count("preview tiles from disk")
+        else:
+            data = _encode_png(self.tile_array(level, column, row))
+            if path is not None:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "wb") as outfile:
+                    outfile.write(data)
+        with self._lock:
+            self._tiles[key] = data
+            while len(self._tiles) > self._cache_size:
+                self._tiles.popitem(last=False)
+        return data
+
+    def tile_array(self, level, column, row):
+        """
+        Return a tile as an RGB array of shape (tile_size, tile_size, 3).
+        """
+        return self.region(level, column * self.tile_size,
+                           row * self.tile_size, self.tile_size,
+                           self.tile_size)
+
+    def image(self, level):
+        """
+        Return the whole preview at a zoom level as an RGB array.
+        """
+        width, height = self.level_size(level)
+        return self.region(level, 0, 0, width, height)
+
+    def region(self, level, left, top, width, height):
+        """
+        Return a rectangle of the preview at a zoom level as an RGB array.
+
+        :level: zoom level
+        :left, top: position of the upper left corner in pixels
+        :width, height: size of the rectangle in pixels
+        """
+        # pylint: disable=too-many-arguments
+        with stats.timer("draw preview"):
+            scale = self.scale(level)
+            if scale >= 1:
+                return self._magnified(int(scale), left, top, width, height)
+            return self._reduced(int(round(1 / scale)), left, top, width,
+                                 height)
+
+    def write_tiles(self, directory, levels=None):
+        """
+        Write tiles into `directory` as `LEVEL/COLUMN/ROW.png`.
+
+        :directory: output directory, created if it does not exist
+        :levels: Optional list of zoom levels, defaults to all levels
+        :returns: number of tiles written
+        """
+        count = 0
+        for level in range(self.levels) if levels is None else levels:
+            columns, rows = self.tile_counts(level)
+            for column in range(columns):
+                os.makedirs(os.path.join(directory, str(level), str(column)),
+                            exist_ok=True)
+                for row in range(rows):
+                    with open(os.path.join(directory, str(level), str(column),
+                                           "{}.png".format(row)),
+                              "wb") as outfile:
+                        outfile.write(self.tile(level, column, row))
+                    count += 1
+        return count
+
+    def _magnified(self, scale, left, top, width, height):
+        """
+        Return a region at a level with `scale` pixels per stitch.
+        """
+        # pylint: disable=too-many-arguments
+        region = np.empty((height, width, 3), dtype=np.uint8)
+        region[:] = BACKGROUND
+        rows = np.arange(top, top + height) // scale
+        columns = np.arange(left, left + width) // scale
+        inside_rows = rows < self.height
+        inside_columns = columns < self.width
+        rgb = self._colours[self._indices[np.ix_(rows[inside_rows],
+                                                 columns[inside_columns])]]
+        if self.texture and scale >= TEXTURE_MIN_CELL:
+            shade = _cross_texture(scale)[np.ix_(
+                np.arange(top, top + height)[inside_rows] % scale,
+                np.arange(left, left + width)[inside_columns] % scale)]
+            rgb = (rgb * shade[..., np.newaxis]).astype(np.uint8)
+        region[np.ix_(inside_rows, inside_columns)] = rgb
+        return region
+
+    def _reduced(self, factor, left, top, width, height):
+        """
+        Return a region at a level where each pixel covers `factor` stitches
+        in both directions.
+        """
+        # pylint: disable=too-many-arguments
+        sums, counts = self._mipmap(factor)
+        region = np.empty((height, width, 3), dtype=np.uint8)
+        region[:] = BACKGROUND
+        bottom = min(top + height, counts.shape[0])
+        right = min(left + width, counts.shape[1])
+        if bottom <= top or right <= left:
+            return region
+        region[:bottom - top, :right - left] = np.round(
+            sums[top:bottom, left:right] /
+            counts[top:bottom, left:right, np.newaxis])
+        return region
+
+    def _mipmap(self, factor):
+        """
+        Return the sums of the colours of blocks of `factor` by `factor`
+        stitches and the number of stitches in each block.
+
+        Each reduced level is made from the previous one, and they are kept
+        for drawing more tiles. Tiles are drawn on several threads, so each
+        level is made once while holding a lock.
+        """
+        with self._mipmap_lock:
+            if factor not in self._mipmaps:
+                if factor == 2:
+                    sums = self._colours[self._indices].astype(np.float32)
+                    counts = np.ones(self._indices.shape, dtype=np.float32)
+                else:
+                    sums, counts = self._mipmap(factor // 2)
+                self._mipmaps[factor] = (_halve(sums), _halve(counts))
+            return self._mipmaps[factor]
+
+    def _check_level(self, level):
+        """
+        Raise ValueError if the zoom level does not exist.
+        """
+        if not 0 <= level < self.levels:
+            raise ValueError("no zoom level {}, levels are 0-{}".format(
+                level, self.levels - 1))
+
+    def _digest(self):
+        """
+        Return a digest of the image, colours and options of the pyramid.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(np.ascontiguousarray(self._indices).tobytes())
+        digest.update(self._colours.tobytes())
+        digest.update(repr((self._indices.shape, self.tile_size,
+                            self.cell_size, self.texture)).encode())
+        return digest.hexdigest()
+
+
+def _halve(array):
+    """
+    Return the sums of 2 by 2 blocks of an array, padding it with zeros to an
+    even size.
+    """
+    height, width = array.shape[:2]
+    padded = np.zeros(((height + 1) // 2 * 2, (width + 1) // 2 * 2)
+                      + array.shape[2:], dtype=array.dtype)
+    padded[:height, :width] = array
+    return padded[0::2, 0::2] + padded[1::2, 0::2] + padded[0::2, 1::2] + \
+        padded[1::2, 1::2]
+
+
+@functools.lru_cache(maxsize=None)
+def _cross_texture(size):
+    """
+    Return the brightness (0-1) of each pixel of a stitch drawn as a cross.
+
+    The threads are shaded darker towards their edges, the fabric between
+    the arms of the cross is darker still and the holes in the corners are
+    the darkest.
+    """
+    position = (np.arange(size) + 0.5) / size
+    row, column = np.meshgrid(position, position, indexing="ij")
+    diagonal = np.minimum(np.abs(row - column), np.abs(row + column - 1))
+    shade = np.where(diagonal < 0.3, 1 - 0.3 * (diagonal / 0.3) ** 2, 0.55)
+    corner = np.hypot(np.minimum(row, 1 - row), np.minimum(column, 1 - column))
+    return np.where(corner < 0.15, 0.35, shade)
+
+
+def _encode_png(rgb):
+    """
+    Return an RGB array encoded as PNG data.
+    """
+    # pylint: disable=import-outside-toplevel
+    from imageio import imwrite
+
+    output = io.BytesIO()
+    imwrite(output, rgb, format="png")
+    return output.getvalue()
@@ -0,0 +1,129 @@
+"""
+Reduction of images with many colours to a few floss colours.
+"""
+
+import numpy as np
+
+from crosstitch_helper import color_space
+from crosstitch_helper.dither import map_colors
+from crosstitch_helper.imagetool import ImageTool, unpack_rgb
+
+
+class Quantizer():
+    """
+    Choose N flosses for an image and map the image onto them.
+
+    The flosses are chosen by clustering the distinct colours of the image in
+    CIELab space with mini-batch k-means, weighting each colour by its pixel
+    count, and replacing each cluster centre with the best matching floss.
+    Colours are first combined into bins of similar RGB values, so that the
+    clustering time does not grow with the number of distinct colours.
+    """
+
+    def __init__(self, palette, n_colors, batch_size=4096, random_state=0):
+        """
+        Create a new Quantizer.
+
+        :palette: `Palette` of the available flosses, e.g. DMC
+        :n_colors: Maximum number of flosses in the result. Fewer flosses are
+                   used if several clusters match the same floss or if the
+                   image has fewer colours.
+        :batch_size: Number of colours in each k-means mini-batch
+        :random_state: Seed for the k-means initialisation
+        """
+        self._palette = palette
+        self._n_colors = n_colors
+        self._batch_size = batch_size
+        self._random_state = random_state
+        self.palette = None
+
+    def fit(self, image_tool):
+        """
+        Choose the flosses for an image.
+
+        The chosen flosses are stored in `self.palette` as a `Palette`.
+
+        :image_tool: `ImageTool` for the image
+        """
+        codes, counts = image_tool.distinct_colours()
+        if len(codes) <= self._n_colors:
+            centers = color_space.rgb_to_lab(unpack_rgb(codes))
+        else:
+            centers = self._cluster_centers(*_binned_colours(codes, counts))
+        matches = color_space.nearest(centers, self._palette.lab_matrix(),
+                                      **self._palette.metric_params)
+        chosen = list(dict.fromkeys(matches.tolist()))
+        self.palette = self._palette.subset(chosen)
+        return self
+
+    def _cluster_centers(self, lab, weights):
+        """
+        Return at most `n_colors` Lab colours representing binned colours.
+
+        The bins are used as such if there are few enough of them, as k-means
+        needs at least as many points as clusters.
+
+        :lab: mean Lab colour of each bin
+        :weights: number of pixels in each bin
+        """
+        if len(lab) <= self._n_colors:
+            return lab
+        # pylint: disable=import-outside-toplevel
+        from sklearn.cluster import MiniBatchKMeans
+        kmeans = MiniBatchKMeans(n_clusters=self._n_colors,
+                                 batch_size=self._batch_size,
+                                 random_state=self._random_state,
+                                 n_init=3)
+        kmeans.fit(lab, sample_weight=weights)
+        return kmeans.cluster_centers_
+
+    def quantize(self, image_tool, dither="none"):
+        """
+        Return an `ImageTool` of the image drawn using the chosen flosses.
+
+        Without dithering, every pixel is replaced by the best matching chosen
+        floss. `fit` is called first if flosses have not been chosen yet.
+
+        :image_tool: `ImageTool` for the image
+        :dither: Dithering method, one of `dither.METHODS`
+        """
+        if self.palette is None:
+            self.fit(image_tool)
+        floss_rgb = self.palette.rgb
+        if dither == "none":
+            quantized = np.empty(image_tool.colour_values().shape,
+                                 dtype=np.uint8)
+            for first_row, strip in image_tool.iterate_strips():
+                indices = self.palette.best_match_many(strip)
+                quantized[first_row:first_row + len(strip)] = \
+                    floss_rgb[indices]
+        else:
+            indices = map_colors(image_tool.colour_values(), self.palette,
+                                 dither)
+            quantized = floss_rgb[indices]
+        return ImageTool.from_array(quantized,
+                                    strip_height=image_tool.strip_height)
+
+
+def _binned_colours(codes, counts, bits=5):
+    """
+    Return mean Lab colours and pixel counts of colours binned in RGB space.
+
+    Colours whose RGB values agree in the `bits` most significant bits fall in
+    the same bin, which bounds the number of points to cluster to
+    2**(3 * bits) however many distinct colours a photo has.
+
+    :codes: 24-bit codes of the distinct colours
+    :counts: number of pixels of each colour
+    """
+    rgb = unpack_rgb(codes)
+    shift = 8 - bits
+    bins = ((rgb[:, 0].astype(np.uint32) >> shift) << (2 * bits)
+            | (rgb[:, 1].astype(np.uint32) >> shift) << bits
+            | rgb[:, 2].astype(np.uint32) >> shift)
+    _, inverse = np.unique(bins, return_inverse=True)
+    weights = np.bincount(inverse, weights=counts)
+    lab = color_space.rgb_to_lab(rgb)
+    lab_sums = np.stack([np.bincount(inverse, weights=lab[:, i] * counts)
+                         for i in range(3)], axis=1)
+    return lab_sums / weights[:, np.newaxis], weights
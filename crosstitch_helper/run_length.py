@@ -0,0 +1,199 @@
+"""
+Run-length encoding of pattern images.
+
+Each row of the image is stored as runs of stitches of the same colour:
+the index of the colour, the column where the run starts and its length.
+Patterns drawn as pixel art consist mostly of long runs, so the encoding
+takes a fraction of the memory of the RGB data.
+"""
+
+import numpy as np
+
+from crosstitch_helper.imagetool import code_to_hex, pack_rgb, unique_in_order
+
+
+class RunLengthImage():
+    """
+    A pattern image stored as runs of equal colour in each row.
+
+    The runs are stored in row order in the arrays `colours` (index to
+    `codes`), `starts` and `lengths`. The runs of row `r` are at indices
+    `row_offsets[r]:row_offsets[r + 1]`. `codes` holds the 24-bit codes of
+    the colours in the order they first appear in the image.
+    """
+
+    def __init__(self, codes, colours, row_offsets, starts, lengths, width):
+        """
+        Create a new instance from the run arrays.
+
+        Use `from_strips` or `ImageTool.runs` to encode an image.
+        """
+        # pylint: disable=too-many-arguments
+        self.codes = codes
+        self.colours = colours
+        self.row_offsets = row_offsets
+        self.starts = starts
+        self.lengths = lengths
+        self.width = width
+        self.height = len(row_offsets) - 1
+
+    @classmethod
+    def from_strips(cls, strips, width):
+        """
+        Encode an image given as horizontal strips.
+
+        Only one strip of RGB data is processed at a time.
+
+        :strips: iterable of RGB arrays of shape (rows, width, 3), e.g. from
+                 `ImageTool.iterate_strips` without the row numbers
+        :width: width of the image
+        """
+        run_codes, run_rows, starts, lengths = [], [], [], []
+        height = 0
+        for strip in strips:
+            rows, strip_starts, strip_lengths, strip_codes = row_runs(
+                pack_rgb(strip))
+            run_rows.append((rows + height).astype(np.uint32))
+            starts.append(strip_starts.astype(np.uint32))
+            lengths.append(strip_lengths.astype(np.uint32))
+            run_codes.append(strip_codes)
+            height += len(strip)
+        if not run_codes:
+            run_codes, run_rows, starts, lengths = [[np.empty(
+                0, dtype=np.uint32)]] * 4
+        codes, colours, _ = unique_in_order(np.concatenate(run_codes))
+        row_offsets = np.searchsorted(np.concatenate(run_rows),
+                                      np.arange(height + 1))
+        position_dtype = _index_dtype(width + 1)
+        return cls(codes, colours.astype(_index_dtype(len(codes))),
+                   row_offsets,
+                   np.concatenate(starts).astype(position_dtype),
+                   np.concatenate(lengths).astype(position_dtype), width)
+
+    @property
+    def nbytes(self):
+        """
+        Return the memory used by the run arrays in bytes.
+        """
+        return sum(array.nbytes for array in (
+            self.codes, self.colours, self.row_offsets, self.starts,
+            self.lengths))
+
+    def run_count(self):
+        """
+        Return the total number of runs.
+        """
+        return len(self.colours)
+
+    def hex_values(self):
+        """
+        Return the hex strings of the colours, in the order of `codes`.
+        """
+        return [code_to_hex(code) for code in self.codes]
+
+    def colour_counts(self):
+        """
+        Return a dict mapping hex value of each colour to its stitch count.
+
+        The colours are in the order they first appear in the image, the same
+        as with `ImageTool.colour_counts`.
+        """
+        counts = np.bincount(self.colours, weights=self.lengths,
+                             minlength=len(self.codes))
+        return dict(zip(self.hex_values(), counts.astype(np.int64).tolist()))
+
+    def colour_changes_per_row(self):
+        """
+        Return an array holding the number of colour changes in each row.
+        """
+        return np.maximum(np.diff(self.row_offsets) - 1, 0)
+
+    def confetti_mask(self):
+        """
+        Return a boolean array telling which runs are confetti stitches.
+
+        A confetti stitch is a single stitch with no stitch of the same
+        colour to its left, right, above or below. Each one needs its thread
+        started and finished separately.
+        """
+        single = np.flatnonzero(self.lengths == 1)
+        rows = np.repeat(np.arange(self.height), np.diff(self.row_offsets))
+        isolated = np.ones(len(single), dtype=bool)
+        for offset in (-1, 1):
+            neighbour_rows = rows[single] + offset
+            inside = (neighbour_rows >= 0) & (neighbour_rows < self.height)
+            neighbours = self.colour_at(neighbour_rows[inside],
+                                        self.starts[single][inside], rows)
+            isolated[np.flatnonzero(inside)[
+                neighbours == self.colours[single][inside]]] = False
+        mask = np.zeros(self.run_count(), dtype=bool)
+        mask[single[isolated]] = True
+        return mask
+
+    def confetti_counts(self):
+        """
+        Return a dict mapping hex value of each colour to the number of its
+        confetti stitches (see `confetti_mask`), in the order of `codes`.
+        """
+        counts = np.bincount(self.colours[self.confetti_mask()],
+                             minlength=len(self.codes))
+        return dict(zip(self.hex_values(), counts.tolist()))
+
+    def confetti_count(self):
+        """
+        Return the total number of confetti stitches.
+        """
+        return int(np.count_nonzero(self.confetti_mask()))
+
+    def colour_at(self, rows, columns, run_rows=None):
+        """
+        Return the colour indices of stitches.
+
+        :rows: array of row numbers
+        :columns: array of column numbers
+        :run_rows: Optional array of the row of each run, to avoid
+                   recalculating it
+        """
+        if run_rows is None:
+            run_rows = np.repeat(np.arange(self.height),
+                                 np.diff(self.row_offsets))
+        # runs are sorted by their position in the image
+        run_positions = run_rows.astype(np.int64) * self.width + self.starts
+        positions = np.asarray(rows, dtype=np.int64) * self.width + columns
+        runs = np.searchsorted(run_positions, positions, side="right") - 1
+        return self.colours[runs]
+
+    def to_codes(self):
+        """
+        Return the decoded image as an array of 24-bit colour codes.
+        """
+        return self.codes[np.repeat(self.colours, self.lengths)].reshape(
+            self.height, self.width)
+
+
+def row_runs(codes):
+    """
+    Return the runs of equal values in each row of a 2D array.
+
+    Returns arrays `(rows, starts, lengths, values)` with one entry per run,
+    ordered by row and start.
+
+    :codes: array of shape (height, width), e.g. colour codes
+    """
+    height, width = codes.shape
+    is_start = np.ones((height, width), dtype=bool)
+    is_start[:, 1:] = codes[:, 1:] != codes[:, :-1]
+    rows, starts = np.nonzero(is_start)
+    flat = rows * width + starts
+    lengths = np.diff(np.append(flat, height * width))
+    return rows, starts, lengths, codes[rows, starts]
+
+
+def _index_dtype(size):
+    """
+    Return the smallest unsigned integer type holding indices below `size`.
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if size <= np.iinfo(dtype).max + 1:
+            return dtype
+    return np.uint64
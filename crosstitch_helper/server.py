@@ -0,0 +1,636 @@
+"""
+A local HTTP service for counting stitches, creating palettes and drawing
+charts.
+
+The service keeps the palettes, the floss palette with its lookup table,
+the glyph shapes of the symbols and recent results in memory between
+requests, so that each request only pays for processing its own image.
+Connections are handled on an asyncio event loop, and the images are
+processed on a bounded pool of threads. Requests that are not received
+within `READ_TIMEOUT` seconds are answered with status 408.
+
+Images are sent as the body of POST requests:
+
+* `POST /stitchify?palette=NAME` returns stitch counts and skein estimates
+  (options `stitches_per_skein` and `remap_tolerance`, and
+  `estimate_thread=1` with `fabric_count` and `strands` for estimating the
+  thread from the layout of the stitches)
+* `POST /create-palette` returns a palette for the image (option
+  `sequential_symbols`)
+* `POST /quantize?colours=N` returns the flosses chosen for the image and
+  their stitch counts (options `dither` and `seed`)
+* `POST /chart?palette=NAME` returns a PDF chart, or one page of it as SVG
+  with `format=svg&page=N` (options `page_width` and `page_height`)
+* `POST /preview` returns the id and zoom levels of a preview of the
+  stitched pattern (options `texture` and `floss`), whose PNG tiles are then
+  fetched with `GET /preview/ID/LEVEL/COLUMN/ROW.png`. Tiles are drawn when
+  first requested.
+
+`GET /metrics` returns request counts, latencies, throughput and cache use,
+and `GET /health` tells whether the service is up.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import http
+import io
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+
+from crosstitch_helper.imagetool import ImageTool
+from crosstitch_helper.palette_check import PaletteCheck
+from crosstitch_helper.preview import PreviewPyramid
+from crosstitch_helper.stitch_counter import StitchCounter, skein_count
+from crosstitch_helper.thread_length import ThreadEstimator
+
+MAX_BODY_SIZE = 64 << 20
+READ_TIMEOUT = 30  # seconds
+LATENCY_SAMPLES = 1024
+_TILE_PREFIX = "/preview/"
+_LOG = logging.getLogger(__name__)
+
+
+class RequestError(Exception):
+    """
+    Error in a request, answered with the given HTTP status.
+    """
+
+    def __init__(self, status, message, **details):
+        """
+        Create a new error.
+
+        :status: HTTP status code of the response
+        :message: description of the error
+        :details: additional items of the JSON response
+        """
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+
+class ResultCache():
+    """
+    Least recently used cache of responses.
+    """
+
+    def __init__(self, size):
+        """
+        Create a new cache.
+
+        :size: maximum number of responses kept, 0 disables caching
+        """
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the cached response for a key, or None.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, response):
+        """
+        Store a response, dropping the least recently used ones if needed.
+        """
+        if not self.size:
+            return
+        with self._lock:
+            self._entries[key] = response
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def to_dict(self):
+        """
+        Return the cache use as a JSON serialisable dict.
+        """
+        with self._lock:
+            return {"size": self.size, "entries": len(self._entries),
+                    "hits": self.hits, "misses": self.misses}
+
+
+class Metrics():
+    """
+    Request counts and latencies of each endpoint.
+    """
+
+    def __init__(self):
+        """
+        Create a new, empty collector.
+        """
+        self.started = time.time()
+        self._endpoints = {}
+
+    def record(self, endpoint, seconds, status, cached=False):
+        """
+        Record a handled request.
+
+        :endpoint: path of the request
+        :seconds: time from receiving the request to sending the response
+        :status: HTTP status code of the response
+        :cached: whether the response came from the result cache
+        """
+        metrics = self._endpoints.setdefault(endpoint, {
+            "requests": 0, "errors": 0, "cached": 0, "seconds": 0.0,
+            "latencies": collections.deque(maxlen=LATENCY_SAMPLES)})
+        metrics["requests"] += 1
+        metrics["errors"] += status >= 400
+        metrics["cached"] += cached
+        metrics["seconds"] += seconds
+        metrics["latencies"].append(seconds)
+
+    def to_dict(self):
+        """
+        Return the metrics as a JSON serialisable dict.
+
+        Latency percentiles are in milliseconds and calculated from the
+        latest `LATENCY_SAMPLES` requests of each endpoint.
+        """
+        uptime = time.time() - self.started
+        endpoints = {}
+        for endpoint, metrics in self._endpoints.items():
+            latencies = np.array(metrics["latencies"]) * 1000
+            endpoints[endpoint] = {
+                "requests": metrics["requests"],
+                "errors": metrics["errors"],
+                "cached": metrics["cached"],
+                "requests_per_second": metrics["requests"] / uptime,
+                "mean_ms": 1000 * metrics["seconds"] / metrics["requests"],
+                "p50_ms": float(np.percentile(latencies, 50)),
+                "p95_ms": float(np.percentile(latencies, 95)),
+                "p99_ms": float(np.percentile(latencies, 99)),
+                "max_ms": float(latencies.max()),
+            }
+        total = sum(metrics["requests"]
+                    for metrics in self._endpoints.values())
+        return {"uptime_seconds": uptime,
+                "requests": total,
+                "requests_per_second": total / uptime if uptime else 0.0,
+                "endpoints": endpoints}
+
+
+class PatternServer():
+    """
+    HTTP service for the pattern tools. See the module documentation for the
+    endpoints.
+    """
+
+    def __init__(self, palettes, symbols, floss_palette=None, workers=None,
+                 cache_size=128, max_pending=None, preview_cache_size=8):
+        """
+        Create a new service.
+
+        :palettes: dict mapping palette names to chart palettes (dicts with
+                   hex values of the colours as keys and (symbol, symbol
+                   colour) pairs as values)
+        :symbols: symbols used for new palettes, in order of preference
+        :floss_palette: Optional path of the floss `Palette` file used for
+                        quantizing images
+        :workers: Number of threads processing images. Defaults to the
+                  number of CPUs.
+        :cache_size: Number of responses kept in the result cache
+        :max_pending: Number of requests accepted for processing at a time,
+                      further requests are answered with 503. Defaults to
+                      four times the number of workers.
+        :preview_cache_size: Number of previews kept in memory. Each holds
+                             the colours of its image and some of its
+                             tiles, so this should be much smaller than
+                             `cache_size`.
+        """
+        # pylint: disable=too-many-arguments
+        self._palettes = palettes
+        self._symbols = symbols
+        self._floss_palette_path = floss_palette
+        self._floss_palette = None
+        self.workers = workers or os.cpu_count() or 1
+        self._max_pending = max_pending or 4 * self.workers
+        self._pending = 0
+        self._executor = None
+        self.cache = ResultCache(cache_size)
+        self.previews = ResultCache(preview_cache_size)
+        self.metrics = Metrics()
+        self._handlers = {
+            "/stitchify": self._stitchify,
+            "/create-palette": self._create_palette,
+            "/quantize": self._quantize,
+            "/chart": self._chart,
+            "/preview": self._preview,
+        }
+
+    def warm(self):
+        """
+        Load everything shared by the requests before serving them.
+
+        This loads the floss palette and the modules used for processing
+        images, quantizes a small sample image and calculates the glyph
+        shapes of the symbols.
+        """
+        # pylint: disable=import-outside-toplevel, unused-import
+        import scipy.sparse.csgraph
+        from crosstitch_helper import palette_creator, vector_chart
+        from crosstitch_helper.symbol_assignment import glyph_bitmaps
+
+        if self._floss_palette_path:
+            from crosstitch_helper.palette import Palette
+            from crosstitch_helper.quantizer import Quantizer
+            self._floss_palette = Palette.load(self._floss_palette_path)
+            sample = np.random.default_rng(0).integers(
+                0, 256, (8, 8, 3), dtype=np.uint8)
+            Quantizer(self._floss_palette, 2).quantize(
+                ImageTool.from_array(sample))
+        glyph_bitmaps(list(dict.fromkeys(self._symbols)))
+        for palette in self._palettes.values():
+            for symbol, _ in palette.values():
+                vector_chart.symbol_path(symbol)
+
+    async def serve(self, host="127.0.0.1", port=8080, ready=None):
+        """
+        Serve requests until cancelled.
+
+        :host: address to listen on, by default only local connections are
+               accepted
+        :port: port to listen on
+        :ready: Optional callable, called with the listening socket address
+                once the service accepts connections
+        """
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            self._executor = executor
+            server = await asyncio.start_server(self._handle_connection,
+                                                host, port)
+            async with server:
+                if ready is not None:
+                    ready(server.sockets[0].getsockname())
+                await server.serve_forever()
+
+    def handle(self, method, path, params, body):
+        """
+        Return the response to a request as `(status, content type, body)`.
+
+        The result cache is used for the image endpoints. This is called on
+        the worker threads, but can also be used directly without HTTP.
+
+        :method: HTTP method, e.g. "POST"
+        :path: path of the request, e.g. "/stitchify"
+        :params: dict of query parameters
+        :body: request body as bytes
+        """
+        return self._respond(method, path, params, body)[0]
+
+    def _respond(self, method, path, params, body):
+        """
+        Return the response to a request and whether it came from the cache.
+        """
+        # pylint: disable=too-many-return-statements
+        if path == "/health":
+            return (200, "text/plain", b"ok\n"), False
+        if path == "/metrics":
+            return (200, "application/json",
+                    self.metrics_json().encode()), False
+        if path.startswith(_TILE_PREFIX):
+            return self._preview_tile(path[len(_TILE_PREFIX):]), False
+        handler = self._handlers.get(path)
+        if handler is None:
+            return _error(404, "unknown path {}".format(path)), False
+        if method != "POST":
+            return _error(405, "use POST with the image as the body"), False
+        # previews are kept in their own cache, so that their tiles can be
+        # requested as long as the preview is listed
+        cacheable = path != "/preview"
+        key = (path, hashlib.sha256(body).hexdigest(),
+               tuple(sorted(params.items())))
+        response = self.cache.get(key) if cacheable else None
+        if response is not None:
+            return response, True
+        try:
+            response = handler(body, params)
+        except RequestError as error:
+            return _error(error.status, str(error), **error.details), False
+        except (OSError, ValueError) as error:
+            return _error(400, str(error)), False
+        except Exception:  # pylint: disable=broad-except
+            _LOG.exception("%s %s failed", method, path)
+            return _error(500, "internal error"), False
+        if cacheable:
+            self.cache.put(key, response)
+        return response, False
+
+    def metrics_json(self):
+        """
+        Return the request metrics and the state of the service as JSON.
+        """
+        metrics = self.metrics.to_dict()
+        metrics.update({"workers": self.workers,
+                        "pending": self._pending,
+                        "max_pending": self._max_pending,
+                        "cache": self.cache.to_dict(),
+                        "preview_cache": self.previews.to_dict()})
+        return json.dumps(metrics, indent=4)
+
+    async def _handle_connection(self, reader, writer):
+        """
+        Read one request from a connection and write the response.
+        """
+        start = time.perf_counter()
+        endpoint = "other"
+        cached = False
+        status = None
+        try:
+            try:
+                method, path, params, body = await _read_request(reader)
+                endpoint = self._endpoint(path)
+                if endpoint in ("/health", "/metrics", "other"):
+                    response, cached = self._respond(method, path, params,
+                                                     body)
+                elif self._pending >= self._max_pending:
+                    response = _error(503, "too many requests in progress")
+                else:
+                    self._pending += 1
+                    try:
+                        response, cached = await asyncio.get_running_loop(
+                        ).run_in_executor(self._executor, self._respond,
+                                          method, path, params, body)
+                    finally:
+                        self._pending -= 1
+            except RequestError as error:
+                response = _error(error.status, str(error))
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+            except Exception:  # pylint: disable=broad-except
+                _LOG.exception("handling a request to %s failed", endpoint)
+                response = _error(500, "internal error")
+            status, content_type, content = response
+            writer.write("HTTP/1.1 {} {}\r\nContent-Type: {}\r\n"
+                         "Content-Length: {}\r\nConnection: close\r\n\r\n"
+                         "".format(status, http.HTTPStatus(status).phrase,
+                                   content_type, len(content)).encode()
+                         + content)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            if status is not None:
+                self.metrics.record(endpoint, time.perf_counter() - start,
+                                    status, cached=cached)
+
+    def _endpoint(self, path):
+        """
+        Return the name under which requests to a path are recorded.
+        """
+        if path in self._handlers or path in ("/health", "/metrics"):
+            return path
+        if path.startswith(_TILE_PREFIX):
+            return _TILE_PREFIX + "tile"
+        return "other"
+
+    def _palette(self, params):
+        """
+        Return the palette named in the request.
+        """
+        name = params.get("palette")
+        if name not in self._palettes:
+            raise RequestError(400, "unknown palette {}".format(name))
+        return self._palettes[name]
+
+    def _stitchify(self, body, params):
+        """
+        Return stitch counts and thread estimates of each colour as JSON.
+        """
+        palette = self._palette(params)
+        image_tool = ImageTool(io.BytesIO(body))
+        check = PaletteCheck(image_tool, palette)
+        missing = check.missing_colours()
+        tolerance = _number(params, "remap_tolerance", float, None)
+        if tolerance is not None:
+            mapping = check.remapping(tolerance)
+            image_tool.remap_colours(mapping)
+            missing = [colour for colour in missing
+                       if colour["colour"] not in mapping]
+        if missing:
+            raise RequestError(422, "colours not found in the palette",
+                               missing=missing)
+        counter = StitchCounter(image_tool, palette)
+        counter.count_all_stitches()
+        colours = [{"colour": colour,
+                    "symbol": palette[colour][0],
+                    "stitches": count}
+                   for colour, count in sorted(
+                       counter.stitch_count.items(),
+                       key=lambda item: item[1], reverse=True)]
+        if _number(params, "estimate_thread", int, 0):
+            estimates = ThreadEstimator(
+                image_tool.runs(),
+                fabric_count=_number(params, "fabric_count", int, 14,
+                                     minimum=1),
+                strands=_number(params, "strands", int, 2,
+                                minimum=1)).colour_stats()
+            for colour in colours:
+                colour["skeins"] = estimates[colour["colour"]]["skeins"]
+                colour["thread_length_m"] = \
+                    estimates[colour["colour"]]["length"] / 100
+        else:
+            stitches_per_skein = _number(params, "stitches_per_skein", int,
+                                         1700, minimum=1)
+            for colour in colours:
+                colour["skeins"] = skein_count(colour["stitches"],
+                                               stitches_per_skein)
+        height, width = image_tool.colour_values().shape[:2]
+        return _json({"width": width, "height": height, "colours": colours})
+
+    def _create_palette(self, body, params):
+        """
+        Return a palette for the image as JSON.
+        """
+        # pylint: disable=import-outside-toplevel, protected-access
+        from crosstitch_helper.palette_creator import PaletteCreator
+
+        creator = PaletteCreator(
+            ImageTool(io.BytesIO(body)), self._symbols,
+            sequential_symbols=_number(params, "sequential_symbols", int, 0)
+            > 0)
+        creator.create_palette()
+        return _json({"palette": creator._palette})
+
+    def _quantize(self, body, params):
+        """
+        Return the flosses chosen for the image and their stitch counts as
+        JSON.
+        """
+        # pylint: disable=import-outside-toplevel
+        from crosstitch_helper.quantizer import Quantizer
+
+        if self._floss_palette is None:
+            raise RequestError(404, "no floss palette loaded")
+        quantizer = Quantizer(self._floss_palette,
+                              _number(params, "colours", int, 16, minimum=1),
+                              random_state=_number(params, "seed", int, 0))
+        quantized = quantizer.quantize(ImageTool(io.BytesIO(body)),
+                                       dither=params.get("dither", "none"))
+        counts = quantized.colour_counts()
+        flosses = [dict(floss.to_dict(),
+                        stitches=counts.get(floss.color.lower(), 0))
+                   for floss in quantizer.palette.colors]
+        return _json({"flosses": flosses,
+                      "palette": quantizer.palette.to_chart_palette()})
+
+    def _chart(self, body, params):
+        """
+        Return the chart of the image as PDF, or one page of it as SVG.
+        """
+        # pylint: disable=import-outside-toplevel
+        from crosstitch_helper.vector_chart import VectorChartWriter
+
+        writer = VectorChartWriter(
+            ImageTool(io.BytesIO(body)), self._palette(params),
+            page_width=_number(params, "page_width", int, 50),
+            page_height=_number(params, "page_height", int, 80))
+        if params.get("format", "pdf") == "svg":
+            page = _number(params, "page", int, 0)
+            if not 0 <= page < len(writer.pages()):
+                raise RequestError(404, "no page {}".format(page))
+            return 200, "image/svg+xml", writer.svg_page(page).encode()
+        output = io.BytesIO()
+        writer.write_pdf(output)
+        return 200, "application/pdf", output.getvalue()
+
+    def _preview(self, body, params):
+        """
+        Create a preview of the image, or find an existing one, and return
+        its id and zoom levels as JSON.
+        """
+        preview_id = hashlib.sha256(body + repr(sorted(
+            params.items())).encode()).hexdigest()[:32]
+        pyramid = self.previews.get(preview_id)
+        if pyramid is None:
+            palette = None
+            if _number(params, "floss", int, 0):
+                if self._floss_palette is None:
+                    raise RequestError(404, "no floss palette loaded")
+                palette = self._floss_palette
+            pyramid = PreviewPyramid(
+                ImageTool(io.BytesIO(body)), palette=palette,
+                texture=_number(params, "texture", int, 0) > 0)
+            self.previews.put(preview_id, pyramid)
+        return _json({
+            "id": preview_id,
+            "tile_size": pyramid.tile_size,
+            "tile_url": _TILE_PREFIX + preview_id +
+                        "/{level}/{column}/{row}.png",
+            "levels": [{"level": level,
+                        "size": pyramid.level_size(level),
+                        "tiles": pyramid.tile_counts(level)}
+                       for level in range(pyramid.levels)]})
+
+    def _preview_tile(self, tile_path):
+        """
+        Return a preview tile given as `ID/LEVEL/COLUMN/ROW.png`.
+        """
+        parts = tile_path.split("/")
+        if len(parts) != 4 or not parts[3].endswith(".png"):
+            return _error(404, "tiles are at ID/LEVEL/COLUMN/ROW.png")
+        pyramid = self.previews.get(parts[0])
+        if pyramid is None:
+            return _error(404, "unknown preview {}, POST the image to "
+                          "/preview again".format(parts[0]))
+        try:
+            return 200, "image/png", pyramid.tile(
+                int(parts[1]), int(parts[2]), int(parts[3][:-len(".png")]))
+        except ValueError as error:
+            return _error(404, str(error))
+
+
+async def _read_request(reader):
+    """
+    Read an HTTP request and return `(method, path, params, body)`.
+
+    The request line and headers, and then the body, must each arrive within
+    `READ_TIMEOUT` seconds, so that slow clients do not hold connections
+    indefinitely.
+    """
+    try:
+        method, target, headers = await asyncio.wait_for(_read_head(reader),
+                                                         READ_TIMEOUT)
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError as error:
+            raise RequestError(400, "invalid Content-Length") from error
+        if length > MAX_BODY_SIZE:
+            raise RequestError(413, "images are limited to {} bytes"
+                               "".format(MAX_BODY_SIZE))
+        body = await asyncio.wait_for(reader.readexactly(length),
+                                      READ_TIMEOUT)
+    except asyncio.TimeoutError as error:
+        raise RequestError(408, "request not received within {} seconds"
+                           "".format(READ_TIMEOUT)) from error
+    url = urllib.parse.urlsplit(target)
+    params = dict(urllib.parse.parse_qsl(url.query))
+    return method.upper(), url.path, params, body
+
+
+async def _read_head(reader):
+    """
+    Read the request line and headers of an HTTP request and return
+    `(method, target, headers)`.
+    """
+    request_line = (await reader.readline()).decode("latin-1").split()
+    if len(request_line) != 3:
+        raise RequestError(400, "malformed request")
+    method, target, _ = request_line
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return method, target, headers
+
+
+def _number(params, name, kind, default, minimum=None):
+    """
+    Return a numeric query parameter, or `default` if it is not given.
+
+    :minimum: Optional smallest allowed value
+    """
+    if name not in params:
+        return default
+    try:
+        value = kind(params[name])
+    except ValueError as error:
+        raise RequestError(400, "invalid {}: {}".format(
+            name, params[name])) from error
+    if minimum is not None and value < minimum:
+        raise RequestError(400, "{} must be at least {}".format(name,
+                                                                minimum))
+    return value
+
+
+def _json(content, status=200):
+    """
+    Return a JSON response.
+    """
+    return status, "application/json", json.dumps(content).encode()
+
+
+def _error(status, message, **details):
+    """
+    Return a JSON error response.
+    """
+    return _json(dict(details, error=message), status)
@@ -0,0 +1,79 @@
+"""
+Measurement of the time spent importing modules.
+"""
+
+import builtins
+import importlib.util
+import time
+
+
+class ImportTimer():
+    """
+    Record the time taken by each top-level import while the timer is active.
+
+    Time spent in nested imports is included in the time of the import that
+    triggered them.
+    """
+
+    def __init__(self):
+        """
+        Create a new, stopped timer.
+        """
+        self.timings = {}
+        self._depth = 0
+        self._original_import = None
+
+    def start(self):
+        """
+        Start recording imports.
+        """
+        self._original_import = builtins.__import__
+        builtins.__import__ = self._timed_import
+
+    def stop(self):
+        """
+        Stop recording imports.
+        """
+        if self._original_import is not None:
+            builtins.__import__ = self._original_import
+            self._original_import = None
+
+    def total(self):
+        """
+        Return the total time spent in recorded imports, in seconds.
+        """
+        return sum(self.timings.values())
+
+    def report(self, limit=15):
+        """
+        Return a string listing the slowest imports.
+
+        :limit: Maximum number of modules listed
+        """
+        slowest = sorted(self.timings.items(), key=lambda item: item[1],
+                         reverse=True)[:limit]
+        lines = ["{:8.1f} ms\t{}".format(1000 * seconds, name)
+                 for name, seconds in slowest if seconds >= 0.00005]
+        lines.append("{:8.1f} ms\ttotal".format(1000 * self.total()))
+        return "\n".join(lines)
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(),
+                      level=0):
+        """
+        Replacement for `builtins.__import__` that records import times.
+        """
+        # pylint: disable=redefined-builtin
+        self._depth += 1
+        start = time.perf_counter()
+        try:
+            return self._original_import(name, globals, locals, fromlist,
+                                         level)
+        finally:
+            self._depth -= 1
+            if self._depth == 0:
+                elapsed = time.perf_counter() - start
+                if level:
+                    package = (globals or {}).get("__package__")
+                    name = importlib.util.resolve_name(
+                        "." * level + name, package)
+                self.timings[name] = self.timings.get(name, 0) + elapsed
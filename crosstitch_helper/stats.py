@@ -0,0 +1,131 @@
+"""
+Collection of run time statistics: stage timings, counters and memory use.
+
+The modules record their work in the shared `STATS` collector through the
+`timer` and `count` functions. Collection is disabled by default, in which
+case recording costs only a function call.
+"""
+
+import contextlib
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+class Stats():
+    """
+    Collector of stage timings and counters.
+    """
+
+    def __init__(self):
+        """
+        Create a new, disabled collector.
+        """
+        self.enabled = False
+        self.timings = {}
+        self.counters = {}
+
+    def reset(self):
+        """
+        Forget everything recorded so far.
+        """
+        self.timings = {}
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """
+        Context manager adding the time spent within it to a stage.
+
+        Stages can be entered several times; the times and the number of calls
+        are summed.
+
+        :stage: name of the stage
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds, calls = self.timings.get(stage, (0.0, 0))
+            self.timings[stage] = (seconds + time.perf_counter() - start,
+                                   calls + 1)
+
+    def count(self, counter, value=1):
+        """
+        Add a value to a counter.
+
+        :counter: name of the counter
+        :value: amount added
+        """
+        if self.enabled:
+            self.counters[counter] = self.counters.get(counter, 0) + int(value)
+
+    def to_dict(self):
+        """
+        Return the statistics as a JSON serialisable dict.
+        """
+        return {"stages": {stage: {"seconds": seconds, "calls": calls}
+                           for stage, (seconds, calls)
+                           in self.timings.items()},
+                "counters": dict(self.counters),
+                "peak_rss_bytes": peak_rss()}
+
+    def report(self):
+        """
+        Return the statistics as human readable text.
+        """
+        lines = ["Stage timings:"]
+        lines.extend("{:10.1f} ms\t{}{}".format(
+            1000 * seconds, stage,
+            "" if calls == 1 else " ({} calls)".format(calls))
+                     for stage, (seconds, calls) in self.timings.items())
+        if self.counters:
+            lines.append("Counters:")
+            lines.extend("{:>13}\t{}".format(value, counter)
+                         for counter, value in self.counters.items())
+        if peak_rss() is not None:
+            lines.append("Peak RSS: {:.1f} MB".format(peak_rss() / (1 << 20)))
+        return "\n".join(lines)
+
+    def report_json(self):
+        """
+        Return the statistics as a JSON string.
+        """
+        return json.dumps(self.to_dict(), indent=4)
+
+
+def peak_rss():
+    """
+    Return the peak resident set size of the process in bytes, or None if it
+    is not available.
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+STATS = Stats()
+
+
+def timer(stage):
+    """
+    Time a stage using the shared collector. See `Stats.timer`.
+    """
+    return STATS.timer(stage)
+
+
+def count(counter, value=1):
+    """
+    Add to a counter of the shared collector. See `Stats.count`.
+    """
+    STATS.count(counter, value)
@@ -1,3 +1,11 @@
+"""
+Tools for counting stitches in a pattern
+"""
+
+import math
+
+from crosstitch_helper import stats
+
 
 class StitchCounter():
     """
@@ -8,8 +16,12 @@ class StitchCounter():
         """
         Create a new StitchCounter instance.
 
-        :stitch_iterator: iterator that yields hex strings for each stitch in
-                          the pattern
+        :stitch_iterator: an `ImageTool` (or other object providing
+                          `colour_counts`) for the pattern, or a callable
+                          returning an iterator that yields hex strings for
+                          each stitch in the pattern. If the object provides
+                          `runs`, the stitches are counted from the
+                          run-length encoded image.
         :palette: colour palette that holds the symbols for each colour
         """
         self._stitch_iterator = stitch_iterator
@@ -25,12 +37,34 @@ class StitchCounter():
         """
         if not self.stitch_count:
             self.stitch_count = {}
-            for hexvalue in self._stitch_iterator():
-                if hexvalue not in self._palette:
-                    raise ValueError("Colour {} found in the pattern image, "
-                                     "not found in the colour palette."
-                                     "".format(hexvalue))
-                self._add_stitch(hexvalue)
+            with stats.timer("count stitches"):
+                if hasattr(self._stitch_iterator, "colour_counts"):
+                    self._count_from_colour_counts()
+                    return
+                for hexvalue in self._stitch_iterator():
+                    self._check_in_palette(hexvalue)
+                    self._add_stitch(hexvalue)
+
+    def _count_from_colour_counts(self):
+        """
+        Set stitch counts using the per-colour counts of the stitch source.
+        """
+        source = self._stitch_iterator
+        if hasattr(source, "runs"):
+            source = source.runs()
+        counts = source.colour_counts()
+        for hexvalue in counts:
+            self._check_in_palette(hexvalue)
+        self.stitch_count = dict(counts)
+
+    def _check_in_palette(self, hexvalue):
+        """
+        Raise ValueError if the given colour is not in the palette.
+        """
+        if hexvalue not in self._palette:
+            raise ValueError("Colour {} found in the pattern image, "
+                             "not found in the colour palette."
+                             "".format(hexvalue))
 
     def _needs_stitch_count(func, *args, **kwargs):
         """
@@ -79,3 +113,13 @@ class StitchCounter():
         :colour: hex value for the colour of interest
         """
         return self.stitch_count.get(colour, 0)
+
+
+def skein_count(stitches, stitches_per_skein):
+    """
+    Return the number of skeins needed for the given number of stitches.
+
+    :stitches: number of stitches
+    :stitches_per_skein: how many stitches can one skein of thread make
+    """
+    return math.ceil(1.0 * stitches / stitches_per_skein)
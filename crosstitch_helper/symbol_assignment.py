@@ -0,0 +1,188 @@
+"""
+Choice of chart symbols and symbol colours for the colours of a pattern.
+
+Symbols are assigned so that colours which are close to each other in CIELab
+space, and thus easy to confuse on the fabric, get glyphs that look different.
+Glyph shapes are compared as small bitmaps, and all comparisons are made with
+distance matrices instead of comparing pairs one at a time.
+"""
+
+import functools
+
+import numpy as np
+
+from crosstitch_helper import color_space
+
+BITMAP_SIZE = 24
+NEIGHBOURS = 16
+SIMILARITY_SCALE = 10.0  # Delta E at which colours count as clearly different
+MAX_COLOURS = 4096  # more colours than this get the symbols in order
+_WHITE_LUMINANCE_LIMIT = 0.1791  # equal contrast against black and white
+
+
+def symbol_colours(rgb):
+    """
+    Return a black or white symbol colour for each colour.
+
+    The one with the higher WCAG contrast ratio to the colour is chosen.
+
+    :rgb: array of shape (n, 3) of RGB values (0-255)
+    """
+    luminance = color_space.relative_luminance(np.reshape(rgb, (-1, 3)))
+    return np.where(luminance < _WHITE_LUMINANCE_LIMIT,
+                    "#ffffff", "#000000").tolist()
+
+
+def assign_symbols(rgb, symbols):
+    """
+    Return a symbol for each colour, giving similar colours distinct glyphs.
+
+    Colours are handled starting from those with the closest neighbours. Each
+    colour gets the unused glyph least similar to the glyphs of its nearest
+    already handled colours, weighted by how close those colours are. Earlier
+    symbols in `symbols` are preferred when there is a tie. Symbols are only
+    reused when there are more colours than distinct symbols.
+
+    With more than `MAX_COLOURS` colours, e.g. for unquantized photos, the
+    symbols are simply used in order, repeating as needed, as comparing all
+    the colours would take too much time and memory.
+
+    :rgb: array of shape (n, 3) of RGB values (0-255) of the colours
+    :symbols: sequence of available symbols, in order of preference
+    :returns: list of n symbols
+    """
+    rgb = np.reshape(rgb, (-1, 3))
+    pool = list(dict.fromkeys(symbols))[:max(2 * len(rgb), 1)]
+    if not len(rgb):
+        return []
+    if len(rgb) > MAX_COLOURS:
+        return [symbols[index % len(symbols)] for index in range(len(rgb))]
+    similarity = glyph_similarity(glyph_bitmaps(pool))
+    neighbours, distances = _nearest_neighbours(color_space.rgb_to_lab(rgb),
+                                                NEIGHBOURS)
+    weights = np.exp(-(distances / SIMILARITY_SCALE) ** 2)
+    # tiny preference for earlier symbols to break ties
+    preference = np.arange(len(pool)) * 1e-9
+    assigned = np.full(len(rgb), -1)
+    used = np.zeros(len(pool), dtype=bool)
+    for colour in np.argsort(distances[:, 0], kind="stable"):
+        neighbour_glyphs = assigned[neighbours[colour]]
+        known = neighbour_glyphs >= 0
+        penalty = similarity[:, neighbour_glyphs[known]] @ \
+            weights[colour, known] + preference
+        if not used.all():
+            penalty[used] = np.inf
+        glyph = int(np.argmin(penalty))
+        assigned[colour] = glyph
+        used[glyph] = True
+    return [pool[glyph] for glyph in assigned]
+
+
+def glyph_bitmaps(symbols, size=BITMAP_SIZE):
+    """
+    Return the shapes of symbols as flattened boolean bitmaps.
+
+    The symbols are drawn centred at the size used in charts. Symbols missing
+    from the font come out as the same placeholder shape.
+
+    :symbols: sequence of symbols
+    :size: side length of the bitmaps in pixels
+    :returns: array of shape (len(symbols), size * size)
+    """
+    return np.array([_glyph_bitmap(symbol, size) for symbol in symbols])
+
+
+@functools.lru_cache(maxsize=None)
+def _glyph_bitmap(symbol, size):
+    """
+    Return the bitmap of one symbol. See `glyph_bitmaps`.
+    """
+    # pylint: disable=import-outside-toplevel
+    from matplotlib.textpath import TextPath
+    from crosstitch_helper.chart_renderer import SYMBOL_SIZE
+
+    path = TextPath((0, 0), symbol, size=SYMBOL_SIZE)
+    inside = np.zeros(size * size, dtype=bool)
+    if not len(path.vertices):
+        return inside
+    # centred on the control points, which is close enough for comparing
+    # shapes and much faster than the exact extents of the curves
+    center = (path.vertices.min(axis=0) + path.vertices.max(axis=0)) / 2
+    coordinates = (np.arange(size) + 0.5) / size * 1.2 * SYMBOL_SIZE \
+        - 0.6 * SYMBOL_SIZE
+    x, y = np.meshgrid(coordinates + center[0], coordinates + center[1])
+    # outlines are combined using the even-odd rule, which leaves holes in
+    # glyphs such as "O" empty
+    for polygon in path.to_polygons(closed_only=True):
+        if len(polygon) >= 3:
+            inside ^= _polygon_contains(polygon, x.ravel(), y.ravel())
+    return inside
+
+
+def _polygon_contains(polygon, x, y):
+    """
+    Return which points are inside a polygon using the even-odd rule.
+    """
+    start = polygon
+    end = np.roll(polygon, -1, axis=0)
+    crosses = (start[:, 1][:, np.newaxis] > y) != \
+        (end[:, 1][:, np.newaxis] > y)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        crossing_x = start[:, 0][:, np.newaxis] + \
+            (y - start[:, 1][:, np.newaxis]) * \
+            ((end[:, 0] - start[:, 0]) / (end[:, 1] - start[:, 1]))[
+                :, np.newaxis]
+    return np.count_nonzero(crosses & (x < crossing_x), axis=0) % 2 == 1
+
+
+def glyph_similarity(bitmaps):
+    """
+    Return a matrix of the similarity (0-1) of each pair of glyph bitmaps.
+
+    The similarity is one minus the number of differing pixels relative to
+    the total number of set pixels in both bitmaps, so identical glyphs have
+    similarity 1 and glyphs with no common pixels 0.
+
+    :bitmaps: array of flattened bitmaps, as returned by `glyph_bitmaps`
+    """
+    bitmaps = np.asarray(bitmaps, dtype=np.float32)
+    overlap = bitmaps @ bitmaps.T
+    areas = np.diag(overlap)
+    total = areas[:, np.newaxis] + areas[np.newaxis, :]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        similarity = 2 * overlap / total
+    similarity[total == 0] = 1.0
+    return similarity
+
+
+def _nearest_neighbours(lab, count, chunk_size=256):
+    """
+    Return the indices and distances of the nearest other colours.
+
+    Distances are Euclidean distances in CIELab space (CIE 1976 Delta E).
+    Both arrays have shape (n, min(count, n - 1)) and are ordered from the
+    nearest. A colour without neighbours gets an infinite distance to itself.
+
+    :lab: array of shape (n, 3) of Lab coordinates
+    :count: number of neighbours per colour
+    """
+    count = min(count, len(lab) - 1)
+    if count < 1:
+        return (np.zeros((len(lab), 1), dtype=np.intp),
+                np.full((len(lab), 1), np.inf))
+    indices = np.empty((len(lab), count), dtype=np.intp)
+    distances = np.empty((len(lab), count))
+    for start in range(0, len(lab), chunk_size):
+        chunk = lab[start:start + chunk_size]
+        squared = ((chunk[:, np.newaxis, :] - lab[np.newaxis, :, :]) ** 2
+                   ).sum(axis=2)
+        squared[np.arange(len(chunk)), np.arange(start, start + len(chunk))] \
+            = np.inf
+        nearest = np.argpartition(squared, count - 1, axis=1)[:, :count]
+        nearest_squared = np.take_along_axis(squared, nearest, axis=1)
+        order = np.argsort(nearest_squared, axis=1)
+        indices[start:start + len(chunk)] = np.take_along_axis(nearest, order,
+                                                               axis=1)
+        distances[start:start + len(chunk)] = np.sqrt(
+            np.take_along_axis(nearest_squared, order, axis=1))
+    return indices, distances
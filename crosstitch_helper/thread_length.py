@@ -0,0 +1,272 @@
+"""
+Estimation of the thread needed for a pattern from the layout of its stitches.
+
+A flat number of stitches per skein underestimates the thread of patterns
+with many small areas and scattered stitches: every area has edges where the
+thread turns, and every new start needs thread for securing the ends. The
+estimate here is made per connected area of each colour:
+
+* thread for the stitches themselves,
+* a turning allowance for each edge between the area and other colours,
+* thread carried on the back along a row to another area of the same colour,
+  when it is at most `max_carry` stitches away,
+* the tails for starting and finishing each separate thread.
+
+The areas are found by labelling the runs of the run-length encoded image as
+a graph, so all colours are labelled in one pass without visiting each
+stitch more than a few times.
+"""
+
+import numpy as np
+
+from crosstitch_helper import stats
+
+FABRIC_COUNT = 14  # stitches per inch
+STRANDS = 2  # strands of floss used for stitching
+SKEIN_LENGTH = 800.0  # cm of six-stranded floss in a skein
+SKEIN_STRANDS = 6
+# thread per full cross stitch in units of stitch width, including the back
+# and passing through the fabric; about 1800 stitches per skein on 14-count
+# with two strands
+THREAD_PER_STITCH = 7.35
+THREAD_PER_EDGE = 0.5  # turning allowance per exposed stitch edge
+TAIL_LENGTH = 5.0  # cm for securing the start and end of a thread
+MAX_CARRY = 5  # stitches a thread is carried on the back to the next area
+PAIR_BLOCK = 1 << 16  # runs compared to the next row at a time
+
+
+class ThreadEstimator():
+    """
+    Estimate thread lengths and skeins for each colour of a pattern.
+
+    Stitches touching at a side or a corner belong to the same area, as the
+    thread can go on from one to the other.
+    """
+
+    def __init__(self, runs, fabric_count=FABRIC_COUNT, strands=STRANDS,
+                 max_carry=MAX_CARRY):
+        """
+        Create a new estimator.
+
+        :runs: `RunLengthImage` of the pattern, e.g. from `ImageTool.runs`
+        :fabric_count: stitches per inch of the fabric
+        :strands: number of strands of floss used for stitching
+        :max_carry: longest distance in stitches that the thread is carried
+                    on the back instead of starting a new thread
+        """
+        self._runs = runs
+        self.fabric_count = fabric_count
+        self.strands = strands
+        self.max_carry = max_carry
+        self._colour_stats = None
+
+    def colour_stats(self):
+        """
+        Return a dict mapping hex value of each colour to a dict of its
+        statistics, in the order of `RunLengthImage.codes`:
+
+        * `stitches`: number of stitches
+        * `areas`: number of connected areas
+        * `perimeter`: number of stitch edges next to other colours or the
+          edge of the pattern
+        * `travel`: stitches the thread is carried on the back between areas
+        * `starts`: number of separate threads
+        * `length`: estimated thread length in centimetres
+        * `skeins`: estimated number of skeins
+        """
+        if self._colour_stats is None:
+            with stats.timer("estimate thread"):
+                self._colour_stats = self._calculate()
+        return self._colour_stats
+
+    def thread_lengths(self):
+        """
+        Return a dict mapping hex value of each colour to the estimated thread
+        length in centimetres.
+        """
+        return {colour: values["length"]
+                for colour, values in self.colour_stats().items()}
+
+    def skein_counts(self):
+        """
+        Return a dict mapping hex value of each colour to the estimated number
+        of skeins.
+        """
+        return {colour: values["skeins"]
+                for colour, values in self.colour_stats().items()}
+
+    def _calculate(self):
+        """
+        Calculate the statistics returned by `colour_stats`.
+        """
+        # pylint: disable=import-outside-toplevel
+        from scipy.sparse.csgraph import connected_components
+
+        runs = self._runs
+        colour_count = len(runs.codes)
+        upper, lower, overlaps = touching_runs(runs)
+        area_count, labels = connected_components(
+            _graph(upper, lower, runs.run_count()), directed=False)
+        stats.count("thread areas", area_count)
+        area_colours = np.zeros(area_count, dtype=np.int64)
+        area_colours[labels] = runs.colours
+
+        first, second, gaps = row_carries(runs, self.max_carry)
+        joined = labels[first] != labels[second]
+        thread_count, threads = connected_components(
+            _graph(labels[first][joined], labels[second][joined],
+                   area_count), directed=False)
+        thread_colours = np.zeros(thread_count, dtype=np.int64)
+        thread_colours[threads] = area_colours
+
+        totals = {
+            "stitches": np.bincount(runs.colours, weights=runs.lengths,
+                                    minlength=colour_count),
+            "areas": np.bincount(area_colours, minlength=colour_count),
+            "perimeter": np.bincount(
+                runs.colours, weights=run_perimeters(runs, upper, lower,
+                                                     overlaps),
+                minlength=colour_count),
+            "starts": np.bincount(thread_colours, minlength=colour_count),
+        }
+        # each carry joins two threads; its length is taken as the average
+        # gap between runs of different areas of the colour
+        carry_colours = runs.colours[first][joined]
+        gap_counts = np.bincount(carry_colours, minlength=colour_count)
+        gap_sums = np.bincount(carry_colours, weights=gaps[joined],
+                               minlength=colour_count)
+        totals["travel"] = (totals["areas"] - totals["starts"]) * \
+            gap_sums / np.maximum(gap_counts, 1)
+
+        stitch_width = 2.54 / self.fabric_count
+        lengths = stitch_width * (THREAD_PER_STITCH * totals["stitches"] +
+                                  THREAD_PER_EDGE * totals["perimeter"] +
+                                  totals["travel"]) + \
+            TAIL_LENGTH * totals["starts"]
+        skein_yield = SKEIN_LENGTH * SKEIN_STRANDS / self.strands
+        columns = {
+            "stitches": totals["stitches"].astype(np.int64).tolist(),
+            "areas": totals["areas"].tolist(),
+            "perimeter": totals["perimeter"].astype(np.int64).tolist(),
+            "travel": totals["travel"].tolist(),
+            "starts": totals["starts"].tolist(),
+            "length": lengths.tolist(),
+            "skeins": np.ceil(lengths / skein_yield).astype(np.int64).tolist(),
+        }
+        names = list(columns)
+        result = {colour: dict(zip(names, values)) for colour, values in zip(
+            runs.hex_values(), zip(*columns.values()))}
+        return result
+
+
+def touching_runs(runs):
+    """
+    Return the pairs of runs of the same colour touching each other.
+
+    Runs in adjacent rows touch when they overlap or meet at a corner, that
+    is when each starts at most at the end of the other. As the runs of a row
+    are in order, the runs of the next row touching a run are consecutive,
+    and the first and last of them are found by searching the run starts and
+    ends of the next row. Positions are numbered across rows with a gap of
+    two columns between rows, so all rows are searched at once.
+
+    :runs: `RunLengthImage` of the pattern
+    :returns: tuple of arrays `(upper, lower, overlaps)` holding the run in
+              the upper row, the run in the lower row and the number of
+              columns they overlap (0 for runs meeting at a corner)
+    """
+    if runs.height < 2 or not runs.run_count():
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    stride = runs.width + 2
+    run_rows = np.repeat(np.arange(runs.height), np.diff(runs.row_offsets))
+    starts = run_rows * stride + runs.starts
+    ends = starts + runs.lengths
+    # runs of all rows but the last are compared to the runs from the
+    # second row on, in blocks to bound the size of the candidate pairs
+    below = runs.row_offsets[1]
+    above = runs.row_offsets[-2]
+    pairs = []
+    for block in range(0, above, PAIR_BLOCK):
+        upper = np.arange(block, min(block + PAIR_BLOCK, above))
+        first = np.searchsorted(ends[below:], starts[upper] + stride,
+                                side="left")
+        counts = np.searchsorted(starts[below:], ends[upper] + stride,
+                                 side="right") - first
+        lower = np.arange(counts.sum()) - np.repeat(
+            np.cumsum(counts) - counts, counts)
+        lower += np.repeat(first + below, counts)
+        upper = np.repeat(upper, counts)
+        same = runs.colours[upper] == runs.colours[lower]
+        upper, lower = upper[same], lower[same]
+        overlaps = np.maximum(
+            np.minimum(ends[upper], ends[lower] - stride) -
+            np.maximum(starts[upper], starts[lower] - stride), 0)
+        pairs.append((upper, lower, overlaps))
+    return tuple(np.concatenate(part) for part in zip(*pairs))
+
+
+def run_perimeters(runs, upper, lower, overlaps):
+    """
+    Return the number of exposed stitch edges of each run.
+
+    An edge is exposed if the stitch on the other side has another colour or
+    if it is at the edge of the pattern. Runs are as long as possible, so both
+    of their ends are always exposed.
+
+    :runs: `RunLengthImage` of the pattern
+    :upper, lower, overlaps: touching runs, as returned by `touching_runs`
+    """
+    covered = np.bincount(upper, weights=overlaps,
+                          minlength=runs.run_count()) + \
+        np.bincount(lower, weights=overlaps, minlength=runs.run_count())
+    return 2 * runs.lengths.astype(np.int64) + 2 - covered.astype(np.int64)
+
+
+def row_carries(runs, max_carry):
+    """
+    Return the runs from which the thread can be carried along the row to
+    the next run of the same colour.
+
+    The next run of the same colour at most `max_carry` stitches away is at
+    most `max_carry + 1` runs further, as each run is at least one stitch
+    long, so only that many neighbours are compared.
+
+    :runs: `RunLengthImage` of the pattern
+    :max_carry: longest gap in stitches the thread is carried over
+    :returns: tuple of arrays `(first, second, gaps)` holding the run the
+              thread is carried from, the run it is carried to and the number
+              of stitches between them
+    """
+    run_count = runs.run_count()
+    run_rows = np.repeat(np.arange(runs.height), np.diff(runs.row_offsets))
+    starts = runs.starts.astype(np.int64)
+    ends = starts + runs.lengths
+    found = np.zeros(run_count, dtype=bool)
+    first, second, gaps = [], [], []
+    for step in range(1, min(max_carry + 2, run_count)):
+        gap = starts[step:] - ends[:-step]
+        matches = np.flatnonzero(
+            ~found[:-step] & (gap <= max_carry) &
+            (run_rows[step:] == run_rows[:-step]) &
+            (runs.colours[step:] == runs.colours[:-step]))
+        found[matches] = True
+        first.append(matches)
+        second.append(matches + step)
+        gaps.append(gap[matches])
+    if not first:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    return (np.concatenate(first), np.concatenate(second),
+            np.concatenate(gaps))
+
+
+def _graph(sources, targets, size):
+    """
+    Return a sparse adjacency matrix with the given edges.
+    """
+    # pylint: disable=import-outside-toplevel
+    from scipy.sparse import coo_matrix
+
+    return coo_matrix((np.ones(len(sources), dtype=np.int8),
+                       (sources, targets)), shape=(size, size))
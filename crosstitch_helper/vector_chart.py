@@ -0,0 +1,371 @@
+"""
+Cross stitch charts written directly as PDF or SVG vector graphics.
+
+Instead of drawing every stitch, each row of a page is divided into runs of
+stitches of the same colour. A run is drawn as one rectangle filled with its
+colour and once more with a repeating pattern of its symbol, so the size of
+the output and the time taken grow with the number of runs, not the number
+of stitches. Each symbol outline is written only once per file, as a pattern
+that is referenced by every run of the colour.
+"""
+
+import os
+import zlib
+
+import numpy as np
+
+from crosstitch_helper.chart_renderer import (INCHES_PER_STITCH, page_bounds,
+                                              page_file_name, symbol_path)
+from crosstitch_helper.imagetool import code_to_hex, pack_rgb
+from crosstitch_helper.pdf_writer import PdfWriter
+from crosstitch_helper.run_length import row_runs
+
+CELL_SIZE = 72 * INCHES_PER_STITCH  # points
+MARGIN = 36  # points
+LABEL_SIZE = 7  # points
+MINOR_GRID = (0.7, 0.4)  # grey level, line width in points
+MAJOR_GRID = (0.2, 1.0)
+_DIGIT_WIDTH = 0.556  # width of Helvetica digits relative to the font size
+
+
+class VectorChartWriter():
+    """
+    Write the pattern as pages of symbol charts in PDF or SVG format.
+    """
+
+    def __init__(self, image_tool, palette, page_width=50, page_height=80):
+        """
+        Create a new writer.
+
+        :image_tool: `ImageTool` for the pattern image
+        :palette: colour palette that holds the symbols for each colour, e.g.
+                  from conf/palettes.py, or a `Palette` of flosses
+        :page_width: width of one page in stitches
+        :page_height: height of one page in stitches
+        """
+        if hasattr(palette, "to_chart_palette"):
+            palette = palette.to_chart_palette()
+        self._image_tool = image_tool
+        self._palette = palette
+        self.page_width = page_width
+        self.page_height = page_height
+
+    def pages(self):
+        """
+        Return a list of the pages in the chart.
+
+        The pages are the same as those of `ChartRenderer.pages`.
+        """
+        height, width = self._image_tool.colour_values().shape[:2]
+        return page_bounds(width, height, self.page_width, self.page_height)
+
+    def page_size(self):
+        """
+        Return the width and height of the pages in points.
+        """
+        return (2 * MARGIN + self.page_width * CELL_SIZE,
+                2 * MARGIN + self.page_height * CELL_SIZE)
+
+    def write_pdf(self, output):
+        """
+        Write all pages into one PDF file.
+
+        Each page is written to the file as soon as it has been generated, so
+        only one page is held in memory at a time.
+
+        :output: path or binary file object of the output PDF
+        :returns: number of pages written
+        """
+        if not hasattr(output, "write"):
+            with open(output, "wb") as outfile:
+                return self.write_pdf(outfile)
+        pdf = PdfWriter(output)
+        catalog, pages_tree, font = pdf.reserve(), pdf.reserve(), pdf.reserve()
+        pdf.write_object(font, b"<< /Type /Font /Subtype /Type1 "
+                         b"/BaseFont /Helvetica >>")
+        patterns = {}
+        kids = []
+        width, height = self.page_size()
+        for page in self.pages():
+            runs = self._page_runs(page)
+            for hexvalue in runs:
+                if hexvalue not in patterns:
+                    patterns[hexvalue] = pdf.reserve()
+                    pdf.write_object(patterns[hexvalue],
+                                     *self._pdf_pattern(hexvalue))
+            content = pdf.reserve()
+            pdf.write_object(content, b"<< /Filter /FlateDecode >>",
+                             zlib.compress(self._pdf_content(page, runs,
+                                                            patterns)))
+            resources = "/Font << /F1 {} 0 R >> /Pattern << {} >>".format(
+                font, " ".join("/P{} {} 0 R".format(patterns[hexvalue],
+                                                     patterns[hexvalue])
+                               for hexvalue in runs))
+            kids.append(pdf.reserve())
+            pdf.write_object(kids[-1], "<< /Type /Page /Parent {} 0 R "
+                             "/MediaBox [0 0 {:.2f} {:.2f}] "
+                             "/Resources << {} >> /Contents {} 0 R >>".format(
+                                 pages_tree, width, height, resources,
+                                 content).encode())
+        pdf.write_object(pages_tree, "<< /Type /Pages /Kids [{}] /Count {} >>"
+                         "".format(" ".join("{} 0 R".format(kid)
+                                            for kid in kids),
+                                   len(kids)).encode())
+        pdf.write_object(catalog, "<< /Type /Catalog /Pages {} 0 R >>"
+                         "".format(pages_tree).encode())
+        pdf.close(catalog)
+        return len(kids)
+
+    def write_svg(self, directory):
+        """
+        Write each page into its own SVG file, e.g. `page-001.svg`.
+
+        :directory: Output directory, created if it does not exist
+        :returns: list of the paths of the written files
+        """
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for index, page in enumerate(self.pages()):
+            paths.append(os.path.join(directory, page_file_name(index, "svg")))
+            with open(paths[-1], "w", encoding="utf-8") as outfile:
+                outfile.write(self._svg_page(page))
+        return paths
+
+    def svg_page(self, index):
+        """
+        Return the SVG document of one page.
+
+        :index: index of the page in `pages`
+        """
+        return self._svg_page(self.pages()[index])
+
+    def _page_runs(self, page):
+        """
+        Return the runs of each colour on a page.
+
+        Returns a dict mapping the hex value of each colour to a tuple of
+        arrays `(rows, starts, lengths)` of its runs, in page coordinates.
+        """
+        min_x, min_y, max_x, max_y = page
+        codes = pack_rgb(self._image_tool.colour_values()[min_y:max_y,
+                                                          min_x:max_x])
+        rows, starts, lengths, run_codes = row_runs(codes)
+        order = np.argsort(run_codes, kind="stable")
+        boundaries = np.flatnonzero(np.diff(run_codes[order])) + 1
+        runs = {}
+        for group in np.split(order, boundaries):
+            if not len(group):
+                continue
+            hexvalue = code_to_hex(run_codes[group[0]])
+            if hexvalue not in self._palette:
+                raise ValueError("Colour {} found in the pattern image, "
+                                 "not found in the colour palette."
+                                 "".format(hexvalue))
+            runs[hexvalue] = (rows[group], starts[group], lengths[group])
+        return runs
+
+    def _pdf_pattern(self, hexvalue):
+        """
+        Return the dictionary and content of the symbol pattern of a colour.
+        """
+        symbol, symbol_colour = self._palette[hexvalue][:2]
+        content = "{} rg 1 0 0 1 {:.3f} {:.3f} cm {} f".format(
+            _pdf_colour(symbol_colour), CELL_SIZE / 2, CELL_SIZE / 2,
+            _pdf_path(symbol_path(symbol)))
+        # the pattern grid is anchored at the top left corner of the chart
+        header = ("<< /Type /Pattern /PatternType 1 /PaintType 1 "
+                  "/TilingType 1 /BBox [0 0 {cell:.3f} {cell:.3f}] "
+                  "/XStep {cell:.3f} /YStep {cell:.3f} /Resources << >> "
+                  "/Matrix [1 0 0 1 {x:.3f} {y:.3f}] >>".format(
+                      cell=CELL_SIZE, x=MARGIN,
+                      y=self.page_size()[1] - MARGIN))
+        return header.encode(), content.encode()
+
+    def _pdf_content(self, page, runs, patterns):
+        """
+        Return the content stream of a page.
+
+        Patterns are named after their object numbers, given in `patterns`.
+        """
+        min_x, min_y, max_x, max_y = page
+        top = self.page_size()[1] - MARGIN
+        lines = []
+        for hexvalue, (rows, starts, lengths) in runs.items():
+            rectangles = _pdf_rectangles(rows, starts, lengths, top)
+            lines.append("{} rg\n{}f".format(_pdf_colour(hexvalue),
+                                             rectangles))
+            lines.append("/Pattern cs /P{} scn\n{}f".format(
+                patterns[hexvalue], rectangles))
+        width, height = max_x - min_x, max_y - min_y
+        for (grey, line_width), step in ((MINOR_GRID, 1), (MAJOR_GRID, 5)):
+            segments = ["{:.2f} {:.2f} m {:.2f} {:.2f} l".format(
+                MARGIN + column * CELL_SIZE, top,
+                MARGIN + column * CELL_SIZE, top - height * CELL_SIZE)
+                        for column in range(0, width + 1, step)]
+            segments.extend("{:.2f} {:.2f} m {:.2f} {:.2f} l".format(
+                MARGIN, top - row * CELL_SIZE,
+                MARGIN + width * CELL_SIZE, top - row * CELL_SIZE)
+                            for row in range(0, height + 1, step))
+            lines.append("{} G {} w\n{}\nS".format(grey, line_width,
+                                                   "\n".join(segments)))
+        lines.append("0 g BT /F1 {} Tf".format(LABEL_SIZE))
+        for column in range(0, width + 1, 5):
+            label = str(min_x + column)
+            lines.append("1 0 0 1 {:.2f} {:.2f} Tm ({}) Tj".format(
+                MARGIN + column * CELL_SIZE - _label_width(label) / 2,
+                top + LABEL_SIZE / 2, label))
+        for row in range(0, height + 1, 5):
+            label = str(min_y + row)
+            lines.append("1 0 0 1 {:.2f} {:.2f} Tm ({}) Tj".format(
+                MARGIN - LABEL_SIZE / 2 - _label_width(label),
+                top - row * CELL_SIZE - LABEL_SIZE / 3, label))
+        lines.append("ET")
+        return "\n".join(lines).encode()
+
+    def _svg_page(self, page):
+        """
+        Return the SVG document of a page.
+        """
+        min_x, min_y, max_x, max_y = page
+        runs = self._page_runs(page)
+        page_width, page_height = self.page_size()
+        parts = ['<svg xmlns="http://www.w3.org/2000/svg" '
+                 'width="{0:.2f}pt" height="{1:.2f}pt" '
+                 'viewBox="0 0 {0:.2f} {1:.2f}">'.format(page_width,
+                                                         page_height),
+                 "<defs>"]
+        for index, hexvalue in enumerate(runs):
+            symbol, symbol_colour = self._palette[hexvalue][:2]
+            parts.append(
+                '<pattern id="p{index}" patternUnits="userSpaceOnUse" '
+                'x="{margin}" y="{margin}" width="{cell:.3f}" '
+                'height="{cell:.3f}"><path fill="{colour}" '
+                'transform="translate({half:.3f} {half:.3f}) scale(1 -1)" '
+                'd="{path}"/></pattern>'.format(
+                    index=index, margin=MARGIN, cell=CELL_SIZE,
+                    half=CELL_SIZE / 2, colour=symbol_colour,
+                    path=_svg_path(symbol_path(symbol))))
+        parts.append("</defs>")
+        for index, (hexvalue, (rows, starts, lengths)) in enumerate(
+                runs.items()):
+            rectangles = _svg_rectangles(rows, starts, lengths)
+            parts.append('<path fill="{}" d="{}"/>'.format(hexvalue,
+                                                          rectangles))
+            parts.append('<path fill="url(#p{})" d="{}"/>'.format(index,
+                                                                 rectangles))
+        width, height = max_x - min_x, max_y - min_y
+        for (grey, line_width), step in ((MINOR_GRID, 1), (MAJOR_GRID, 5)):
+            segments = ["M{:.2f} {:.2f}V{:.2f}".format(
+                MARGIN + column * CELL_SIZE, MARGIN,
+                MARGIN + height * CELL_SIZE)
+                        for column in range(0, width + 1, step)]
+            segments.extend("M{:.2f} {:.2f}H{:.2f}".format(
+                MARGIN, MARGIN + row * CELL_SIZE, MARGIN + width * CELL_SIZE)
+                            for row in range(0, height + 1, step))
+            parts.append('<path fill="none" stroke="rgb({0},{0},{0})" '
+                         'stroke-width="{1}" d="{2}"/>'.format(
+                             round(255 * grey), line_width, "".join(segments)))
+        parts.append('<g font-family="Helvetica, Arial, sans-serif" '
+                     'font-size="{}">'.format(LABEL_SIZE))
+        parts.extend('<text x="{:.2f}" y="{:.2f}" text-anchor="middle">{}'
+                     '</text>'.format(MARGIN + column * CELL_SIZE,
+                                      MARGIN - LABEL_SIZE / 2, min_x + column)
+                     for column in range(0, width + 1, 5))
+        parts.extend('<text x="{:.2f}" y="{:.2f}" text-anchor="end">{}'
+                     '</text>'.format(
+                         MARGIN - LABEL_SIZE / 2,
+                         MARGIN + row * CELL_SIZE + LABEL_SIZE / 3,
+                         min_y + row)
+                     for row in range(0, height + 1, 5))
+        parts.append("</g>\n</svg>\n")
+        return "\n".join(parts)
+
+
+def _pdf_rectangles(rows, starts, lengths, top):
+    """
+    Return PDF path operators for the rectangles of runs.
+    """
+    return "".join("{:.2f} {:.2f} {:.2f} {:.2f} re\n".format(
+        MARGIN + start * CELL_SIZE, top - (row + 1) * CELL_SIZE,
+        length * CELL_SIZE, CELL_SIZE)
+                   for row, start, length in zip(rows.tolist(),
+                                                 starts.tolist(),
+                                                 lengths.tolist()))
+
+
+def _svg_rectangles(rows, starts, lengths):
+    """
+    Return SVG path data for the rectangles of runs.
+    """
+    return "".join("M{:.2f} {:.2f}h{:.2f}v{:.2f}h{:.2f}z".format(
+        MARGIN + start * CELL_SIZE, MARGIN + row * CELL_SIZE,
+        length * CELL_SIZE, CELL_SIZE, -length * CELL_SIZE)
+                   for row, start, length in zip(rows.tolist(),
+                                                 starts.tolist(),
+                                                 lengths.tolist()))
+
+
+def _pdf_colour(hexvalue):
+    """
+    Return the PDF operands of a "#rrggbb" colour.
+    """
+    value = int(hexvalue.lstrip("#"), 16)
+    return "{:.3f} {:.3f} {:.3f}".format((value >> 16) / 255,
+                                         (value >> 8 & 0xff) / 255,
+                                         (value & 0xff) / 255)
+
+
+def _label_width(label):
+    """
+    Return the approximate width of a numeric label in points.
+    """
+    return len(label) * _DIGIT_WIDTH * LABEL_SIZE
+
+
+def _path_segments(path):
+    """
+    Yield `(operator, points)` of a matplotlib `Path`, with quadratic curves
+    converted to cubic ones. Operators are "M", "L", "C" and "Z".
+    """
+    # pylint: disable=import-outside-toplevel
+    from matplotlib.path import Path
+
+    current = start = np.zeros(2)
+    for vertices, code in path.iter_segments(simplify=False, curves=True):
+        points = vertices.reshape(-1, 2)
+        if code == Path.MOVETO:
+            current = start = points[-1]
+            yield "M", points
+        elif code == Path.LINETO:
+            current = points[-1]
+            yield "L", points
+        elif code == Path.CURVE3:
+            control, end = points
+            yield "C", np.array([current + 2 / 3 * (control - current),
+                                 end + 2 / 3 * (control - end), end])
+            current = end
+        elif code == Path.CURVE4:
+            current = points[-1]
+            yield "C", points
+        elif code == Path.CLOSEPOLY:
+            current = start
+            yield "Z", points[:0]
+
+
+def _pdf_path(path):
+    """
+    Return PDF path construction operators for a matplotlib `Path`.
+    """
+    operators = {"M": "m", "L": "l", "C": "c", "Z": "h"}
+    return " ".join(" ".join(["{:.3f} {:.3f}".format(*point)
+                              for point in points] + [operators[operator]])
+                    for operator, points in _path_segments(path))
+
+
+def _svg_path(path):
+    """
+    Return SVG path data for a matplotlib `Path`.
+    """
+    return "".join(operator + " ".join("{:.3f} {:.3f}".format(*point)
+                                       for point in points)
+                   for operator, points in _path_segments(path))
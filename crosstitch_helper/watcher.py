@@ -0,0 +1,69 @@
+"""
+Polling for changes of a file that is being edited.
+"""
+
+import os
+import time
+
+
+class FileWatcher():
+    """
+    Detect when a file has been saved.
+
+    The file is polled for changes in its modification time and size, which
+    works on every platform and file system. Editors often write a file in
+    several steps, so a change is only reported once the file has stayed the
+    same for the debounce time.
+    """
+
+    def __init__(self, path, interval=0.2, debounce=0.3):
+        """
+        Create a new watcher.
+
+        :path: Location of the watched file
+        :interval: Time between polls in seconds
+        :debounce: Time in seconds the file must stay unchanged after a write
+                   before the change is reported
+        """
+        self.path = path
+        self.interval = interval
+        self.debounce = debounce
+        self._signature = self._current_signature()
+
+    def changes(self):
+        """
+        Yield the time of the last write each time the file has been saved.
+
+        The times are `time.perf_counter` values of when the last write of a
+        burst was detected. Iteration never ends by itself.
+        """
+        while True:
+            yield self.wait_for_change()
+
+    def wait_for_change(self):
+        """
+        Block until the file has changed and stayed unchanged for the debounce
+        time, and return the time the last write was detected.
+        """
+        last_change = None
+        while True:
+            time.sleep(self.interval)
+            signature = self._current_signature()
+            now = time.perf_counter()
+            if signature != self._signature:
+                self._signature = signature
+                last_change = now
+            elif last_change is not None and signature is not None and \
+                    now - last_change >= self.debounce:
+                return last_change
+
+    def _current_signature(self):
+        """
+        Return the modification time and size of the file, or None if it does
+        not exist (e.g. while an editor replaces it).
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
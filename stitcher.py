@@ -1,44 +1,312 @@
 """
 Command line interface for cross stitch pattern creation.
+
+The crosstitch_helper modules (and through them numpy, matplotlib etc.) are
+imported within the commands that need them, so that starting the tool only
+costs what the invoked command uses.
 """
+# pylint: disable=import-outside-toplevel
 
-import math
+import contextlib
+import functools
+import glob
+import os
+import pprint
 import sys
+import time
 import click
 
-from crosstitch_helper.imagetool import ImageTool
-from crosstitch_helper.palette_creator import PaletteCreator
-from crosstitch_helper.stitch_counter import StitchCounter
-
 from conf import palettes
 
+_START_TIME = time.perf_counter()
+
 
 @click.group()
-def cli():
+@click.option("--profile-startup", is_flag=True,
+              help="Report the time spent importing modules")
+@click.pass_context
+def cli(ctx, profile_startup):
     """
     Create a cross stitch pattern from an image.
     """
+    if profile_startup:
+        from crosstitch_helper.startup import ImportTimer
+        timer = ImportTimer()
+        timer.start()
+        ctx.call_on_close(lambda: _report_startup(timer))
+
+
+def _report_startup(timer):
+    """
+    Print the import times recorded by `timer` to stderr.
+    """
+    timer.stop()
+    click.echo("Imports during the command:", err=True)
+    click.echo(timer.report(), err=True)
+    click.echo("Total run time {:.1f} ms (excluding interpreter startup)"
+               "".format(1000 * (time.perf_counter() - _START_TIME)),
+               err=True)
+
+
+def _instrumentation_options(func):
+    """
+    Decorator adding the --stats and --profile options to a command.
+    """
+    @click.option("--stats", "stats_format",
+                  type=click.Choice(["text", "json"]),
+                  help="Report stage timings, counters and peak memory use "
+                  "to stderr in the given format")
+    @click.option("--profile", "profile_file",
+                  type=click.Path(dir_okay=False, writable=True),
+                  help="Profile the command with cProfile and write the "
+                  "statistics to the file (readable with pstats)")
+    @functools.wraps(func)
+    def wrapper(*args, stats_format, profile_file, **kwargs):
+        with _instrumented(stats_format, profile_file):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+@contextlib.contextmanager
+def _instrumented(stats_format, profile_file):
+    """
+    Collect statistics and profile within the context if requested.
+    """
+    from crosstitch_helper import stats
+
+    profiler = None
+    if profile_file:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    stats.STATS.enabled = bool(stats_format)
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+        if stats_format == "json":
+            click.echo(stats.STATS.report_json(), err=True)
+        elif stats_format == "text":
+            click.echo(stats.STATS.report(), err=True)
+
 
 @cli.command()
 @click.argument("image", type=click.File('rb'))
 @click.argument("palette_name")
-@click.option("--stitches-per-skein", type=int, default=1700,
+@click.option("--stitches-per-skein", type=click.IntRange(min=1), default=1700,
               help="How many stitches can one skein of thread make")
-def stitchify(image, palette_name, stitches_per_skein):
+@click.option("--estimate-thread", is_flag=True,
+              help="Estimate thread and skeins from the layout of the "
+              "stitches instead of a flat number of stitches per skein. This "
+              "reads the whole image at once.")
+@click.option("--fabric-count", type=click.IntRange(min=1), default=14,
+              help="Stitches per inch of the fabric, for --estimate-thread")
+@click.option("--strands", type=click.IntRange(min=1), default=2,
+              help="Strands of floss used for stitching, for "
+              "--estimate-thread")
+@click.option("--remap-tolerance", type=float, default=None,
+              help="Replace colours missing from the palette with the "
+              "nearest palette colour if the CIE 1994 colour difference is "
+              "at most this")
+@click.option("--lazy", is_flag=True,
+              help="Process the image in strips from a memory-mapped cache "
+              "instead of holding it in memory")
+@click.option("--state", "state_file", type=click.Path(dir_okay=False),
+              help="File for saving counts between runs, so that only the "
+              "parts of the image changed since the previous run are counted")
+@click.option("--chart-dir", type=click.Path(file_okay=False),
+              help="Directory for the chart, one PDF file per page. With "
+              "--state, only the pages that changed are rendered again.")
+@click.option("--workers", type=int, default=None,
+              help="Number of processes counting (with --parallel) and "
+              "rendering chart pages, defaults to number of CPUs")
+@click.option("--parallel", is_flag=True,
+              help="Count the image in row chunks on a pool of processes")
+@click.option("--progress", is_flag=True,
+              help="Show progress of counting (implies --parallel)")
+@click.option("--run-stats", is_flag=True,
+              help="Show colour changes per row and confetti stitches")
+@_instrumentation_options
+def stitchify(image, palette_name, stitches_per_skein, estimate_thread,
+              fabric_count, strands, remap_tolerance, lazy, state_file,
+              chart_dir, workers, parallel, progress, run_stats):
     """
     Create a cross-stitch pattern from IMAGE using PALETTE.
 
     Palette with the same name must be present in conf/palettes.py.
     """
-    palette = getattr(palettes, palette_name, None)
-    if not palette:
-        click.echo(
-            "palette '{}' not found in conf/palettes.py".format(palette_name))
-        sys.exit(1)
+    # pylint: disable=too-many-arguments, too-many-locals
+    from crosstitch_helper import stats
+    from crosstitch_helper.imagetool import ImageTool
+    from crosstitch_helper.stitch_counter import StitchCounter
+
+    palette = _get_palette(palette_name)
+    image_tool = ImageTool(image, lazy=lazy)
+    try:
+        source = _stitch_source(image_tool, palette, state_file, workers,
+                                parallel, progress)
+        mapping = _check_palette(image_tool, palette, _colour_counts(source),
+                                 remap_tolerance)
+        if state_file:
+            # the state is kept for the image as read, so that unchanged
+            # tiles with replaced colours are not counted again next time
+            source.remap_colours(mapping)
+        elif mapping:
+            source = _stitch_source(image_tool, palette, state_file, workers,
+                                    parallel, progress)
+        changed_tiles = source.changed_tiles if state_file else None
+        counter = StitchCounter(source, palette)
+        counter.count_all_stitches()
+    except KeyboardInterrupt:
+        click.echo("\nCancelled", err=True)
+        sys.exit(130)
+
+    estimator = None
+    if estimate_thread:
+        from crosstitch_helper.thread_length import ThreadEstimator
+        estimator = ThreadEstimator(image_tool.runs(),
+                                    fabric_count=fabric_count,
+                                    strands=strands)
+
+    with stats.timer("output"):
+        if estimator is None:
+            _echo_counts(counter, palette, stitches_per_skein)
+        else:
+            _echo_thread_estimate(counter, palette, estimator)
+        if run_stats:
+            _echo_run_stats(image_tool.runs(), palette)
+
+    if chart_dir:
+        from crosstitch_helper.chart_renderer import ChartRenderer
+        renderer = ChartRenderer(image_tool, palette)
+        pages = None
+        if state_file:
+            pages = _pages_to_render(renderer, changed_tiles, chart_dir)
+        paths = renderer.render_pages(chart_dir, pages=pages, workers=workers)
+        click.echo("Rendered {} chart pages to {}".format(len(paths),
+                                                          chart_dir),
+                   err=True)
+
+
+def _stitch_source(image_tool, palette, state_file, workers, parallel,
+                   progress):
+    """
+    Return the counter of the image colours for `StitchCounter` selected by
+    the options of `stitchify`.
+    """
+    # pylint: disable=too-many-arguments
+    if state_file:
+        from crosstitch_helper.incremental import IncrementalCounter
+        incremental = IncrementalCounter(image_tool, state_file,
+                                         palette=palette)
+        incremental.update()
+        click.echo("Counted {} of {} tiles".format(
+            len(incremental.changed_tiles), incremental.tile_count), err=True)
+        return incremental
+    if parallel or progress:
+        from crosstitch_helper.parallel import ParallelCounter
+        return ParallelCounter(
+            image_tool, workers=workers,
+            progress=_progress_reporter("Counted") if progress else None)
+    return image_tool
+
+
+def _colour_counts(source):
+    """
+    Return the colour counts of the image that `StitchCounter` counts the
+    stitches from.
+    """
+    if hasattr(source, "runs"):
+        source = source.runs()
+    return source.colour_counts()
+
+
+def _check_palette(image_tool, palette, colour_counts, tolerance=None):
+    """
+    Check that all colours of the image are in the palette, or exit with a
+    report of the missing colours.
+
+    Missing colours within `tolerance` of a palette colour are replaced with
+    it first, if `tolerance` is given.
+
+    :colour_counts: colour counts of the image, see `PaletteCheck`
+    :returns: dict mapping hex value of each replaced colour to the hex value
+              of the colour replacing it
+    """
+    from crosstitch_helper.palette_check import PaletteCheck
+
+    check = PaletteCheck(image_tool, palette, colour_counts=colour_counts)
+    missing = check.missing_colours()
+    mapping = {}
+    if tolerance is not None:
+        mapping = check.remapping(tolerance)
+        for colour in missing:
+            if colour["colour"] in mapping:
+                click.echo("Replaced {} with {} ({}), Delta E {:.1f}, {} "
+                           "stitches".format(
+                               colour["colour"], colour["nearest"],
+                               palette[colour["nearest"]][0],
+                               colour["delta_e"], colour["count"]),
+                           err=True)
+        image_tool.remap_colours(mapping)
+        missing = [colour for colour in missing
+                   if colour["colour"] not in mapping]
+    if not missing:
+        return mapping
+    click.echo("{} colours found in the pattern image, not found in the "
+               "colour palette:".format(len(missing)), err=True)
+    for colour in missing:
+        nearest = "" if colour["nearest"] is None else \
+            "\tnearest {} ({}), Delta E {:.1f}".format(
+                colour["nearest"], palette[colour["nearest"]][0],
+                colour["delta_e"])
+        click.echo("{}\t{} stitches\tfirst at x={}, y={}{}".format(
+            colour["colour"], colour["count"], colour["column"],
+            colour["row"], nearest), err=True)
+    sys.exit(1)
+
+
+def _echo_run_stats(runs, palette):
+    """
+    Print statistics of the colour runs of a pattern.
+    """
+    changes = runs.colour_changes_per_row()
+    click.echo()
+    click.echo("Colour changes per row: {:.1f} on average, {} at most, {} in "
+               "total".format(changes.mean() if len(changes) else 0,
+                              changes.max(initial=0), changes.sum()))
+    confetti = runs.confetti_counts()
+    click.echo("Confetti stitches: {}".format(sum(confetti.values())))
+    for colour, count in sorted(confetti.items(), key=lambda item: item[1],
+                                reverse=True):
+        if count:
+            click.echo("{}\t{}".format(palette[colour][0], count))
+
 
-    image_tool = ImageTool(image)
+def _progress_reporter(label):
+    """
+    Return a progress callback printing the completed share, processing rate
+    and estimated time remaining to stderr.
+    """
+    start = time.perf_counter()
+
+    def _report(done, total):
+        elapsed = time.perf_counter() - start
+        rate = done / elapsed if elapsed > 0 else 0
+        remaining = (total - done) / rate if rate else 0
+        click.echo("\r{} {:.0%} ({:.1f} Mpixels/s, ETA {:.0f} s)  ".format(
+            label, done / total if total else 1, rate / 1e6, remaining),
+                   nl=done >= total, err=True)
+    return _report
 
-    counter = StitchCounter(image_tool.iterate_pixels, palette)
+
+def _echo_counts(counter, palette, stitches_per_skein):
+    """
+    Print the stitch and skein counts of each colour.
+    """
+    from crosstitch_helper.stitch_counter import skein_count
 
     click.echo("Stitch counts for each colour:")
     click.echo(counter.stitch_count_string())
@@ -49,7 +317,309 @@ def stitchify(image, palette_name, stitches_per_skein):
     for colour in counter.stitch_count:
         click.echo("{}\t{}".format(
             palette[colour][0],
-            math.ceil(1.0 * counter.stitch_count[colour]/stitches_per_skein)))
+            skein_count(counter.stitch_count[colour], stitches_per_skein)))
+
+
+def _echo_thread_estimate(counter, palette, estimator):
+    """
+    Print the stitch counts and the estimated thread and skeins of each
+    colour.
+    """
+    click.echo("Stitch counts for each colour:")
+    click.echo(counter.stitch_count_string())
+
+    click.echo()
+    click.echo("Thread and skein estimates for each colour for {}-count "
+               "fabric and {} strands:".format(estimator.fabric_count,
+                                               estimator.strands))
+    estimates = estimator.colour_stats()
+    for colour in counter.stitch_count:
+        click.echo("{}\t{}\t{:.1f} m".format(
+            palette[colour][0], estimates[colour]["skeins"],
+            estimates[colour]["length"] / 100))
+
+
+@cli.command()
+@click.argument("image", type=click.Path(exists=True, dir_okay=False))
+@click.argument("palette_name")
+@click.option("--stitches-per-skein", type=int, default=1700,
+              help="How many stitches can one skein of thread make")
+@click.option("--state", "state_file", type=click.Path(dir_okay=False),
+              help="File for saving counts, defaults to IMAGE.state")
+@click.option("--chart-dir", type=click.Path(file_okay=False),
+              help="Directory for the chart, one PDF file per page. Pages "
+              "are rendered again when they change.")
+@click.option("--workers", type=int, default=None,
+              help="Number of processes rendering chart pages, defaults to "
+              "number of CPUs")
+@click.option("--interval", type=float, default=0.2, show_default=True,
+              help="Seconds between checks of the image file")
+@click.option("--debounce", type=float, default=0.3, show_default=True,
+              help="Seconds the image must stay unchanged before updating")
+def watch(image, palette_name, stitches_per_skein, state_file, chart_dir,
+          workers, interval, debounce):
+    """
+    Update counts and chart of IMAGE using PALETTE whenever IMAGE is saved.
+
+    The process stays running, with modules and the palette loaded, and only
+    the parts of the image that changed are counted and rendered again. Stop
+    with Ctrl-C.
+    """
+    # pylint: disable=too-many-arguments, too-many-locals
+    import itertools
+    import multiprocessing
+    from crosstitch_helper.chart_renderer import ChartRenderer
+    from crosstitch_helper.imagetool import ImageTool
+    from crosstitch_helper.incremental import IncrementalCounter
+    from crosstitch_helper.stitch_counter import StitchCounter
+    from crosstitch_helper.watcher import FileWatcher
+
+    palette = _get_palette(palette_name)
+    incremental = IncrementalCounter(None, state_file or image + ".state",
+                                     palette=palette)
+    watcher = FileWatcher(image, interval=interval, debounce=debounce)
+
+    def _update(saved, pool):
+        start = time.perf_counter()
+        image_tool = ImageTool(image)
+        incremental.update(image_tool)
+        _echo_counts(StitchCounter(incremental, palette), palette,
+                     stitches_per_skein)
+        rendered = []
+        if chart_dir:
+            renderer = ChartRenderer(image_tool, palette)
+            rendered = renderer.render_pages(
+                chart_dir, pool=pool, workers=workers,
+                pages=_pages_to_render(renderer, incremental.changed_tiles,
+                                       chart_dir))
+        done = time.perf_counter()
+        click.echo("Counted {} of {} tiles, rendered {} pages in {:.0f} ms "
+                   "({:.0f} ms after the save was detected)".format(
+                       len(incremental.changed_tiles), incremental.tile_count,
+                       len(rendered), 1000 * (done - start),
+                       1000 * (done - saved)), err=True)
+
+    with contextlib.ExitStack() as stack:
+        pool = None
+        if chart_dir:
+            pool = stack.enter_context(multiprocessing.Pool(workers))
+        try:
+            for saved in itertools.chain([time.perf_counter()],
+                                         watcher.changes()):
+                try:
+                    _update(saved, pool)
+                except (OSError, ValueError) as error:
+                    click.echo("Could not update: {}".format(error), err=True)
+                click.echo("Watching {} for changes".format(image), err=True)
+        except KeyboardInterrupt:
+            pass
+
+
+def _pages_to_render(renderer, changed_tiles, chart_dir):
+    """
+    Return the chart pages that overlap changed tiles or whose files are
+    missing.
+
+    :changed_tiles: bounds `(min_x, min_y, max_x, max_y)` of the tiles that
+                    changed, from `IncrementalCounter.changed_tiles`. The
+                    tiles need not be the same size as the pages.
+    """
+    import numpy as np
+    from crosstitch_helper.chart_renderer import page_file_name
+
+    tiles = np.array(changed_tiles, dtype=np.int64).reshape(-1, 4)
+    pages = []
+    for index, (min_x, min_y, max_x, max_y) in enumerate(renderer.pages()):
+        overlaps = (tiles[:, 0] < max_x) & (tiles[:, 2] > min_x) & \
+            (tiles[:, 1] < max_y) & (tiles[:, 3] > min_y)
+        if overlaps.any() or not os.path.exists(
+                os.path.join(chart_dir, page_file_name(index))):
+            pages.append((min_x, min_y, max_x, max_y))
+    return pages
+
+
+@cli.command()
+@click.argument("palette_name")
+@click.argument("images", nargs=-1, type=click.Path(exists=True,
+                                                    dir_okay=False))
+@click.option("--glob", "patterns", multiple=True,
+              help="Glob pattern of images to process, can be repeated")
+@click.option("--workers", type=int, default=None,
+              help="Number of worker processes, defaults to number of CPUs")
+@click.option("--stitches-per-skein", type=int, default=1700,
+              help="How many stitches can one skein of thread make")
+@click.option("--format", "output_format", type=click.Choice(["csv", "json"]),
+              default="csv", help="Format of the report")
+@click.option("--output", type=click.File("w"), default="-",
+              help="File for the report, defaults to stdout")
+@click.option("--lazy", is_flag=True,
+              help="Process the images in strips from a memory-mapped cache "
+              "instead of holding them in memory")
+def stitchify_batch(palette_name, images, patterns, workers,
+                    stitches_per_skein, output_format, output, lazy):
+    """
+    Count stitches and skeins of many IMAGES using PALETTE.
+
+    Images can be given as arguments or using --glob. They are processed
+    concurrently, and a report with counts of each image and their totals is
+    written. Palette with the same name must be present in conf/palettes.py.
+    """
+    # pylint: disable=too-many-arguments
+    from crosstitch_helper.batch import BatchCounter, BatchReport
+
+    palette = _get_palette(palette_name)
+    paths = list(images)
+    for pattern in patterns:
+        paths.extend(sorted(glob.glob(pattern, recursive=True)))
+    paths = list(dict.fromkeys(paths))
+    if not paths:
+        click.echo("No images given")
+        sys.exit(1)
+
+    results = BatchCounter(palette, workers=workers, lazy=lazy).count(paths)
+    report = BatchReport(results, palette, stitches_per_skein)
+    if output_format == "json":
+        report.write_json(output)
+    else:
+        report.write_csv(output)
+
+    for image, error in report.errors():
+        click.echo("{}: {}".format(image, error), err=True)
+    if report.errors():
+        sys.exit(1)
+
+
+@cli.command()
+@click.argument("image", type=click.File("rb"))
+@click.argument("palette_name")
+@click.argument("output", type=click.Path(dir_okay=False, writable=True))
+@click.option("--page-width", type=int, default=50,
+              help="Width of one chart page in stitches")
+@click.option("--page-height", type=int, default=80,
+              help="Height of one chart page in stitches")
+@click.option("--workers", type=int, default=None,
+              help="Number of worker processes, defaults to number of CPUs")
+@click.option("--lazy", is_flag=True,
+              help="Process the image in strips from a memory-mapped cache "
+              "instead of holding it in memory")
+def render(image, palette_name, output, page_width, page_height, workers,
+           lazy):
+    """
+    Render a printable chart of IMAGE using PALETTE into OUTPUT PDF file.
+
+    Palette with the same name must be present in conf/palettes.py.
+    """
+    from crosstitch_helper.chart_renderer import ChartRenderer
+    from crosstitch_helper.imagetool import ImageTool
+
+    palette = _get_palette(palette_name)
+    renderer = ChartRenderer(ImageTool(image, lazy=lazy), palette,
+                             page_width=page_width, page_height=page_height)
+    try:
+        renderer.render(output, workers=workers)
+    except ValueError as error:
+        click.echo(error)
+        sys.exit(1)
+    click.echo("Wrote {} pages to {}".format(len(renderer.pages()), output))
+
+
+@cli.command()
+@click.argument("image", type=click.File("rb"))
+@click.argument("palette_name")
+@click.argument("output", type=click.Path(writable=True))
+@click.option("--format", "output_format", type=click.Choice(["pdf", "svg"]),
+              default="pdf", show_default=True,
+              help="pdf writes one multi-page file, svg a directory with one "
+              "file per page")
+@click.option("--page-width", type=int, default=50,
+              help="Width of one chart page in stitches")
+@click.option("--page-height", type=int, default=80,
+              help="Height of one chart page in stitches")
+@click.option("--lazy", is_flag=True,
+              help="Process the image in strips from a memory-mapped cache "
+              "instead of holding it in memory")
+def vector_chart(image, palette_name, output, output_format, page_width,
+                 page_height, lazy):
+    """
+    Write a compact vector chart of IMAGE using PALETTE into OUTPUT.
+
+    Runs of stitches of the same colour are drawn as single shapes, which
+    makes the chart much faster to write and smaller than with `render`.
+    Palette with the same name must be present in conf/palettes.py.
+    """
+    # pylint: disable=too-many-arguments
+    from crosstitch_helper.imagetool import ImageTool
+    from crosstitch_helper.vector_chart import VectorChartWriter
+
+    palette = _get_palette(palette_name)
+    writer = VectorChartWriter(ImageTool(image, lazy=lazy), palette,
+                               page_width=page_width, page_height=page_height)
+    try:
+        if output_format == "svg":
+            pages = len(writer.write_svg(output))
+        else:
+            pages = writer.write_pdf(output)
+    except ValueError as error:
+        click.echo(error)
+        sys.exit(1)
+    click.echo("Wrote {} pages to {}".format(pages, output))
+
+
+@cli.command()
+@click.argument("image", type=click.File("rb"))
+@click.argument("output", type=click.Path(writable=True))
+@click.option("--size", type=int, default=1024, show_default=True,
+              help="Largest width or height of the preview image")
+@click.option("--tiles", is_flag=True,
+              help="Write tiles of the zoom levels into the directory OUTPUT "
+              "as LEVEL/COLUMN/ROW.png instead of one image")
+@click.option("--levels", type=str, default=None,
+              help="Comma separated zoom levels written with --tiles, "
+              "defaults to all")
+@click.option("--texture", is_flag=True,
+              help="Draw the stitches as crosses when zoomed in")
+@click.option("--cell-size", type=int, default=8, show_default=True,
+              help="Pixels per stitch at the largest zoom level, a power of "
+              "two")
+@click.option("--floss-palette", type=click.Path(exists=True, dir_okay=False),
+              default=None, help="Show each colour as the best matching "
+              "floss of this palette file")
+@_instrumentation_options
+def preview(image, output, size, tiles, levels, texture, cell_size,
+            floss_palette):
+    """
+    Write a preview of how IMAGE looks when stitched into OUTPUT.
+
+    The preview is drawn at the largest zoom level that fits in --size, or
+    as tiles at several zoom levels for viewing large patterns.
+    """
+    # pylint: disable=too-many-arguments
+    from imageio import imwrite
+    from crosstitch_helper.imagetool import ImageTool
+    from crosstitch_helper.preview import PreviewPyramid
+
+    palette = None
+    if floss_palette:
+        from crosstitch_helper.palette import Palette
+        palette = Palette.load(floss_palette)
+    try:
+        pyramid = PreviewPyramid(ImageTool(image), palette=palette,
+                                 cell_size=cell_size, texture=texture)
+        if tiles:
+            if levels:
+                levels = [int(level) for level in levels.split(",")]
+            count = pyramid.write_tiles(output, levels=levels)
+            click.echo("Wrote {} tiles of {} zoom levels to {}".format(
+                count, pyramid.levels, output))
+            return
+        level = max([level for level in range(pyramid.levels)
+                     if max(pyramid.level_size(level)) <= size] or [0])
+        imwrite(output, pyramid.image(level))
+    except ValueError as error:
+        click.echo(error)
+        sys.exit(1)
+    click.echo("Wrote preview of {}x{} pixels to {}".format(
+        *pyramid.level_size(level), output))
 
 
 @cli.command()
@@ -58,18 +628,251 @@ def stitchify(image, palette_name, stitches_per_skein):
               help="Variable name in the output dict")
 @click.option("--symbol-file", type=click.File("r"), default="conf/symbols.py",
               help="File containing a list of symbols to be used")
-def create_palette(image, palette_name, symbol_file):
+@click.option("--lazy", is_flag=True,
+              help="Process the image in strips from a memory-mapped cache "
+              "instead of holding it in memory")
+@click.option("--sequential-symbols", is_flag=True,
+              help="Use the symbols in the order of the symbol file instead "
+              "of choosing distinct symbols for similar colours")
+@_instrumentation_options
+def create_palette(image, palette_name, symbol_file, lazy,
+                   sequential_symbols):
     """
     Automatically create a palette for an image.
 
-    The created palette is likely not optimal when it comes to selection of
-    symbols or contrast colours: the palette can be greatly improved with some
-    handywork.
+    Colours that are close to each other get symbols of different shapes, and
+    each symbol is black or white depending on which stands out better from
+    its colour. The palette can still be improved with some handywork.
     """
-    image_tool = ImageTool(image)
+    from crosstitch_helper import stats
+    from crosstitch_helper.imagetool import ImageTool
+    from crosstitch_helper.palette_creator import PaletteCreator
+
+    image_tool = ImageTool(image, lazy=lazy)
     symbols = _read_symbols(symbol_file)
-    palette_maker = PaletteCreator(image_tool.iterate_pixels, symbols)
-    print(palette_maker.palette_string())
+    palette_maker = PaletteCreator(image_tool, symbols,
+                                   sequential_symbols=sequential_symbols)
+    palette_maker.create_palette()
+    with stats.timer("output"):
+        print(palette_maker.palette_string())
+
+
+@cli.command()
+@click.argument("image", type=click.File("rb"))
+@click.argument("n_colours", type=click.IntRange(min=1))
+@click.argument("output", type=click.Path(dir_okay=False, writable=True))
+@click.option("--floss-palette", type=click.Path(exists=True, dir_okay=False),
+              default="palettes/dmc.json",
+              help="Palette file of the available flosses")
+@click.option("--palette-name", type=str, default="palette",
+              help="Variable name in the output dict")
+@click.option("--chart", type=click.Path(dir_okay=False, writable=True),
+              default=None, help="Also render a PDF chart into this file")
+@click.option("--seed", type=int, default=0,
+              help="Seed for choosing the colours")
+@click.option("--dither", type=click.Choice(["none", "ordered",
+                                             "floyd-steinberg"]),
+              default="none", help="Dithering used when mapping the image "
+              "onto the chosen flosses")
+@click.option("--lazy", is_flag=True,
+              help="Process the image in strips from a memory-mapped cache "
+              "instead of holding it in memory")
+def quantize(image, n_colours, output, floss_palette, palette_name, chart,
+             seed, dither, lazy):
+    """
+    Reduce IMAGE to at most N_COLOURS flosses and save it to OUTPUT.
+
+    The flosses are chosen from the floss palette by clustering the colours
+    of the image. The flosses and their stitch counts are printed, followed by
+    the palette dict of the flosses that can be added to conf/palettes.py.
+    """
+    # pylint: disable=too-many-arguments
+    from imageio import imwrite
+    from crosstitch_helper.chart_renderer import ChartRenderer
+    from crosstitch_helper.imagetool import ImageTool
+    from crosstitch_helper.palette import Palette
+    from crosstitch_helper.quantizer import Quantizer
+    from crosstitch_helper.stitch_counter import StitchCounter
+
+    quantizer = Quantizer(Palette.load(floss_palette), n_colours,
+                          random_state=seed)
+    quantized = quantizer.quantize(ImageTool(image, lazy=lazy), dither=dither)
+    imwrite(output, quantized.colour_values())
+
+    chart_palette = quantizer.palette.to_chart_palette()
+    counter = StitchCounter(quantized, chart_palette)
+    counter.count_all_stitches()
+    click.echo("Flosses and stitch counts:")
+    for floss in quantizer.palette.colors:
+        click.echo("{}\t{}".format(
+            floss, counter.stitch_count_for_colour(floss.color.lower())))
+    click.echo()
+    click.echo("{} = {}".format(palette_name,
+                                pprint.pformat(chart_palette, indent=4)))
+
+    if chart:
+        ChartRenderer(quantized, chart_palette).render(chart)
+
+
+@cli.command()
+@click.option("--host", default="127.0.0.1", show_default=True,
+              help="Address to listen on")
+@click.option("--port", type=int, default=8080, show_default=True,
+              help="Port to listen on")
+@click.option("--workers", type=int, default=None,
+              help="Number of threads processing images, defaults to number "
+              "of CPUs")
+@click.option("--cache-size", type=int, default=128, show_default=True,
+              help="Number of results kept in memory for repeated images")
+@click.option("--preview-cache-size", type=int, default=8, show_default=True,
+              help="Number of previews kept in memory for fetching their "
+              "tiles")
+@click.option("--floss-palette", type=click.Path(exists=True, dir_okay=False),
+              default="palettes/dmc.json",
+              help="Palette file of the available flosses, for quantizing")
+@click.option("--symbol-file", type=click.File("r"), default="conf/symbols.py",
+              help="File containing a list of symbols to be used")
+def serve(host, port, workers, cache_size, preview_cache_size, floss_palette,
+          symbol_file):
+    """
+    Serve stitch counts, palettes and charts over HTTP.
+
+    Images are POSTed to /stitchify?palette=NAME, /create-palette,
+    /quantize?colours=N or /chart?palette=NAME, and the results are returned
+    as JSON, PDF or SVG. GET /metrics reports request latencies and
+    throughput. Palettes, modules and recent results stay in memory between
+    requests. Stop with Ctrl-C.
+    """
+    # pylint: disable=too-many-arguments
+    import asyncio
+    from crosstitch_helper.server import PatternServer
+
+    chart_palettes = {name: value for name, value in vars(palettes).items()
+                      if not name.startswith("_") and isinstance(value, dict)}
+    server = PatternServer(chart_palettes, _read_symbols(symbol_file),
+                           floss_palette=floss_palette, workers=workers,
+                           cache_size=cache_size,
+                           preview_cache_size=preview_cache_size)
+    server.warm()
+
+    def _ready(address):
+        click.echo("Serving on http://{}:{}/ with {} workers".format(
+            address[0], address[1], server.workers), err=True)
+
+    try:
+        asyncio.run(server.serve(host, port, ready=_ready))
+    except KeyboardInterrupt:
+        pass
+
+
+@cli.command()
+@click.argument("palette_file", type=click.Path(exists=True, dir_okay=False))
+@click.argument("table_file", type=click.Path(dir_okay=False))
+@click.option("--workers", type=int, default=None,
+              help="Number of worker processes, defaults to number of CPUs")
+@click.option("--verify-samples", type=int, default=100000,
+              help="Number of random colours checked after building")
+def build_table(palette_file, table_file, workers, verify_samples):
+    """
+    Build a lookup table of the best floss for every RGB colour.
+
+    The table for PALETTE_FILE (e.g. palettes/dmc.json) is written to
+    TABLE_FILE (a .npy file) and can be used with `Palette.use_lookup_table`.
+    """
+    from crosstitch_helper import lookup_table
+    from crosstitch_helper.palette import Palette
+
+    palette = Palette.load(palette_file)
+
+    def _report(done, total):
+        click.echo("\rMatched {}/{} blocks".format(done, total), nl=False,
+                   err=True)
+
+    lookup_table.build_lookup_table(palette, table_file, workers=workers,
+                                    progress=_report)
+    click.echo(err=True)
+    click.echo("Lookup table written to {}".format(table_file))
+    if verify_samples:
+        _verify_table(palette, table_file, verify_samples)
+
+
+@cli.command()
+@click.argument("palette_file", type=click.Path(exists=True, dir_okay=False))
+@click.argument("table_file", type=click.Path(exists=True, dir_okay=False))
+@click.option("--samples", type=int, default=100000,
+              help="Number of random colours to check")
+def verify_table(palette_file, table_file, samples):
+    """
+    Check a lookup table against direct colour matching.
+
+    A random sample of colours is matched using PALETTE_FILE and compared to
+    the contents of TABLE_FILE.
+    """
+    from crosstitch_helper.palette import Palette
+
+    _verify_table(Palette.load(palette_file), table_file, samples)
+
+
+@cli.command()
+@click.argument("palette_file", type=click.Path(exists=True, dir_okay=False))
+@click.argument("output", type=click.Path(dir_okay=False, writable=True))
+@click.option("--format", "output_format", type=click.Choice(["npz", "json"]),
+              default="npz", show_default=True, help="Output file format")
+@click.option("--table", "table_file",
+              type=click.Path(exists=True, dir_okay=False),
+              help="Lookup table built for the palette to embed in the "
+              "npz file")
+def convert_palette(palette_file, output, output_format, table_file):
+    """
+    Convert PALETTE_FILE between the JSON and binary formats.
+
+    The binary (npz) format stores the precomputed colour values and,
+    optionally, a lookup table, so that loading the palette needs no parsing
+    or colour conversions.
+    """
+    from crosstitch_helper.palette import Palette
+
+    palette = Palette.load(palette_file)
+    if table_file:
+        if output_format != "npz":
+            click.echo("A lookup table can only be embedded in npz files")
+            sys.exit(1)
+        palette.use_lookup_table(table_file)
+    palette.save(output, format=output_format,
+                 include_lookup_table=bool(table_file))
+    click.echo("Palette of {} flosses written to {}".format(len(palette),
+                                                            output))
+
+
+def _verify_table(palette, table_file, samples):
+    """
+    Verify a lookup table and exit with an error if it is not valid.
+    """
+    from crosstitch_helper import lookup_table
+
+    try:
+        table = lookup_table.load_lookup_table(palette, table_file)
+    except (OSError, ValueError) as error:
+        click.echo("Invalid lookup table: {}".format(error))
+        sys.exit(1)
+    mismatches = lookup_table.verify_lookup_table(palette, table, samples)
+    if len(mismatches):
+        click.echo("{} of the checked colours do not match the palette, "
+                   "e.g. #{:06x}".format(len(mismatches), mismatches[0]))
+        sys.exit(1)
+    click.echo("Lookup table OK ({} colours checked)".format(samples))
+
+
+def _get_palette(palette_name):
+    """
+    Return the palette from conf/palettes.py, or exit if it does not exist.
+    """
+    palette = getattr(palettes, palette_name, None)
+    if not palette:
+        click.echo(
+            "palette '{}' not found in conf/palettes.py".format(palette_name))
+        sys.exit(1)
+    return palette
 
 
 def _read_symbols(symbol_file):